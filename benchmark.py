@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+
+""" Throughput benchmarks of the PHY/LLC processing stages
+usage: python benchmark.py [name ...]
+"""
+
+import binascii
+import contextlib
+import io
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from ofdm.ofdm_queue import make_queue
+from ofdm.ofdm_sync import OfdmSquelch, OfdmSync
+from ofdm.ofdm_rx import OfdmRx
+from ofdm.ofdm_tx import OfdmTx, OfdmTxPlan
+from ofdm.ofdm_utils import OfdmConfig
+from ofdm.gray_qammod import GrayQamMod
+from ofdm.ofdm_coding import make_coding
+from img_operate import decode_image, image_packet_size, preview_image, read_image, read_image_bytes
+from llc.llc_frame import FRAME_OVERHEAD, check_frames, decode_frame, encode_frame, encode_frames, \
+    encode_frame_bytes, iter_payloads, transfer_session
+from llc.llc_harq import HarqBuffer
+from llc.llc_reassembly import Reassembly
+from llc.llc_nodeA import NodeALLC
+from llc.llc_nodeB import NodeBLLC
+from llc.llc_utils import calc_crc32, check_crc32, simu_pkt_loss_delay, bin2dec
+from ofdm.support import detfcount, ofdm_demodulation, ofdm_soft_demodulation, qpsk_demodulation, \
+    detect_preamble_cross_correlation
+
+PILOT_INDEX = [7, 21, 43, 57]
+DATA_INDEX = list(range(1, 7)) + list(range(8, 21)) + list(range(22, 27)) + \
+             list(range(38, 43)) + list(range(44, 57)) + list(range(58, 64))
+
+
+def rate(func, repeat=20):
+    """ call func repeatedly and return the number of calls per second """
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return repeat / (time.perf_counter() - start)
+
+
+def report(name, before, after, unit):
+    print("{:<24} before: {:>10.1f} {}  after: {:>10.1f} {}  speedup: {:.1f}x".format(
+        name, before, unit, after, unit, after / before))
+
+
+def bench_demodulation(num_symbol=100):
+    rx_samples_data = np.random.randn(num_symbol * 80) + 1j * np.random.randn(num_symbol * 80)
+    h_tilde = np.ones((64, 1), dtype=complex)
+    before = rate(lambda: detfcount(rx_samples_data, h_tilde, num_symbol, PILOT_INDEX, DATA_INDEX))
+    after = rate(lambda: ofdm_demodulation(rx_samples_data, h_tilde, num_symbol, PILOT_INDEX, DATA_INDEX))
+    report("demodulation", before, after, "pkt/s")
+    before = rate(lambda: qpsk_demodulation(rx_samples_data, h_tilde, num_symbol, PILOT_INDEX, DATA_INDEX))
+    for m in [4, 16, 64]:
+        qam_mod = GrayQamMod(m)
+        after = rate(lambda: ofdm_demodulation(rx_samples_data, h_tilde, num_symbol, PILOT_INDEX, DATA_INDEX,
+                                               qam_mod=qam_mod))
+        report("demodulation ({}-QAM)".format(m), before, after, "pkt/s")
+    # soft output against hard decision of the same constellation, more calls as the two are close
+    for m in [2, 4, 16, 64]:
+        qam_mod = GrayQamMod(m) if m > 2 else None
+        hard = rate(lambda: ofdm_demodulation(rx_samples_data, h_tilde, num_symbol, PILOT_INDEX, DATA_INDEX,
+                                              qam_mod=qam_mod), repeat=200)
+        for dtype in [np.float32, np.float16]:
+            soft = rate(lambda: ofdm_soft_demodulation(rx_samples_data, h_tilde, num_symbol, PILOT_INDEX,
+                                                       DATA_INDEX, [1, 1, 1, -1], qam_mod=qam_mod, dtype=dtype),
+                        repeat=200)
+            report("LLR {} vs hard ({})".format(np.dtype(dtype).name[5:], "{}-QAM".format(m) if m > 2 else "BPSK"),
+                   hard, soft, "pkt/s")
+
+
+def bench_detection(buffer_size=10000, num_symbol=100):
+    config = OfdmConfig(64, 16, 2, 'custom')
+    packet_len = config.preamble_sts_len + config.preamble_lts_len + num_symbol * config.sym_len
+    signal = 0.01 * (np.random.randn(buffer_size) + 1j * np.random.randn(buffer_size))
+    before = rate(lambda: detect_preamble_cross_correlation(config.training_signal_time, signal))
+    for detector in ['cross', 'auto']:
+        sync = OfdmSync(config.training_signal_time, config.preamble_sts_len + config.cp_len * 2, packet_len,
+                        detector=detector)
+        after = rate(lambda: sync.push(signal))
+        report("detection ({})".format(detector), before, after, "buf/s")
+
+
+def bench_squelch(buffer_size=10000, signal_db=20, num_buffer=50):
+    """ squelch of a receiver started in noise or while a transmission is on air: buffers searched during
+    the noise, during the transmission, and whether the gate opens for a packet once it has ended
+    """
+    noise = lambda: (np.random.randn(buffer_size) + 1j * np.random.randn(buffer_size)) / np.sqrt(2)
+    on_air = lambda: 10 ** (signal_db / 20) * noise()
+
+    def packet():
+        buffer = noise()
+        buffer[buffer_size // 2:buffer_size // 2 + 2000] += 10 ** (signal_db / 20) * noise()[:2000]
+        return buffer
+
+    for start, first in [("noise", noise), ("signal", on_air)]:
+        squelch = OfdmSquelch()
+        during = sum(squelch.check(first()) for _ in range(num_buffer))
+        idle = sum(squelch.check(noise()) for _ in range(num_buffer))
+        print("{:<24} searched {:>3} of {} buffers at start, {:>3} of {} in noise after, packet: {}, "
+              "floor: {:.2f} (noise 1)".format("squelch (starts in {})".format(start), during, num_buffer, idle,
+                                               num_buffer, "open" if squelch.check(packet()) else "GATED",
+                                               squelch.noise_floor))
+
+
+def bench_modulation(num_symbol=100, sample_rate=1e6):
+    config = OfdmConfig(64, 16, 2, 'custom')
+    bits = np.random.randint(0, 2, num_symbol * config.n_cbps)
+    plan = OfdmTxPlan(config, num_symbol, scale=2 ** 14, nbuf=22)
+    frames = rate(lambda: plan.build(bits), repeat=200)
+    print("{:<24} {:>10.1f} frames/s  (air time: {:.1f} frames/s at {:.0f} S/s)".format(
+        "modulation", frames, sample_rate / plan.frame_len, sample_rate))
+
+
+def bench_decoding(num_symbol=100, sample_rate=1e6, batch=8):
+    config = OfdmConfig(64, 16, 2, 'custom')
+    frame_len = config.preamble_sts_len + config.preamble_lts_len + num_symbol * config.sym_len
+    for rate_name in ['1/2', '2/3', '3/4']:
+        for n_bpsc in [1, 2, 4, 6]:
+            coding = make_coding('conv-' + rate_name, 48 * n_bpsc, n_bpsc)
+            bit_num = coding.packet_bit_size(num_symbol)
+            coded = coding.encode(np.random.randint(0, 2, bit_num), num_symbol)
+            llr = (coded * 2.0 - 1) * 4 + np.random.randn(coded.size)
+            packets = rate(lambda: coding.decode(llr), repeat=5)
+            # a backlog of packets is decoded in batches by the receiver
+            batched = batch * rate(lambda: coding.decode_batch([llr] * batch), repeat=2)
+            print("{:<24} {:>10.1f} pkt/s  {:>8.1f} kbit/s  batch of {}: {:>6.1f} pkt/s  "
+                  "(air time: {:.1f} pkt/s at {:.0f} S/s)".format(
+                      "viterbi ({}, {} bit/sc)".format(rate_name, n_bpsc), packets, packets * bit_num / 1e3, batch,
+                      batched, sample_rate / frame_len, sample_rate))
+
+
+def bench_harq(num_symbol=100, frame_num=100, mean_snr_db=1.0, max_tx=8, seed=0):
+    """ transmissions per frame over a Rayleigh block-fading link (one SNR per copy), BPSK rate 1/2 """
+    rng = np.random.default_rng(seed)
+    coding = make_coding('conv-1/2', 48, 1)
+    frame = np.random.randint(0, 2, coding.packet_bit_size(num_symbol) - 32)
+    frame = np.concatenate((frame, calc_crc32(frame))).astype(np.uint8)
+    symbols = coding.encode(frame, num_symbol) * 2.0 - 1
+    for combining in [False, True]:
+        harq = HarqBuffer(8, symbols.size)
+        tx_num, failed = [], 0
+        for seq in range(frame_num):
+            for tx in range(1, max_tx + 1):
+                noise_var = 1 / (10 ** (mean_snr_db / 10) * rng.exponential())
+                llr = 2 * (symbols + np.sqrt(noise_var) * rng.standard_normal(symbols.size)) / noise_var
+                combined = harq.combine(seq, llr) if combining else None
+                if check_crc32(coding.decode(combined if combined is not None else llr).ravel()):
+                    harq.release(seq, recovered=combined is not None)
+                    break
+            else:
+                failed += 1
+            tx_num.append(tx)
+        print("{:<24} {:>10.2f} tx/frame  failed: {}  nhit: {}  nmiss: {}  nrecovered: {}".format(
+            "harq ({})".format("chase combining" if combining else "no combining"), np.mean(tx_num),
+            failed, harq.nhit, harq.nmiss, harq.nrecovered))
+
+
+def _legacy_dec2bin(num_dec, size=32):
+    """ bit conversion of the LLC before llc.llc_frame """
+    bin_arr = np.array([], dtype=int)
+    for _ in range(0, size):
+        bin_arr = np.append(bin_arr, num_dec & 0x1)
+        num_dec >>= 1
+    return bin_arr[::-1]
+
+
+def _legacy_frame(payload, seq):
+    frame = np.concatenate((_legacy_dec2bin(seq, 16), payload))
+    return np.concatenate((frame, _legacy_dec2bin(binascii.crc32(bytes(np.packbits(frame))))))
+
+
+def _legacy_parse(frame):
+    crc = np.array(_legacy_dec2bin(binascii.crc32(bytes(np.packbits(frame[:-32])))), dtype=np.uint8)
+    if (frame[-32:] == crc).all():
+        return bin2dec(np.array2string(frame[0:16]).translate({ord(i): None for i in '[] '}))
+
+
+def bench_frame(num_symbol=100, batch=64):
+    """ header and CRC cost per frame: build a data frame and parse it back """
+    packet_bit_size = OfdmConfig(64, 16, 2, 'custom').packet_bit_size(num_symbol)
+    payloads = np.random.randint(0, 2, (batch, packet_bit_size - FRAME_OVERHEAD)).astype(np.uint8)
+    before = rate(lambda: _legacy_parse(_legacy_frame(payloads[0, :packet_bit_size - 48], 513)), repeat=200)
+    after = rate(lambda: decode_frame(encode_frame(payloads[0], 513, 0, 0, packet_bit_size)), repeat=200)
+    report("frame codec", before, after, "frame/s")
+    after = rate(lambda: check_frames(encode_frames(payloads, np.arange(batch), 0, 0, packet_bit_size))) * batch
+    report("frame codec (batch {})".format(batch), before, after, "frame/s")
+
+
+def _legacy_read_image(img_path):
+    """ image ingest before the versioned header: every pixel appended to a list """
+    img = Image.open(img_path)
+    grey_level = 3 if img.mode == 'RGB' else 1
+    img_data = np.array(list(img.getdata()), dtype=np.uint8)
+    img_data.shape = len(img_data) * grey_level, 1
+    width, height = img.size
+    pkt = [width // 128, width % 128, height // 128, height % 128, grey_level]
+    for i in range(len(img_data)):
+        pkt.append(img_data[i][0])
+    return np.unpackbits(np.array(pkt, dtype=np.uint8))
+
+
+def _test_image(width, height):
+    path = os.path.join(tempfile.mkdtemp(), 'payload.png')
+    Image.fromarray(np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)).save(path)
+    return path
+
+
+def bench_ingest(width=512, height=512):
+    """ image file to image packet, and the frame count of the file selection """
+    path = _test_image(width, height)
+    with contextlib.redirect_stdout(io.StringIO()):
+        before = rate(lambda: _legacy_read_image(path), repeat=2)
+        after = rate(lambda: read_image_bytes(path), repeat=10)
+    report("image ingest", before, after, "img/s")
+    report("frame count", before, rate(lambda: image_packet_size(path), repeat=200), "img/s")
+
+
+def _test_photo(width, height):
+    """ a smooth photo-like image saved as JPEG """
+    y, x = np.mgrid[0:height, 0:width] / max(width, height)
+    img = np.stack([0.5 + 0.4 * np.sin(6 * x + 4 * y ** 2), 0.5 + 0.4 * np.cos(9 * x * y + 2 * y),
+                    0.5 + 0.3 * np.sin(12 * np.hypot(x - 0.5, y - 0.4))], axis=-1)
+    img = np.clip(255 * img + np.random.normal(0, 4, img.shape), 0, 255).astype(np.uint8)
+    path = os.path.join(tempfile.mkdtemp(), 'photo.jpg')
+    Image.fromarray(img).save(path, quality=85)
+    return path
+
+
+def bench_codec(width=640, height=480, num_symbol=100):
+    """ frames of an image packet per payload codec, for a photo saved as JPEG """
+    packet_bit_size = OfdmConfig(64, 16, 2, 'custom').packet_bit_size(num_symbol)
+    pkt_size = (packet_bit_size - FRAME_OVERHEAD) // 8 * 8
+    path = _test_photo(width, height)
+    raw = -(-8 * image_packet_size(path) // pkt_size)
+    for codec, quality, max_bytes in [('raw', None, None), ('file', None, None), ('PNG', None, None),
+                                      ('JPEG', 50, None), ('WEBP', None, None), ('JPEG', None, 8000)]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            size = len(read_image_bytes(path, codec, quality, max_bytes))
+        num_frame = -(-8 * size // pkt_size)
+        print("{:<24} {:>10d} bytes  {:>6d} frames  reduction: {:.1f}x".format(
+            "codec ({}{}{})".format(codec, ", q={}".format(quality) if quality else "",
+                                   ", <={}B".format(max_bytes) if max_bytes else ""),
+            size, num_frame, raw / num_frame))
+
+
+def _psnr(img, ref):
+    return 10 * np.log10(255 ** 2 / max(np.mean((np.asarray(img, dtype=float) - ref) ** 2), 1e-10))
+
+
+def bench_preview(width=640, height=480, num_symbol=100, psnr_db=25):
+    """ frames received in order before the preview is within psnr_db of the final image """
+    packet_bit_size = OfdmConfig(64, 16, 2, 'custom').packet_bit_size(num_symbol)
+    pkt_bytes = (packet_bit_size - FRAME_OVERHEAD) // 8
+    path = _test_photo(width, height)
+    for codec in ['raw', 'pyramid', 'JPEG', 'PJPEG']:
+        with contextlib.redirect_stdout(io.StringIO()):
+            pkt = read_image_bytes(path, codec)
+        ref = np.asarray(decode_image(pkt)[1], dtype=float)
+        num_frame = -(-len(pkt) // pkt_bytes)
+
+        def usable(k):
+            preview = preview_image(pkt, k * pkt_bytes)
+            return preview is not None and _psnr(preview[1], ref) >= psnr_db
+
+        # fewest frames for a usable preview, by bisection
+        low, high = 1, num_frame
+        while low < high:
+            mid = (low + high) // 2
+            low, high = (low, mid) if usable(mid) else (mid + 1, high)
+        print("{:<24} {:>6d} of {:>6d} frames ({:>5.1f}%) for {} dB".format(
+            "preview ({})".format(codec), low, num_frame, 100 * low / num_frame, psnr_db))
+
+
+def _held(func):
+    """ bytes still allocated by the result of func, and the result """
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return held, result
+
+
+def bench_payload(width=512, height=512, num_symbol=100):
+    """ image payload held by the transmitter and the receiver, and framing it up to the modulator input:
+    a list of bits sliced per frame before, zero-copy byte slices unpacked at the modulator after
+    """
+    packet_bit_size = OfdmConfig(64, 16, 2, 'custom').packet_bit_size(num_symbol)
+    pkt_size = (packet_bit_size - FRAME_OVERHEAD) // 8 * 8
+    path = _test_image(width, height)
+    before, bits = _held(lambda: list(read_image(path)))
+    after, data = _held(lambda: read_image_bytes(path))
+    print("{:<24} before: {:>10.1f} MB  after: {:>10.3f} MB  reduction: {:.0f}x".format(
+        "payload memory", before / 1e6, after / 1e6, before / after))
+    num_frame = -(-len(bits) // pkt_size)
+    before = _held(lambda: [0] * num_frame * pkt_size)[0]
+    after = _held(lambda: Reassembly(pkt_size, num_frame))[0]
+    print("{:<24} before: {:>10.1f} MB  after: {:>10.3f} MB  reduction: {:.0f}x".format(
+        "rx buffer memory", before / 1e6, after / 1e6, before / after))
+
+    def frames_before():
+        for start in range(0, len(bits), pkt_size):
+            encode_frame(bits[start:start + pkt_size], 0, 0, 0, packet_bit_size)
+
+    def frames_after():
+        for pyload in iter_payloads(data, pkt_size // 8):
+            np.unpackbits(np.frombuffer(encode_frame_bytes(pyload, 0, 0, 0, packet_bit_size // 8), dtype=np.uint8))
+
+    report("payload framing", rate(frames_before, 3) * num_frame, rate(frames_after, 3) * num_frame, "frame/s")
+
+
+class _LoopbackPhy(object):
+    """ one direction of a link for the LLC benchmarks: a frame is on the air for frame_time, then lost or
+    delayed by simu_pkt_loss_delay while the next one is sent
+    """
+
+    def __init__(self, packet_bit_size, frame_time, loss_rate, mean_delay, std_delay):
+        self.packet_bit_size = packet_bit_size
+        self.soft_output = None
+        self.frame_time = frame_time
+        self.loss_delay = (loss_rate, mean_delay, std_delay)
+        self.air = threading.Lock()
+        self.packets = queue.Queue()
+        self.nput = 0
+
+    def put(self, frame, block=True, timeout=None):
+        self.nput += 1
+        with self.air:
+            time.sleep(self.frame_time)
+        if isinstance(frame, (bytes, bytearray, memoryview)):
+            # unpacked at the modulator input, as by OfdmTx
+            frame = np.unpackbits(np.frombuffer(frame, dtype=np.uint8))
+        threading.Thread(target=self._deliver, args=(np.array(frame),), daemon=True).start()
+        return True
+
+    def _deliver(self, frame):
+        if simu_pkt_loss_delay(*self.loss_delay):
+            self.packets.put(frame)
+
+    def get(self, timeout=0.1):
+        try:
+            return self.packets.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+def bench_arq(num_frame=200, num_symbol=100, sample_rate=1e6, loss_rate=0.1, mean_delay=0.02, std_delay=0.005,
+              window_size=8):
+    """ transfer rate over a lossy loopback link with the air time of BPSK packets (stop-and-wait-ARQ
+    transfers 32 frames)
+    """
+    config = OfdmConfig(64, 16, 2, 'custom')
+    packet_bit_size = config.packet_bit_size(num_symbol)
+    pkt_size = (packet_bit_size - FRAME_OVERHEAD) // 8 * 8
+    ack_num_symbol = config.symbols_for_bits(FRAME_OVERHEAD + window_size)
+    frame_time, ack_time = [(config.preamble_sts_len + config.preamble_lts_len + sym_num * config.sym_len) /
+                            sample_rate for sym_num in [num_symbol, ack_num_symbol]]
+    for name, arq_mode, block_ack in [
+            ("stop-and-wait-ARQ", "stop-and-wait-ARQ", 0),
+            ("selective-repeat-ARQ", "selective-repeat-ARQ", 0),
+            ("selective-repeat (bACK)", "selective-repeat-ARQ", window_size // 2)]:
+        frame_num = min(num_frame, 32) if arq_mode == "stop-and-wait-ARQ" else num_frame
+        # the last frame is a short one
+        tx_pkt = np.random.bytes(frame_num * pkt_size // 8 - 100)
+        data_link = _LoopbackPhy(packet_bit_size, frame_time, loss_rate, mean_delay, std_delay)
+        ack_link = _LoopbackPhy(config.packet_bit_size(ack_num_symbol), ack_time, loss_rate, mean_delay, std_delay)
+        node_a = NodeALLC(data_link, ack_link, packet_bit_size, window_size=window_size)
+        node_b = NodeBLLC(ack_link, data_link, packet_bit_size, window_size=window_size, block_ack=block_ack)
+        sender = threading.Thread(target=node_a.send, args=(tx_pkt, pkt_size, True, arq_mode), daemon=True)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            sender.start()
+            rx_pkt = node_b.recv(pkt_size, frame_num, "loopback", True, arq_mode)
+            elapsed = time.perf_counter() - start
+            node_a.done()
+            sender.join()
+            if node_a.is_alive():
+                node_a.join()
+        ok = rx_pkt.tobytes() == tx_pkt
+        print("{:<24} {:>10.1f} frames/s  {:>8.1f} kbit/s  ACKs/frame: {:.2f}  ok: {}  "
+              "(air time: {:.1f} frames/s)".format(name, frame_num / elapsed, frame_num * pkt_size / elapsed / 1e3,
+                                                   ack_link.nput / frame_num, ok, 1 / frame_time))
+        print("{:<24} {}".format("", node_a.format_stats()))
+
+
+def bench_resume(num_frame=200, num_symbol=100, sample_rate=1e6, loss_rate=0.1, mean_delay=0.02, std_delay=0.005,
+                 window_size=8, held=0.9):
+    """ transfer interrupted once held of its frames are in. Both sides restarted (selective-repeat-ARQ): sent
+    again from the start without the receiver journal, only the missing frames with it. The receiver alone
+    restarted while the transmitter goes on: the new receiver resumes from the journal and its block ACK,
+    without the journal it waits for frames the transmitter has done with
+    """
+    config = OfdmConfig(64, 16, 2, 'custom')
+    packet_bit_size = config.packet_bit_size(num_symbol)
+    pkt_size = (packet_bit_size - FRAME_OVERHEAD) // 8 * 8
+    ack_num_symbol = config.symbols_for_bits(FRAME_OVERHEAD + window_size)
+    frame_time, ack_time = [(config.preamble_sts_len + config.preamble_lts_len + sym_num * config.sym_len) /
+                            sample_rate for sym_num in [num_symbol, ack_num_symbol]]
+    tx_pkt = np.random.bytes(num_frame * pkt_size // 8 - 100)
+
+    def transfer(journal_dir, stop_at=None, arq_mode="selective-repeat-ARQ", restart_receiver=False):
+        """ frames sent and time to the end of the transfer, from the receiver restart with restart_receiver """
+        data_link = _LoopbackPhy(packet_bit_size, frame_time, loss_rate, mean_delay, std_delay)
+        ack_link = _LoopbackPhy(config.packet_bit_size(ack_num_symbol), ack_time, loss_rate, mean_delay, std_delay)
+        node_a = NodeALLC(data_link, ack_link, packet_bit_size, window_size=window_size,
+                          session=transfer_session(tx_pkt))
+
+        def receive(stop_at):
+            def on_frame(seq, start, end):
+                if stop_at is not None and seq + 1 >= stop_at:
+                    node_b.done()
+
+            node_b = NodeBLLC(ack_link, data_link, packet_bit_size, window_size=window_size,
+                              block_ack=window_size // 2, on_frame=on_frame, journal_dir=journal_dir)
+            return node_b.recv(pkt_size, num_frame, "loopback", True, arq_mode)
+
+        sender = threading.Thread(target=node_a.send, args=(tx_pkt, pkt_size, True, arq_mode), daemon=True)
+        start, nsent = time.perf_counter(), 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            sender.start()
+            rx_pkt = receive(stop_at)
+            if restart_receiver:
+                start, nsent = time.perf_counter(), data_link.nput
+                rx_pkt = receive(None)
+            elapsed = time.perf_counter() - start
+            node_a.done()
+            sender.join()
+            if node_a.is_alive():
+                node_a.join()
+        return rx_pkt, data_link.nput - nsent, elapsed
+
+    results = []
+    for journal in [False, True]:
+        with tempfile.TemporaryDirectory() as journal_dir:
+            journal_dir = journal_dir if journal else None
+            transfer(journal_dir, int(held * num_frame))
+            rx_pkt, nsent, elapsed = transfer(journal_dir)
+            results.append((nsent, elapsed, rx_pkt.tobytes() == tx_pkt))
+    (before_sent, before_time, before_ok), (after_sent, after_time, after_ok) = results
+    print("{:<24} restart: {:>5} frames {:>6.2f} s  resume: {:>5} frames {:>6.2f} s  speedup: {:.1f}x  "
+          "ok: {}".format("resume ({:.0f}% held)".format(100 * held), before_sent, before_time, after_sent,
+                          after_time, before_time / after_time, before_ok and after_ok))
+    for arq_mode in ["selective-repeat-ARQ", "stop-and-wait-ARQ"]:
+        with tempfile.TemporaryDirectory() as journal_dir:
+            rx_pkt, nsent, elapsed = transfer(journal_dir, int(held * num_frame), arq_mode, restart_receiver=True)
+        print("{:<24} receiver restarted at {:.0f}%, then: {:>5} frames {:>6.2f} s  ok: {}".format(
+            "resume ({})".format("SR" if arq_mode.startswith("selective") else "S&W"), 100 * held, nsent, elapsed,
+            rx_pkt.tobytes() == tx_pkt))
+
+
+def _consume(q, count):
+    for _ in range(count):
+        q.get()
+
+
+def _shm_segments():
+    """ names of the shared memory segments of the machine """
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+
+def bench_queue(buffer_size=10000, count=500):
+    buffer = np.zeros(buffer_size, dtype=np.complex128)
+    segments = _shm_segments()
+    for queue_type, in_process in [('manager', False), ('thread', False), ('shm', False), ('shm', True)]:
+        q = make_queue(queue_type, 20, buffer.nbytes)
+        if in_process:
+            consumer = multiprocessing.Process(target=_consume, args=(q, count))
+        else:
+            consumer = threading.Thread(target=_consume, args=(q, count))
+        start = time.perf_counter()
+        consumer.start()
+        for _ in range(count):
+            q.put(buffer)
+        consumer.join()
+        print("{:<24} {:>10.1f} buf/s  blocked puts: {}".format(
+            "queue ({}{})".format(queue_type, ", process" if in_process else ""),
+            count / (time.perf_counter() - start), q.noverflow))
+        q.close()
+    print("{:<24} shm segments left: {}".format("queue (closed)", len(_shm_segments() - segments)))
+
+    # the PHY releases the queues it created when it is done, over the socket link (no device needed)
+    cwd = os.getcwd()
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ofdm'))  # preamble files
+    try:
+        phy_tx = OfdmTx('socket', ('127.0.0.1', 45730), queue_type='shm')
+        phy_rx = OfdmRx('socket', ('127.0.0.1', 45730), queue_type='shm')
+    finally:
+        os.chdir(cwd)
+    held = len(_shm_segments() - segments)
+    phy_tx.done()
+    phy_rx.done()
+    print("{:<24} shm segments while running: {}, after done(): {}".format(
+        "PHY (shm)", held, len(_shm_segments() - segments)))
+
+
+BENCHMARKS = {
+    'arq': bench_arq,
+    'codec': bench_codec,
+    'demodulation': bench_demodulation,
+    'detection': bench_detection,
+    'frame': bench_frame,
+    'decoding': bench_decoding,
+    'harq': bench_harq,
+    'ingest': bench_ingest,
+    'modulation': bench_modulation,
+    'payload': bench_payload,
+    'preview': bench_preview,
+    'queue': bench_queue,
+    'resume': bench_resume,
+    'squelch': bench_squelch,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -3,61 +3,288 @@
 # @Time    : 2022/4/26 08:46
 
 
+import io
 import math
+import os
+import struct
+import threading
+from collections import namedtuple
+
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageFile
 
+# image packet header: magic, version, mode, channels, codec, width, height, payload bytes; big endian
+IMAGE_MAGIC = b'PI'
+IMAGE_VERSION = 2
+IMAGE_HEADER_FORMAT = '>2sBBBBIII'
+IMAGE_HEADER_LEN = struct.calcsize(IMAGE_HEADER_FORMAT)
+# pixel layouts carried as they are, other modes are converted to the nearest one
+IMAGE_MODES = ['L', 'LA', 'RGB', 'RGBA']
+# payload codecs: raw pixel bytes row by row, a file of a Pillow format, or raw pixel bytes coarse to fine
+IMAGE_CODECS = ['raw', 'JPEG', 'PNG', 'WEBP', 'BMP', 'GIF', 'TIFF', 'pyramid']
+LOSSY_CODECS = ['JPEG', 'WEBP']
+# the pyramid codec sends the pixels of a 1/PYRAMID_STRIDE grid first, then the finer grids
+PYRAMID_STRIDE = 8
+# held while a payload file is decoded: the previews set the process-global ImageFile.LOAD_TRUNCATED_IMAGES
+_LOAD_LOCK = threading.Lock()
 
-def read_image(img_path):
-    print("Load image from:", img_path)
-    # open the img
-    img = Image.open(img_path)
-    mode = img.mode
-    if mode == 'RGB':
-        greyLevel = 3
-    elif mode == 'L':
-        greyLevel = 1
+ImageHeader = namedtuple('ImageHeader', ['version', 'mode', 'channels', 'codec', 'width', 'height', 'size'])
+
+
+def _packet_mode(img, codec='raw'):
+    """ mode of img in IMAGE_MODES: the base mode, with alpha if img has any and the codec keeps it """
+    if img.mode in IMAGE_MODES:
+        mode = img.mode
     else:
-        greyLevel = 1
-    img_data = np.array(list(img.getdata()), dtype=np.uint8)
-    img_data.shape = len(img_data) * greyLevel, 1
+        alpha = 'A' in img.getbands() or 'transparency' in img.info
+        # grey modes ('1', 'I', 'F', ...) to L, colour ones (palette, CMYK, YCbCr, ...) to RGB
+        mode = ('L' if Image.getmodebase(img.mode) == 'L' else 'RGB') + ('A' if alpha else '')
+    if codec in ('JPEG', 'PJPEG'):
+        # JPEG has no alpha channel
+        mode = mode.rstrip('A')
+    return mode
+
+
+def image_info(img_path):
+    """ header of the raw image packet of a file, from the file header only (no pixel is decoded)
+    :return:                ImageHeader
+    """
+    with Image.open(img_path) as img:
+        mode = _packet_mode(img)
+        width, height = img.size
+    return ImageHeader(IMAGE_VERSION, mode, len(mode), 'raw', width, height, width * height * len(mode))
+
+
+def image_packet_size(img_path, codec='raw', quality=None, max_bytes=None):
+    """ # of bytes of the image packet of a file, for counting frames; without reading the image for the
+    raw packet and the file as it is, the other codecs encode it (see read_image_bytes)
+    """
+    if codec in ('raw', 'pyramid'):
+        return IMAGE_HEADER_LEN + image_info(img_path).size
+    if codec == 'file':
+        with Image.open(img_path) as img:
+            if img.format in IMAGE_CODECS:
+                return IMAGE_HEADER_LEN + os.path.getsize(img_path)
+    return len(read_image_bytes(img_path, codec, quality, max_bytes))
+
+
+def read_image(img_path, codec='raw', quality=None, max_bytes=None):
+    """ bits of the image packet, see read_image_bytes """
+    return np.unpackbits(np.frombuffer(read_image_bytes(img_path, codec, quality, max_bytes), dtype=np.uint8))
+
+
+def read_image_bytes(img_path, codec='raw', quality=None, max_bytes=None):
+    """ image packet: header (see IMAGE_HEADER_FORMAT) followed by the payload
+    :param codec:           'raw': the pixel bytes row by row,
+                            'pyramid': the pixel bytes coarse to fine (see pyramid_order),
+                            'file': the file as it is if its format is in IMAGE_CODECS, else encoded as PNG,
+                            'JPEG', 'WEBP' or 'PNG': the image encoded with Pillow,
+                            'PJPEG': progressive JPEG, its first scans are a coarse image
+                            The progressive payloads ('pyramid', 'PJPEG') give a full-frame preview from
+                            their first bytes, see preview_image.
+    :param quality:         quality of the lossy codecs (1-95), None: the Pillow default
+    :param max_bytes:       payload budget of the lossy codecs, met with the highest quality up to quality
+    :return:                bytearray of the packet
+    """
+    print("Load image from:", img_path)
+    with Image.open(img_path) as img:
+        width, height = img.size
+        if codec == 'file' and img.format in IMAGE_CODECS:
+            mode, codec = _packet_mode(img), img.format
+            with open(img_path, "rb") as fp:
+                payload = fp.read()
+        else:
+            codec = 'PNG' if codec == 'file' else codec
+            mode = _packet_mode(img, codec)
+            if img.mode != mode:
+                img = img.convert(mode)
+            if codec == 'raw':
+                payload = np.asarray(img, dtype=np.uint8).reshape(-1)
+            elif codec == 'pyramid':
+                img_data = np.asarray(img, dtype=np.uint8).reshape(height * width, -1)
+                payload = img_data[pyramid_order(height, width)].reshape(-1)
+            else:
+                payload = encode_image(img, codec, quality, max_bytes)
+                codec = 'JPEG' if codec == 'PJPEG' else codec
+    print("Image info: width:{}, height:{}, mode:{}, codec:{}, size:{}".format(width, height, mode, codec,
+                                                                             len(payload)))
+    pkt = bytearray(IMAGE_HEADER_LEN + len(payload))
+    struct.pack_into(IMAGE_HEADER_FORMAT, pkt, 0, IMAGE_MAGIC, IMAGE_VERSION, IMAGE_MODES.index(mode), len(mode),
+                     IMAGE_CODECS.index(codec), width, height, len(payload))
+    np.frombuffer(pkt, dtype=np.uint8, offset=IMAGE_HEADER_LEN)[:] = np.frombuffer(payload, dtype=np.uint8)
+    return pkt
+
+
+def encode_image(img, codec, quality=None, max_bytes=None):
+    """ bytes of img encoded with Pillow, see read_image_bytes """
+    options = {}
+    if codec == 'PJPEG':
+        codec, options = 'JPEG', {'progressive': True}
+    if codec not in IMAGE_CODECS[1:-1]:
+        raise ValueError("Invalid image codec!")
 
-    width, height = img.size
-    width1 = width // 128
-    width2 = width % 128
-    height1 = height // 128
-    height2 = height % 128
+    def encode(q):
+        buf = io.BytesIO()
+        img.save(buf, codec, **options, **({'quality': q} if q is not None else {}))
+        return buf.getvalue()
 
-    pkt = [width1, width2, height1, height2, greyLevel]  # 1 indicates grey-level
-    print("Image info: width:{}, height:{}, greyLevel:{}".format(width, height, greyLevel))
-    for i in range(len(img_data)):
-        pkt.append(img_data[i][0])
-    return np.unpackbits(np.array(pkt, dtype=np.uint8))
+    if codec not in LOSSY_CODECS:
+        if max_bytes:
+            raise ValueError("A byte budget needs a lossy codec!")
+        return encode(None)
+    if not max_bytes:
+        return encode(quality)
+    # highest quality within the budget, by bisection
+    low, high = 1, quality or 95
+    data = encode(low)
+    while low < high:
+        mid = (low + high + 1) // 2
+        mid_data = encode(mid)
+        if len(mid_data) <= max_bytes:
+            low, data = mid, mid_data
+        else:
+            high = mid - 1
+    if len(data) > max_bytes:
+        print("Image over the byte budget at the lowest quality: {} > {} bytes".format(len(data), max_bytes))
+    return data
+
+
+def pyramid_order(height, width, stride=PYRAMID_STRIDE):
+    """ pixel indices (row-major) in the order of the pyramid codec: the grid of the pixels whose row and
+    column are multiples of stride, then those of stride/2 not sent yet, ... down to every pixel; row by
+    row within a grid
+    """
+    def level(n):
+        # log2 of the largest power of 2 up to stride dividing n (0 is divided by all)
+        n = np.arange(n)
+        return np.log2(np.minimum(np.where(n == 0, stride, n & -n), stride)).astype(np.int8)
+
+    levels = np.minimum.outer(level(height), level(width)).ravel()
+    return np.argsort(-levels, kind='stable')
+
+
+def parse_image_header(data):
+    """ header of an image packet
+    :param data:            bytes-like packet, at least its IMAGE_HEADER_LEN first bytes
+    :return:                ImageHeader
+    """
+    magic, version, mode, channels, codec, width, height, size = struct.unpack_from(IMAGE_HEADER_FORMAT, data)
+    if magic != IMAGE_MAGIC:
+        raise ValueError("Not an image packet!")
+    if version != IMAGE_VERSION or mode >= len(IMAGE_MODES) or channels != len(IMAGE_MODES[mode]) or \
+            codec >= len(IMAGE_CODECS):
+        raise ValueError("Image packet version {} mode {} codec {} not supported!".format(version, mode, codec))
+    return ImageHeader(version, IMAGE_MODES[mode], channels, IMAGE_CODECS[codec], width, height, size)
+
+
+def decode_image(data):
+    """ image of a packet
+    :param data:            bytes-like packet
+    :return:                (ImageHeader, PIL image)
+    """
+    info = parse_image_header(data)
+    payload = np.frombuffer(data, dtype=np.uint8)[IMAGE_HEADER_LEN: IMAGE_HEADER_LEN + info.size]
+    if info.codec in ('raw', 'pyramid'):
+        return preview_image(data, IMAGE_HEADER_LEN + info.size)
+    img = _load_file(payload)
+    if img.mode != info.mode:
+        img = img.convert(info.mode)
+    return info, img
+
+
+def _load_file(payload, truncated=False):
+    """ decoded image of a payload file
+    :param truncated:       decode what can be of a partial file; the flag of Pillow is set only under
+                            _LOAD_LOCK, so a file decoded at the same time in another thread is not affected
+    """
+    with _LOAD_LOCK:
+        loose, ImageFile.LOAD_TRUNCATED_IMAGES = ImageFile.LOAD_TRUNCATED_IMAGES, \
+            ImageFile.LOAD_TRUNCATED_IMAGES or truncated
+        try:
+            img = Image.open(io.BytesIO(payload))
+            img.load()
+        finally:
+            ImageFile.LOAD_TRUNCATED_IMAGES = loose
+    return img
+
+
+def _pixels(img_data, shape):
+    """ image of pixel bytes, shape is (height, width, channels); the mode follows the channel number """
+    return Image.fromarray(img_data.reshape(shape[:3 if shape[2] > 1 else 2]))
+
+
+def preview_image(data, nbytes):
+    """ full-frame image of the first nbytes of a packet: the missing pixels of the raw codec are black,
+    those of the pyramid codec copied from the nearest coarser pixel; the compressed codecs decode what
+    they can of a truncated file (coarse scans of progressive JPEG)
+    :param data:            bytes-like packet, at least its first nbytes
+    :param nbytes:          # of bytes of the packet received
+    :return:                (ImageHeader, PIL image), None before the image header or when nothing of the
+                            payload can be decoded yet
+    """
+    if nbytes < IMAGE_HEADER_LEN:
+        return None
+    info = parse_image_header(data)
+    shape = (info.height, info.width, info.channels)
+    nbytes = min(nbytes - IMAGE_HEADER_LEN, info.size)
+    payload = np.frombuffer(data, dtype=np.uint8)[IMAGE_HEADER_LEN: IMAGE_HEADER_LEN + nbytes]
+    if info.codec == 'raw':
+        img_data = np.zeros(info.size, dtype=np.uint8)
+        img_data[:nbytes] = payload
+        return info, _pixels(img_data, shape)
+    if info.codec == 'pyramid':
+        npix = nbytes // info.channels
+        img_data = np.zeros((info.height * info.width, info.channels), dtype=np.uint8)
+        known = np.zeros(info.height * info.width, dtype=bool)
+        order = pyramid_order(info.height, info.width)
+        img_data[order[:npix]] = payload[:npix * info.channels].reshape(npix, info.channels)
+        known[order[:npix]] = True
+        img_data, known = img_data.reshape(shape), known.reshape(shape[:2])
+        # fill each grid, coarse to fine, from the grid twice as coarse
+        stride = PYRAMID_STRIDE
+        while stride >= 1:
+            rows, cols = np.arange(0, info.height, stride), np.arange(0, info.width, stride)
+            parent = img_data[np.ix_(rows // (2 * stride) * (2 * stride), cols // (2 * stride) * (2 * stride))]
+            grid = np.ix_(rows, cols)
+            img_data[grid] = np.where(known[grid][..., np.newaxis], img_data[grid], parent)
+            known[grid] = True
+            stride //= 2
+        return info, _pixels(img_data, shape)
+    try:
+        img = _load_file(payload, nbytes < info.size)
+    except (OSError, SyntaxError):
+        return None
+    if img.mode != info.mode:
+        img = img.convert(info.mode)
+    return info, img
 
 
 def extract_image_info(pkt):
     print("Extracting image info.")
-    _pkt = np.packbits(pkt)
-    width1, width2, height1, height2, greyLevel = _pkt[0: 5]
-    width = width1 * 128 + width2
-    height = height1 * 128 + height2
-    print("Image info: width:{}, height:{}, greyLevel:{}".format(width, height, greyLevel))
-    return width, height, greyLevel
+    info = parse_image_header(np.packbits(pkt[:8 * IMAGE_HEADER_LEN]).tobytes())
+    print("Image info: width:{}, height:{}, mode:{}, codec:{}".format(info.width, info.height, info.mode,
+                                                                     info.codec))
+    return info.width, info.height, info.channels
 
 
 def save_image(pkt, save_path):
+    """ write the image of a packet to a file
+    :param pkt:             bytes-like packet, e.g. the rx buffer of the LLC layer (bits: np.packbits them)
+    """
     print("Save image to:", save_path)
-    width, height, greyLevel = extract_image_info(pkt)
-    _pkt = np.packbits(pkt)
-    img_data = np.array(_pkt[5: 5 + width * height * greyLevel], dtype=np.uint8)
-    if greyLevel == 3:
-        img_data.shape = height, width, greyLevel
-        img = Image.fromarray(img_data).convert('RGB')
-    elif greyLevel == 1:
-        img_data.shape = height, width
-        img = Image.fromarray(img_data).convert('L')
-    else:
-        raise ValueError("Grey level not supported!")
+    _pkt = np.frombuffer(pkt, dtype=np.uint8)
+    info, img = decode_image(_pkt)
+    print("Image info: width:{}, height:{}, mode:{}, codec:{}".format(info.width, info.height, info.mode,
+                                                                     info.codec))
+    ext = os.path.splitext(save_path)[1].lower()
+    if info.codec != 'raw' and Image.registered_extensions().get(ext) == info.codec:
+        # the received file as it is, not encoded again
+        with open(save_path, "wb") as fp:
+            fp.write(_pkt[IMAGE_HEADER_LEN: IMAGE_HEADER_LEN + info.size].tobytes())
+        return
+    if info.mode.endswith('A') and ext in ('.jpg', '.jpeg'):
+        # JPEG has no alpha channel
+        img = img.convert(info.mode[:-1])
     img.save(save_path)
 
 
@@ -75,4 +302,4 @@ if __name__ == '__main__':
     for n in range(num_frame):
         rx_pkt[n * pkt_size: (n + 1) * pkt_size] = tx_pkt[n * pkt_size: (n + 1) * pkt_size]
     print(num_frame)
-    save_image(rx_pkt, r'images/recv.jpg')
+    save_image(np.packbits(rx_pkt), r'images/recv.jpg')
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+""" LLC-layer frame codec: header, payload and CRC-32 packed as bytes, carried as bits by the PHY layer
+
+A frame is the header, the payload bits and the CRC-32 of both, zero-padded to the PHY packet:
+
+    | seq (16) | length (16) | flags (8) | session (8) | payload (length bits) | CRC-32 (32) | padding |
+
+length is the number of payload bits, so the CRC follows the payload and a short (e.g. last) payload
+needs no filler. ACK frames carry FLAG_ACK, with the bitmap of a block ACK as payload. The last data
+frame of a transfer carries FLAG_LAST, which tells the receiver the frame number. The session id tells
+transfers apart; a receiver resuming an interrupted transfer advertises the frames it holds with a block
+ACK, and the transmitter skips them.
+
+Payloads of whole bytes are framed as bytes (encode_frame_bytes), the PHY layer unpacks them into bits
+at the modulator input.
+"""
+
+import binascii
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+HEADER_FORMAT = '>HHBB'  # seq, length, flags, session id, big endian
+HEADER_LEN = struct.calcsize(HEADER_FORMAT)
+HEADER_BIT_SIZE = 8 * HEADER_LEN
+CRC_BIT_SIZE = 32
+FRAME_OVERHEAD = HEADER_BIT_SIZE + CRC_BIT_SIZE
+SEQ_NUM = 1 << 16  # sequence numbers of the seq field, so the most frames of a transfer
+
+FLAG_ACK = 0x01
+FLAG_BLOCK_ACK = 0x02
+FLAG_LAST = 0x04
+
+FrameHeader = namedtuple('FrameHeader', ['seq', 'length', 'flags', 'session'])
+
+
+def int_to_bits(values, width):
+    """ bits of integers, MSB first
+    :param values:          integer or array of integers
+    :param width:           bits per integer
+    :return:                uint8 array of shape values.shape + (width,)
+    """
+    values = np.asarray(values, dtype=np.int64)
+    return ((values[..., np.newaxis] >> np.arange(width - 1, -1, -1)) & 1).astype(np.uint8)
+
+
+def bits_to_int(bits):
+    """ integers of bits along the last axis, MSB first (up to 63 bits) """
+    bits = np.asarray(bits, dtype=np.int64)
+    return bits @ (1 << np.arange(bits.shape[-1] - 1, -1, -1, dtype=np.int64))
+
+
+def read_header(bits):
+    """ header fields of a frame, not checked against the CRC """
+    return FrameHeader(*struct.unpack(HEADER_FORMAT, np.packbits(bits[:HEADER_BIT_SIZE]).tobytes()))
+
+
+def encode_frame(payload, seq, flags=0, session=0, frame_bit_size=None):
+    """ bits of a frame
+    :param payload:         payload bits
+    :param seq:             sequence number
+    :param flags:           FLAG_* bits
+    :param session:         id of the transfer
+    :param frame_bit_size:  size of the PHY packet the frame is padded to, None: no padding
+    :return:                uint8 array of bits
+    """
+    payload = np.asarray(payload, dtype=np.uint8).ravel()
+    length = payload.size
+    frame_bit_size = frame_bit_size or FRAME_OVERHEAD + length
+    assert FRAME_OVERHEAD + length <= frame_bit_size
+    header = struct.pack(HEADER_FORMAT, seq, length, flags, session)
+    # the header is a whole number of bytes, so the bytes of header + payload are those of the frame bits
+    crc = binascii.crc32(np.packbits(payload).tobytes(), binascii.crc32(header))
+    frame = np.zeros(frame_bit_size, dtype=np.uint8)
+    frame[:HEADER_BIT_SIZE] = np.unpackbits(np.frombuffer(header, dtype=np.uint8))
+    frame[HEADER_BIT_SIZE:HEADER_BIT_SIZE + length] = payload
+    frame[HEADER_BIT_SIZE + length:FRAME_OVERHEAD + length] = int_to_bits(crc, CRC_BIT_SIZE)
+    return frame
+
+
+def encode_frame_bytes(payload, seq, flags=0, session=0, frame_byte_size=None):
+    """ bytes of a frame, the same bits as encode_frame of the payload bits
+    :param payload:         payload bytes (bytes, bytearray or memoryview, not copied before the frame)
+    :param frame_byte_size: size in bytes the frame is padded to, None: no padding
+    :return:                bytearray of the frame
+    """
+    payload = memoryview(payload).cast('B')
+    length = payload.nbytes
+    frame = bytearray(frame_byte_size or FRAME_OVERHEAD // 8 + length)
+    assert FRAME_OVERHEAD // 8 + length <= len(frame)
+    struct.pack_into(HEADER_FORMAT, frame, 0, seq, 8 * length, flags, session)
+    frame[HEADER_LEN:HEADER_LEN + length] = payload
+    crc = binascii.crc32(payload, binascii.crc32(memoryview(frame)[:HEADER_LEN]))
+    struct.pack_into('>I', frame, HEADER_LEN + length, crc)
+    return frame
+
+
+def iter_payloads(payload, pkt_size):
+    """ lazy zero-copy split of a payload into the payloads of successive frames
+    :param payload:         bytes-like payload of the transfer
+    :param pkt_size:        payload bytes of a frame, the last one may be shorter
+    :return:                generator of memoryview slices of payload
+    """
+    payload = memoryview(payload).cast('B')
+    for start in range(0, payload.nbytes, pkt_size):
+        yield payload[start:start + pkt_size]
+
+
+def transfer_session(payload):
+    """ session id (0-255) of a transfer derived from its bytes-like payload: the same when the transfer is
+    sent again, so a receiver keeping the frames of an interrupted transfer finds them by this id
+    """
+    return binascii.crc32(payload) & 0xff
+
+
+def decode_frame(bits):
+    """ header and payload of a received frame
+    :param bits:            bits of the PHY packet
+    :return:                (FrameHeader, payload bits as a view of bits), None if the CRC fails
+    """
+    bits = np.ravel(bits)
+    if bits.size < FRAME_OVERHEAD:
+        return None
+    header = read_header(bits)
+    end = HEADER_BIT_SIZE + header.length
+    if end + CRC_BIT_SIZE > bits.size:
+        return None
+    if binascii.crc32(np.packbits(bits[:end]).tobytes()) != bits_to_int(bits[end:end + CRC_BIT_SIZE]):
+        return None
+    return header, bits[HEADER_BIT_SIZE:end]
+
+
+@lru_cache(maxsize=8)
+def _crc32_tables(num_bytes):
+    """ CRC-32 of messages of up to num_bytes bytes as a sum of per-byte terms
+    The CRC is linear over GF(2) up to the CRC of the zero message of the same size. The linear part has
+    a zero initial register, so leading zero bytes leave it unchanged: for a message m of n bytes aligned
+    to the end of num_bytes bytes, crc(m) = table[p, byte p] ^ ... ^ zero_crcs[n], over its positions p.
+    :return:                table: flat uint32 array of the (num_bytes + 1, 256) terms, the last row zeros
+                            zero_crcs: CRC-32 of 0 to num_bytes zero bytes
+    """
+    zero_crcs = np.zeros(num_bytes + 1, dtype=np.int64)
+    for i in range(num_bytes):
+        zero_crcs[i + 1] = binascii.crc32(b'\0', int(zero_crcs[i]))
+    # term of every bit at every position, from the last position backwards (k zero bytes follow it)
+    terms = np.zeros((num_bytes + 1, 8), dtype=np.int64)
+    for b in range(8):
+        crc = binascii.crc32(bytes([0x80 >> b]))
+        for k in range(num_bytes):
+            terms[num_bytes - 1 - k, b] = crc ^ zero_crcs[k + 1]
+            crc = binascii.crc32(b'\0', crc)
+    values = int_to_bits(np.arange(256), 8).astype(bool)
+    table = np.bitwise_xor.reduce(np.where(values, terms[:, np.newaxis, :], 0), axis=2)
+    return table.astype(np.uint32).ravel(), zero_crcs
+
+
+def crc32_rows(bits, ends):
+    """ CRC-32 of the first ends[i] bits of every row, zero-padded to whole bytes like np.packbits,
+    computed for all the rows at once
+    :param bits:            uint8 array of shape (number, bits)
+    :param ends:            message bits of every row, at most bits.shape[1]
+    :return:                int64 array of the CRCs, equal to binascii.crc32 of the packed messages
+    """
+    ends = np.asarray(ends, dtype=np.int64)
+    num_bytes = -(-ends // 8)
+    data = np.packbits(bits, axis=1)
+    size = data.shape[1]
+    table, zero_crcs = _crc32_tables(size)
+    # the bits past the end of a message in its last byte count as zeros
+    data[np.arange(data.shape[0]), np.maximum(num_bytes - 1, 0)] &= \
+        ((0xff << (8 * num_bytes - ends)) & 0xff).astype(np.uint8)
+    # a message of n bytes is aligned to the end of the table, the bytes past it take the zero row
+    rows = np.minimum(np.arange(size, dtype=np.int32) + (size - num_bytes)[:, np.newaxis].astype(np.int32), size)
+    return np.bitwise_xor.reduce(np.take(table, rows << 8 | data), axis=1) ^ zero_crcs[num_bytes]
+
+
+def encode_frames(payloads, seqs, flags=0, session=0, frame_bit_size=None):
+    """ bits of a batch of frames with payloads of the same size
+    :param payloads:        payload bits, shape (frame number, payload bits)
+    :param seqs:            sequence numbers, one per frame
+    :return:                uint8 array of shape (frame number, frame bits)
+    """
+    payloads = np.asarray(payloads, dtype=np.uint8)
+    num, length = payloads.shape
+    frame_bit_size = frame_bit_size or FRAME_OVERHEAD + length
+    assert FRAME_OVERHEAD + length <= frame_bit_size
+    header = np.zeros(num, dtype=[('seq', '>u2'), ('length', '>u2'), ('flags', 'u1'), ('session', 'u1')])
+    header['seq'], header['length'], header['flags'], header['session'] = seqs, length, flags, session
+    header = header.view(np.uint8).reshape(num, HEADER_LEN)
+    frames = np.zeros((num, frame_bit_size), dtype=np.uint8)
+    frames[:, :HEADER_BIT_SIZE] = np.unpackbits(header, axis=1)
+    frames[:, HEADER_BIT_SIZE:HEADER_BIT_SIZE + length] = payloads
+    crc = crc32_rows(frames, np.full(num, HEADER_BIT_SIZE + length))
+    frames[:, HEADER_BIT_SIZE + length:FRAME_OVERHEAD + length] = int_to_bits(crc, CRC_BIT_SIZE)
+    return frames
+
+
+def check_frames(frames):
+    """ CRC check of a batch of received frames
+    :param frames:          bits of the PHY packets, shape (frame number, packet bits)
+    :return:                bool array, True for the frames whose CRC holds
+    """
+    frames = np.asarray(frames, dtype=np.uint8)
+    num, size = frames.shape
+    if size < FRAME_OVERHEAD:
+        return np.zeros(num, dtype=bool)
+    ends = HEADER_BIT_SIZE + bits_to_int(frames[:, 16:32])  # length field
+    fits = ends + CRC_BIT_SIZE <= size
+    # frames whose length field points beyond the packet fail, their CRC is taken over no bits
+    ends = np.where(fits, ends, 0)
+    crc_pos = ends[:, np.newaxis] + np.arange(CRC_BIT_SIZE)
+    received = bits_to_int(np.take_along_axis(frames, crc_pos, axis=1))
+    return fits & (crc32_rows(frames, ends) == received)
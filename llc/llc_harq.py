@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+""" Soft-combining buffer of the LLC-layer receiver (hybrid ARQ with chase combining)
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class HarqBuffer(object):
+    def __init__(self, capacity, llr_size):
+        """ bounded pool of the LLRs of frames that failed their CRC, keyed by sequence number
+        A retransmission carries the same coded bits, so the LLRs of its copies add up (chase combining)
+        and the sum is decoded instead of the last copy alone. When the pool is full, the entry updated
+        least recently is evicted.
+        :param capacity:        number of frames held
+        :param llr_size:        LLRs of a frame
+        """
+        assert capacity > 0
+        self.capacity = capacity
+        self.llr_size = llr_size
+        self._pool = np.zeros((capacity, llr_size), dtype=np.float32)
+        self._slots = OrderedDict()  # {sequence number: slot}, least recently updated first
+        self._free = list(range(capacity - 1, -1, -1))
+
+        # counters
+        self.nhit = 0        # retransmissions combined with a stored copy
+        self.nmiss = 0       # failed frames without a stored copy
+        self.nrecovered = 0  # combined frames that passed the CRC
+        self.nevict = 0      # entries evicted to make room
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, seq):
+        return seq in self._slots
+
+    def combine(self, seq, llr):
+        """ add the LLRs of a failed frame to the stored copies of seq
+        :param seq:             sequence number of the frame
+        :param llr:             LLRs of the frame
+        :return:                combined LLRs (a view into the pool, valid until the next combine), None
+                                when no copy of seq was held before
+        """
+        llr = np.ravel(llr)
+        slot = self._slots.pop(seq, None)
+        if slot is not None:
+            self.nhit += 1
+            self._slots[seq] = slot
+            self._pool[slot] += llr
+            return self._pool[slot]
+        self.nmiss += 1
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = self._slots.popitem(last=False)[1]
+            self.nevict += 1
+        self._slots[seq] = slot
+        self._pool[slot] = llr
+        return None
+
+    def release(self, seq, recovered=False):
+        """ forget the copies of seq once it is received
+        :param recovered:       the frame passed the CRC after combining
+        """
+        slot = self._slots.pop(seq, None)
+        if slot is not None:
+            self._free.append(slot)
+            if recovered:
+                self.nrecovered += 1
+
+    def clear(self):
+        """ forget every stored copy """
+        self._free.extend(self._slots.values())
+        self._slots.clear()
@@ -15,15 +15,24 @@ sys.path.append('..')
 
 from ofdm.ofdm_tx import OfdmTx
 from ofdm.ofdm_rx import OfdmRx
-from llc.llc_utils import calc_crc32, check_crc32, dec2bin, bin2dec
+from llc.llc_frame import FLAG_ACK, FLAG_BLOCK_ACK, FLAG_LAST, FRAME_OVERHEAD, decode_frame, encode_frame, \
+    SEQ_NUM, encode_frame_bytes, encode_frames, iter_payloads
 
 
 class NodeALLC(threading.Thread):
-    def __init__(self, ofdm_tx, ofdm_rx, packet_bit_size=20 * 48):
+    def __init__(self, ofdm_tx, ofdm_rx, packet_bit_size=20 * 48, window_size=8, timeout=1.0, min_rto=0.02,
+                 max_rto=10.0, session=0):
         """ LLC-layer transmitter side
         :param ofdm_tx:         physical-layer ofdm transmitter instance
         :param ofdm_rx:         physical-layer ofdm receiver instance
         :param packet_bit_size: # of bits within a frame
+        :param window_size:     # of frames sent ahead of the oldest unacknowledged one (selective-repeat-ARQ)
+        :param timeout:         initial retransmission timeout in seconds (stop-and-wait-ARQ, selective-repeat-ARQ),
+                                then derived from the measured round-trip time
+        :param min_rto:         lower bound of the retransmission timeout in seconds
+        :param max_rto:         upper bound of the retransmission timeout in seconds
+        :param session:         session id of the transfer (0-255), ACKs of other sessions are ignored; see
+                                llc.llc_frame.transfer_session for an id a resuming receiver recognizes
         """
         threading.Thread.__init__(self)
 
@@ -38,36 +47,133 @@ class NodeALLC(threading.Thread):
         # LLC-layer tx parameters
         self.ntx = 0
         self.tx_seq_no = 0
+        self.session = session
+        self.nsent = 0          # transmissions, first ones and retransmissions
+        self.nretx = 0
+        self.nfast = 0          # frames sent again before their timer, as gaps of a block ACK
+        self.arq_mode = "stop-and-wait-ARQ"
+
+        # LLC-layer ARQ state, shared with the ACK receiving thread
+        self.window_size = window_size
+        self.send_base = 0      # oldest unacknowledged frame
+        self.acked = np.zeros(0, dtype=bool)
+        self.sent_at = {}       # {unacknowledged frame: time of its last transmission}
+        self.retransmitted = set()  # unacknowledged frames sent more than once, no RTT sample (Karn)
+        self.payloads = None    # generator of the payloads of the frames not sent yet
+        self.npayload = 0       # payloads drawn from the generator
+        self.num_frame = 0      # frames of the transfer, the last one carries FLAG_LAST
+        self.inflight = {}      # {unacknowledged frame: its payload}, kept for the retransmissions
+        self.cond = threading.Condition()
+
+        # LLC-layer retransmission timeout (RFC 6298): smoothed RTT and RTT variation
+        self.rto = timeout
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rttvar = 0
+        self.nrtt = 0           # RTT samples
 
         # LLC-layer rx counters
         self.nrx = 0
         self.nrxok = 0
         self.ack = 0
-        self.rtt = 0
-        self.pkt_loss = 100
-        self.avg_rtt = 0
-        self.tot_rtt = 0
+        self.rtt = 0            # last RTT sample
+        self.pkt_loss = 100     # % of transmissions that are retransmissions
+        self.avg_rtt = 0        # smoothed RTT
+        self.tot_rtt = 0        # sum of the RTT samples
 
         self.keep_running = True
 
     def done(self):
         self.keep_running = False
+        with self.cond:
+            self.cond.notify_all()
 
     def run(self):
         while self.keep_running:
-            self.recv(arq_mode="stop-and-wait-ARQ")
+            self.recv(arq_mode=self.arq_mode)
+
+    def make_frame(self, tx_pkt, pkt_size, seq):
+        """ frame seq of the transfer, see llc.llc_frame; the last payload may be shorter
+
+        The payloads are drawn in order from a generator of slices of tx_pkt, zero-copy views when tx_pkt
+        is bytes-like, and kept until their frame is acknowledged; the frame itself is built on each
+        transmission, so only the frames in flight are ever held.
+        :return:                the frame, None if it was acknowledged meanwhile
+        """
+        pyload = self.payload(tx_pkt, pkt_size, seq)
+        if pyload is None:
+            return None
+        # add header and crc32 for error detection, which is actually done by LLC layer
+        flags = FLAG_LAST if seq == self.num_frame - 1 else 0
+        if isinstance(pyload, memoryview):
+            return encode_frame_bytes(pyload, seq, flags, self.session, self.packet_bit_size // 8)
+        return encode_frame(pyload, seq, flags, self.session, self.packet_bit_size)
+
+    def make_frames(self, tx_pkt, pkt_size, seqs):
+        """ frames seqs of the transfer as make_frame builds them, the full-size frames of a payload of bits
+        in one batch (their CRCs computed together)
+        :return:                list of the frames, None for those acknowledged meanwhile
+        """
+        frames = {}
+        batch = []
+        for seq in seqs:
+            pyload = self.payload(tx_pkt, pkt_size, seq)
+            if isinstance(pyload, np.ndarray) and pyload.size == pkt_size and seq != self.num_frame - 1:
+                batch.append(seq)
+            else:
+                frames[seq] = self.make_frame(tx_pkt, pkt_size, seq)
+        if batch:
+            rows = encode_frames([self.inflight[seq] for seq in batch], batch, 0, self.session,
+                                 self.packet_bit_size)
+            frames.update(zip(batch, rows))
+        return [frames[seq] for seq in seqs]
+
+    def payload(self, tx_pkt, pkt_size, seq):
+        """ payload of frame seq, None if it was acknowledged meanwhile, see make_frame """
+        if self.payloads is None:
+            self.payloads = self.iter_payloads(tx_pkt, pkt_size)
+        while self.npayload <= seq:
+            pyload = next(self.payloads)
+            # the frames skipped were acknowledged before they were sent, held by a resuming receiver
+            if self.npayload == seq:
+                self.inflight[seq] = pyload
+            self.npayload += 1
+        return self.inflight.get(seq)
+
+    @staticmethod
+    def iter_payloads(tx_pkt, pkt_size):
+        """ payloads of the frames in order
+        :param tx_pkt:          payload of the transfer: bytes-like, or an array of bits
+        :param pkt_size:        payload bits of a frame, a multiple of 8 for a bytes-like tx_pkt
+        """
+        if isinstance(tx_pkt, (bytes, bytearray, memoryview)):
+            assert pkt_size % 8 == 0, "bytes payloads are split at byte boundaries"
+            return iter_payloads(tx_pkt, pkt_size // 8)
+        return (tx_pkt[start:start + pkt_size] for start in range(0, len(tx_pkt), pkt_size))
+
+    @staticmethod
+    def num_frames(tx_pkt, pkt_size):
+        """ # of frames of a transfer, see iter_payloads; raises ValueError beyond the sequence numbers of
+        the frame header
+        """
+        size = 8 * memoryview(tx_pkt).nbytes if isinstance(tx_pkt, (bytes, bytearray, memoryview)) else len(tx_pkt)
+        num_frame = -(-size // pkt_size)
+        if num_frame > SEQ_NUM:
+            raise ValueError("transfer of {} frames, the 16-bit sequence number allows {}: use larger frames or a "
+                             "smaller payload".format(num_frame, SEQ_NUM))
+        return num_frame
 
     def send(self, tx_pkt, pkt_size, is_dbl_link=False, arq_mode="null-ARQ", pause=0.1):
+        self.arq_mode = arq_mode
         if arq_mode == "null-ARQ":
             if is_dbl_link:
                 # start thread to receive ACK
                 self.start()
             while self.keep_running:
-                random_bit_size = self.packet_bit_size - self.crc_bit_size
+                random_bit_size = self.packet_bit_size - FRAME_OVERHEAD
                 frame = np.random.randint(low=0, high=2, size=random_bit_size)
-                # add crc32 for error detection, which is actually done by LLC layer
-                crc = calc_crc32(frame)
-                frame = np.concatenate((frame, crc))
+                # add header and crc32 for error detection, which is actually done by LLC layer
+                frame = encode_frame(frame, self.ntx & 0xffff, 0, self.session)
                 self.ofdm_tx.put(frame)
                 self.ntx += 1
                 print("[NodeA] LLCTx: ntx={}".format(self.ntx))
@@ -79,26 +185,143 @@ class NodeALLC(threading.Thread):
             if is_dbl_link:
                 # start thread to receive ACK
                 self.start()
-            while self.keep_running:
-                pyload = tx_pkt[self.ntx * pkt_size: (self.ntx + 1) * pkt_size]
-                # add crc32 for error detection, which is actually done by LLC layer
-                # frame_len=dec2bin(len(frame))
-                frame_num = dec2bin(self.ntx, 16)
-                # frame = np.concatenate((frame_len,frame))
-                frame = np.concatenate((frame_num, pyload))
-                crc = calc_crc32(frame)
-                frame = np.concatenate((frame, crc))
+            num_frame = self.num_frame = self.num_frames(tx_pkt, pkt_size)
+            self.payloads, self.npayload, self.inflight = None, 0, {}
+            while self.keep_running and self.ntx < num_frame:
+                seq = self.ntx
+                frame = self.make_frame(tx_pkt, pkt_size, seq)
                 # np.save("frame.npy", frame)
+                # recorded before the frame can be acknowledged, an ACK never finds it unsent
+                with self.cond:
+                    self.on_sent(seq)
+                    print("[NodeA] LLCTx: ntx={}, nretx={}, rto={:.3f}".format(seq, self.nretx, self.rto))
                 self.ofdm_tx.put(frame)
-                print("[NodeA] LLCTx: ntx={}".format(self.ntx))
-                time.sleep(pause)
+                with self.cond:
+                    # wait for the ACK, or send the frame again with a doubled timeout
+                    if not self.cond.wait_for(lambda: self.ntx != seq or not self.keep_running, self.rto):
+                        self.backoff()
+            print("[NodeA] transfer done: {} frames, nretx={}, {}".format(num_frame, self.nretx, self.format_stats()))
+            self.done()
+
+        elif arq_mode == "selective-repeat-ARQ":
+            # up to window_size frames in flight, each one sent again when its own timer expires; the
+            # ACK thread marks frames acknowledged and slides the window
+            assert is_dbl_link, "selective-repeat-ARQ needs the ACK link"
+            num_frame = self.num_frame = self.num_frames(tx_pkt, pkt_size)
+            self.payloads, self.npayload, self.inflight = None, 0, {}
+            with self.cond:
+                self.send_base = 0
+                self.acked = np.zeros(num_frame, dtype=bool)
+                self.sent_at = {}
+            self.start()
+            while self.keep_running and self.send_base < num_frame:
+                now = time.monotonic()
+                with self.cond:
+                    window = range(self.send_base, min(self.send_base + self.window_size, num_frame))
+                    due = [seq for seq in window
+                           if not self.acked[seq] and now - self.sent_at.get(seq, -np.inf) >= self.rto]
+                    # one backoff per round of timer expiries (not for the gaps of a block ACK)
+                    if any(-np.inf < self.sent_at.get(seq, -np.inf) for seq in due):
+                        self.backoff()
+                # the round is encoded at once
+                for seq, frame in zip(due, self.make_frames(tx_pkt, pkt_size, due)):
+                    if frame is None:
+                        continue
+                    # recorded before the frame can be acknowledged, an ACK never finds it unsent
+                    with self.cond:
+                        if self.acked[seq]:
+                            continue
+                        self.on_sent(seq)
+                    # blocks while the PHY queue is full
+                    self.ofdm_tx.put(frame)
+                    self.ntx += 1
+                    print("[NodeA] LLCTx: seq={}, ntx={}, nretx={}, rto={:.3f}".format(seq, self.ntx, self.nretx,
+                                                                                       self.rto))
+                # sleep until an ACK arrives or the earliest timer expires
+                with self.cond:
+                    expiry = min([sent + self.rto for sent in self.sent_at.values()] or [now + self.rto])
+                    self.cond.wait(max(expiry - time.monotonic(), 0))
+            print("[NodeA] transfer done: {} frames, ntx={}, nretx={}, {}".format(
+                num_frame, self.ntx, self.nretx, self.format_stats()))
+            self.done()
+
+    def on_sent(self, seq):
+        """ record a transmission of frame seq, under self.cond """
+        if seq in self.sent_at:
+            self.nretx += 1
+            self.retransmitted.add(seq)
+        self.sent_at[seq] = time.monotonic()
+        self.nsent += 1
+        self.pkt_loss = 100 * self.nretx / self.nsent
+
+    def on_acked(self, seq):
+        """ forget the transmissions of an acknowledged frame, under self.cond; a frame sent once gives an
+        RTT sample (Karn's rule)
+        :return:                time of the last transmission of the frame
+        """
+        sent = self.sent_at.pop(seq, -np.inf)
+        self.inflight.pop(seq, None)
+        if seq in self.retransmitted:
+            self.retransmitted.discard(seq)
+        elif sent > -np.inf:
+            self.rtt_sample(time.monotonic() - sent)
+        return sent
+
+    def rtt_sample(self, rtt):
+        """ update the smoothed RTT, its variation and the retransmission timeout (RFC 6298) """
+        self.rtt = rtt
+        self.tot_rtt += rtt
+        self.nrtt += 1
+        if self.nrtt == 1:
+            self.avg_rtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.avg_rtt - rtt)
+            self.avg_rtt = 0.875 * self.avg_rtt + 0.125 * rtt
+        self.rto = min(max(self.avg_rtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def backoff(self):
+        """ double the retransmission timeout after a timer expiry, until the next RTT sample """
+        self.rto = min(2 * self.rto, self.max_rto)
+
+    def stats(self):
+        """ live round-trip and retransmission statistics """
+        return {'rtt': self.rtt, 'avg_rtt': self.avg_rtt, 'rttvar': self.rttvar, 'rto': self.rto,
+                'tot_rtt': self.tot_rtt, 'nrtt': self.nrtt, 'nsent': self.nsent, 'nretx': self.nretx,
+                'nfast': self.nfast, 'pkt_loss': self.pkt_loss}
+
+    def format_stats(self):
+        """ the statistics for the log lines """
+        return "rtt={rtt:.3f}, avg_rtt={avg_rtt:.3f}, rttvar={rttvar:.3f}, rto={rto:.3f}, " \
+               "pkt_loss={pkt_loss:.1f}%".format(**self.stats())
+
+    def acknowledge(self, seqs, resend_gaps=False):
+        """ mark frames acknowledged and slide the window (selective-repeat-ARQ), under self.cond
+        :param seqs:            sequence numbers of the acknowledged frames
+        :param resend_gaps:     the frames still unacknowledged that were sent before an acknowledged one
+                                are lost, send them again without waiting for their timers
+        """
+        latest = -np.inf  # last transmission of an acknowledged frame
+        for seq in seqs:
+            if self.send_base <= seq < self.acked.size and not self.acked[seq]:
+                self.acked[seq] = True
+                self.nrxok += 1
+                latest = max(latest, self.on_acked(seq))
+        while self.send_base < self.acked.size and self.acked[self.send_base]:
+            self.send_base += 1
+        if resend_gaps:
+            for seq, sent in self.sent_at.items():
+                if -np.inf < sent < latest:
+                    self.sent_at[seq] = -np.inf
+                    self.nfast += 1
+        self.cond.notify()
 
     def recv(self, arq_mode):
         frame = self.ofdm_rx.get()
         if frame is None:
             return
         if arq_mode == "null-ARQ":
-            if check_crc32(frame.flatten()):
+            if decode_frame(frame) is not None:
                 self.nrxok += 1
                 self.nrx += 1
                 print("[NodeA] LLCRx: pkt=ok, nrxok={}, nrx={}".format(self.nrxok, self.nrx))
@@ -106,16 +329,48 @@ class NodeALLC(threading.Thread):
                 self.nrx += 1
                 print("[NodeA] LLCRX: pkt=false, nrxok={}, nrx={}".format(self.nrxok, self.nrx))
 
+        if arq_mode == "selective-repeat-ARQ":
+            # the ACK carries the sequence number of one received frame; a block ACK the base before which
+            # all frames are received and the bitmap of the frames from the base on
+            self.nrx += 1
+            decoded = decode_frame(frame)
+            if decoded is not None and decoded[0].flags & FLAG_ACK and decoded[0].session == self.session:
+                header, bitmap = decoded
+                with self.cond:
+                    if header.flags & FLAG_BLOCK_ACK:
+                        self.acknowledge(list(range(self.send_base, header.seq)) +
+                                         list(header.seq + np.flatnonzero(bitmap)), resend_gaps=True)
+                    else:
+                        self.acknowledge([header.seq])
+                print("[NodeA] LLCRX: ack={}{}, nrxok={}, send_base={}, nfast={}, {}".format(
+                    header.seq, "+" + ''.join(str(b) for b in bitmap) if bitmap.size else "", self.nrxok,
+                    self.send_base, self.nfast, self.format_stats()))
+            else:
+                print("[NodeA] LLCRX: pkt=false, nrxok={}, nrx={}".format(self.nrxok, self.nrx))
+
         if arq_mode == "stop-and-wait-ARQ":
             # TODO: 实现stop-and-wait-ARQ protocol
             # - 提取frame的其他字段, 处理协议流程; 处理数据
-            frame = frame.flatten()
-            if check_crc32(frame):
-                rxnum = bin2dec(np.array2string(frame[0:16]).translate({ord(i): None for i in '[] '}))
-                if rxnum == self.ntx:
-                    self.nrxok += 1
-                    self.ntx += 1
-                print("[NodeA] LLCRX: pkt=ok, nrxok={}, ntx_next={}".format(self.nrxok, self.ntx))
+            # the ACK carries the sequence number of the frame received; a block ACK the base before which
+            # all frames are received, e.g. those a resuming receiver holds already
+            decoded = decode_frame(frame)
+            if decoded is not None and decoded[0].flags & FLAG_ACK and decoded[0].session == self.session:
+                rxnum = decoded[0].seq
+                with self.cond:
+                    if decoded[0].flags & FLAG_BLOCK_ACK:
+                        if rxnum > self.ntx:
+                            for seq in range(self.ntx, rxnum):
+                                self.on_acked(seq)
+                            self.nrxok += rxnum - self.ntx
+                            self.ntx = rxnum
+                            self.cond.notify()
+                    elif rxnum == self.ntx:
+                        self.on_acked(rxnum)
+                        self.nrxok += 1
+                        self.ntx += 1
+                        self.cond.notify()
+                print("[NodeA] LLCRX: pkt=ok, nrxok={}, ntx_next={}, {}".format(self.nrxok, self.ntx,
+                                                                               self.format_stats()))
             else:
                 self.nrx += 1
                 print("[NodeA] LLCRX: pkt=false, nrxok={}, nrx={}".format(self.nrxok, self.nrx))
@@ -5,8 +5,10 @@
 """ Basic version of double-link LLC-layer receiver
 """
 
+import os
 import sys
 import threading
+import time
 
 import numpy as np
 
@@ -14,15 +16,37 @@ sys.path.append('..')
 
 from ofdm.ofdm_tx import OfdmTx
 from ofdm.ofdm_rx import OfdmRx
-from llc.llc_utils import calc_crc32, check_crc32, simu_pkt_loss_delay, dec2bin, bin2dec
+from llc.llc_frame import FLAG_ACK, FLAG_BLOCK_ACK, FLAG_LAST, FRAME_OVERHEAD, decode_frame, encode_frame, \
+    read_header
+from llc.llc_harq import HarqBuffer
+from llc.llc_reassembly import Reassembly
+from llc.llc_utils import simu_pkt_loss_delay
 
 
 class NodeBLLC(threading.Thread):
-    def __init__(self, ofdm_tx, ofdm_rx, packet_bit_size=20 * 48):
+    def __init__(self, ofdm_tx, ofdm_rx, packet_bit_size=20 * 48, harq_size=0, window_size=8, block_ack=0,
+                 block_ack_interval=0.05, on_frame=None, journal_dir=None):
         """ LLC-layer receiver side
         :param ofdm_tx:         physical-layer ofdm transmitter instance
         :param ofdm_rx:         physical-layer ofdm receiver instance
         :param packet_bit_size: # of bits within a frame
+        :param harq_size:       # of failed frames whose LLRs are kept for chase combining with their
+                                retransmission (stop-and-wait-ARQ, selective-repeat-ARQ), needs an ofdm_rx with soft_output; 0
+                                decodes every copy on its own
+        :param window_size:     # of frames accepted from the oldest one not received on (selective-repeat-ARQ),
+                                the window size of the transmitter
+        :param block_ack:       selective-repeat-ARQ acknowledges with one block ACK (the window as a bitmap)
+                                per block_ack received frames instead of one ACK per frame; 0 disables
+        :param block_ack_interval: longest delay in seconds of a pending block ACK
+        :param on_frame:        called as on_frame(seq, start, end) once frame seq and all the frames before
+                                it are in the rx buffer, frame seq filled its bytes [start, end); from the
+                                thread of recv
+        :param journal_dir:     directory of the rx journals: the frames of a transfer are kept in a
+                                memory-mapped file keyed by its session id. When the receiver, the
+                                transmitter or both are restarted, the first frame of the transfer the
+                                receiver gets reopens the journal and its block ACK tells the transmitter
+                                which frames are held, so only the missing ones are sent; None keeps the
+                                frames in memory only
         """
         threading.Thread.__init__(self)
         # PHY-layer parameters
@@ -35,12 +59,37 @@ class NodeBLLC(threading.Thread):
 
         # LLC-layer tx parameters
         self.ntx = 0
+        self.session = 0        # session id of the transfer, echoed in the ACKs
 
         # LLC-layer rx counters
         self.nrx = 0
         self.nrxok = 0
+        self.ndup = 0
         self.keep_running = True
 
+        # LLC-layer rx buffer of the transfer, frames are written in place at their sequence number; the
+        # part received in order can be previewed while the rest is on its way
+        self.rx = None          # type: Reassembly
+        self.on_frame = on_frame
+        self.journal_dir = journal_dir
+        self.rx_session = None  # session of the transfer whose journal is open
+
+        # LLC-layer selective-repeat-ARQ window
+        self.window_size = window_size
+        self.recv_base = 0      # oldest frame not received yet
+
+        # LLC-layer block ACK
+        self.block_ack = block_ack
+        self.block_ack_interval = block_ack_interval
+        self.nack_pending = 0   # frames received since the last block ACK
+        self.ack_due = 0        # time the pending block ACK is sent at the latest
+
+        # LLC-layer hybrid ARQ
+        self.harq = None
+        if harq_size:
+            assert self.ofdm_rx.soft_output, "chase combining needs the LLRs of the receiver"
+            self.harq = HarqBuffer(harq_size, self.ofdm_rx.nbits)
+
     def done(self):
         self.keep_running = False
 
@@ -49,9 +98,23 @@ class NodeBLLC(threading.Thread):
     #         self.ack(phy_type="pluto",arq_mode="stop-and-wait-ARQ")
 
     def recv(self, pkt_size, num_frame, phy_type="pluto", is_dbl_link=True, arq_mode="null-ARQ"):
-        rx_pkt = [0] * num_frame * pkt_size
+        """ receive a transfer
+        :param pkt_size:        payload bits of a frame, a multiple of 8
+        :param num_frame:       # of frames expected, to preallocate the rx buffer; the frame flagged last
+                                ends the transfer
+        :return:                payload bytes of the transfer (uint8 array)
+        """
+        self.rx = Reassembly(pkt_size, num_frame)
+        self.rx_session = None
+        self.recv_base = 0
+        self.nack_pending = 0
+        block_ack = arq_mode == "selective-repeat-ARQ" and is_dbl_link and self.block_ack
         while self.keep_running:
-            frame = self.ofdm_rx.get()
+            if block_ack:
+                self.flush_block_ack(phy_type)
+                frame = self.ofdm_rx.get(timeout=self.block_ack_interval)
+            else:
+                frame = self.ofdm_rx.get()
             if frame is None:
                 # print("frame none")
                 continue
@@ -64,7 +127,7 @@ class NodeBLLC(threading.Thread):
                     continue
 
             if arq_mode == "null-ARQ":
-                if check_crc32(frame):
+                if decode_frame(frame) is not None:
                     self.nrxok += 1
                     self.nrx += 1
                     print("[NodeB] LLCRx: pkt=ok, nrxok={}, nrx={}".format(self.nrxok, self.nrx))
@@ -81,28 +144,149 @@ class NodeBLLC(threading.Thread):
                 # - 提取并处理frame的数据;
                 # np.save('jietiao.npy',frame)
                 frame = frame.flatten()
-                if check_crc32(frame):
-                    num_frame = 33
-                    self.nrx = bin2dec(np.array2string(frame[0:16]).translate({ord(i): None for i in '[] '}))
-                    # frame_len = bin2dec(np.array2string(frame[32:64]).translate({ord(i):None for i in '[] '}))
-                    pyload = frame[16:16 + pkt_size]
-                    rx_pkt[self.nrx * pkt_size: (self.nrx + 1) * pkt_size] = pyload
-                    self.nrxok += 1
-                    print("[NodeB] LLCRx: pkt=ok, nrxok={}, nrx={}".format(self.nrxok, self.nrx))
-                    self.nrx += 1
+                if self.harq is not None:
+                    # the transmitter repeats the frame after the last one acknowledged
+                    frame = self.harq_decode(frame, self.nrx)
+                decoded = decode_frame(frame)
+                ack_mode = arq_mode
+                if decoded is not None:
+                    header, pyload = decoded
+                    self.session = header.session
+                    if self.journal_dir is not None and header.session != self.rx_session:
+                        self.open_journal(header, pyload, phy_type, is_dbl_link)
+                    if self.rx.add(header.seq, pyload, header.flags & FLAG_LAST):
+                        self.nrxok += 1
+                        self.deliver()
+                    else:
+                        # the ACK of an earlier copy was lost, or the transmitter restarted while the
+                        # receiver held its frames: a block ACK of all the frames received in order
+                        self.ndup += 1
+                        ack_mode = "block-ACK"
+                    # frames received in order, the next one is the first missing
+                    self.nrx = self.rx.nprefix
+                    print("[NodeB] LLCRx: pkt=ok, nrxok={}, ndup={}, nrx={}".format(self.nrxok, self.ndup,
+                                                                                   self.nrx))
                 else:
-                    self.nrxok += 1
                     print("[NodeB] LLCRx: pkt=false, nrxok={}, nrx={}".format(self.nrxok, self.nrx))
-                if self.nrx >= num_frame - 1:
+                # acknowledge the last frame received in order (a cumulative ACK), none before the first one
+                if is_dbl_link and self.nrx:
+                    self.ack(phy_type, ack_mode)
+                if self.rx.complete():
                     print("saving...")
-                    # np.save('rx_pkt.npy', rx_pkt)
-                    # save_image(rx_pkt, r'recv.jpg')
-                    return rx_pkt
-                if is_dbl_link:
-                    self.ack(phy_type, arq_mode)
+                    return self.rx.data()
                 # np.save('frame.npy',frame)
 
-    def ack(self, phy_type="pluto", arq_mode="null-ARQ"):
+            if arq_mode == "selective-repeat-ARQ":
+                frame = frame.flatten()
+                if self.harq is not None:
+                    frame = self.harq_decode(frame)
+                self.nrx += 1
+                decoded = decode_frame(frame)
+                if decoded is None:
+                    print("[NodeB] LLCRx: pkt=false, nrxok={}, nrx={}".format(self.nrxok, self.nrx))
+                    continue
+                header, pyload = decoded
+                seq = header.seq
+                self.session = header.session
+                if self.journal_dir is not None and header.session != self.rx_session:
+                    self.open_journal(header, pyload, phy_type, is_dbl_link)
+                if seq >= self.recv_base + self.window_size or (self.rx.last is not None and seq > self.rx.last):
+                    # beyond the window, not sent by a transmitter with the same window
+                    print("[NodeB] LLCRx: seq={} out of window, recv_base={}".format(seq, self.recv_base))
+                    continue
+                if self.rx.add(seq, pyload, header.flags & FLAG_LAST):
+                    self.nrxok += 1
+                    self.deliver()
+                else:
+                    # the ACK of an earlier copy was lost, acknowledge it again
+                    self.ndup += 1
+                print("[NodeB] LLCRx: seq={}, nrxok={}, ndup={}, recv_base={}".format(
+                    seq, self.nrxok, self.ndup, self.recv_base))
+                if block_ack:
+                    if not self.nack_pending:
+                        self.ack_due = time.monotonic() + self.block_ack_interval
+                    self.nack_pending += 1
+                    # the last block ACK of the transfer leaves at once
+                    self.flush_block_ack(phy_type, force=self.rx.complete())
+                elif is_dbl_link:
+                    self.ack(phy_type, arq_mode, seq)
+                if self.rx.complete():
+                    return self.rx.data()
+
+    def open_journal(self, header, pyload, phy_type="pluto", is_dbl_link=True):
+        """ move the rx buffer to the journal of the transfer once its first frame is received, whatever
+        its sequence number: the frames held by the journal are delivered at once and advertised to the
+        transmitter by a block ACK, so only the missing ones are sent. A journal holding another payload
+        for this frame, or ending before it, is of another transfer with the same session id and is cleared.
+        :param header:          header of the first frame received
+        :param pyload:          payload bits of the first frame received
+        """
+        self.rx_session, self.recv_base = header.session, 0
+        path = os.path.join(self.journal_dir, "transfer-{:02x}".format(header.session))
+        self.rx = Reassembly(8 * self.rx.pkt_bytes, self.rx.num_frame, path)
+        if header.seq in self.rx and not self.rx.matches(header.seq, pyload) or \
+                self.rx.last is not None and (header.seq > self.rx.last or
+                                              header.flags & FLAG_LAST and header.seq != self.rx.last):
+            self.rx.reset()
+        held = len(self.rx)
+        if not held:
+            return
+        print("[NodeB] resume: session={}, {} frames held, recv_base={}".format(
+            header.session, held, self.rx.nprefix))
+        self.nrxok += held
+        self.deliver()
+        if is_dbl_link:
+            self.ack(phy_type, "block-ACK")
+
+    def deliver(self):
+        """ slide the window over the frames now received in order, and report them to on_frame """
+        while self.recv_base < self.rx.nprefix:
+            if self.on_frame is not None:
+                start = self.recv_base * self.rx.pkt_bytes
+                self.on_frame(self.recv_base, start, min(start + self.rx.pkt_bytes, self.rx.size))
+            self.recv_base += 1
+
+    def flush_block_ack(self, phy_type="pluto", force=False):
+        """ send the pending block ACK once block_ack frames are received since the last one, or its
+        timer has expired
+        """
+        if self.nack_pending and (force or self.nack_pending >= self.block_ack or
+                                  time.monotonic() >= self.ack_due):
+            self.nack_pending = 0
+            self.ack(phy_type, "block-ACK")
+
+    def harq_decode(self, llr, expected=None):
+        """ bits of a received frame; when its CRC fails, the frame is combined with the stored copies
+        of its sequence number and the sum is decoded
+        The header of a failed frame may be corrupted: with expected, the copy is keyed by it instead;
+        otherwise it is kept only if the sequence number read is missing from the receive window.
+        :param llr:             LLRs of the frame from the PHY layer
+        :param expected:        sequence number the transmitter is repeating (stop-and-wait), None: read
+                                from the header (selective-repeat)
+        :return:                bits of the frame
+        """
+        frame = self.ofdm_rx.decode(llr).flatten()
+        seq = read_header(frame).seq
+        if decode_frame(frame) is not None:
+            self.harq.release(seq)
+            return frame
+        if expected is not None:
+            seq = expected
+        elif not self.recv_base <= seq < self.recv_base + self.window_size or seq in self.rx or \
+                (self.rx.last is not None and seq > self.rx.last):
+            # no frame the transmitter may be repeating, the copy cannot be keyed
+            return frame
+        combined = self.harq.combine(seq, llr)
+        if combined is not None:
+            frame = self.ofdm_rx.decode(combined).flatten()
+            if decode_frame(frame) is not None:
+                self.harq.release(seq, recovered=True)
+            print("[NodeB] HARQ: seq={}, pkt={}, nhit={}, nmiss={}, nrecovered={}, nevict={}".format(
+                seq, "ok" if seq not in self.harq else "false", self.harq.nhit, self.harq.nmiss,
+                self.harq.nrecovered, self.harq.nevict))
+        return frame
+
+    def ack(self, phy_type="pluto", arq_mode="null-ARQ", seq=None):
         if phy_type == "socket":
             # packet loss and delay emulator
             is_not_dropped = simu_pkt_loss_delay()
@@ -111,24 +295,30 @@ class NodeBLLC(threading.Thread):
                 return
 
         if arq_mode == "null-ARQ":
-            random_bit_size = self.packet_bit_size - 32
+            random_bit_size = self.packet_bit_size - FRAME_OVERHEAD
             frame = np.random.randint(low=0, high=2, size=random_bit_size)
-            # add crc32 for error detection, which is actually done by LLC layer
-            crc = calc_crc32(frame)
-            frame = np.concatenate((frame, crc))
+            # add header and crc32 for error detection, which is actually done by LLC layer
+            frame = encode_frame(frame, self.ntx & 0xffff, 0, self.session)
             self.ofdm_tx.put(frame)
 
             self.ntx += 1
             print("[NodeB] LLCTx: ntx={}".format(self.ntx))
-        elif arq_mode == "stop-and-wait-ARQ":
+        elif arq_mode in ["stop-and-wait-ARQ", "selective-repeat-ARQ"]:
             # TODO: 实现stop-and-wait-ARQ protocol
             # - 生成ack frame
-            self.ntx = self.nrx - 1
-            frame = dec2bin(self.ntx, 16)
-            # frame = np.pad(frame,(0,4752),'constant')
-            crc = calc_crc32(frame)
-            frame = np.concatenate((frame, crc))
+            # stop-and-wait acknowledges the last frame received in order, selective-repeat the received frame seq
+            self.ntx = self.nrx - 1 if seq is None else seq
+            # fill the PHY packet, whose size depends on the QAM order
+            frame = encode_frame([], self.ntx, FLAG_ACK, self.session, self.ofdm_tx.packet_bit_size)
             # np.save('ack.npy',frame)
-            # add crc32 for error detection, which is actually done by LLC layer
             self.ofdm_tx.put(frame)
             print("[NodeB] LLCTx: ntx={}".format(self.ntx))
+        elif arq_mode == "block-ACK":
+            # base sequence number and bitmap of the frames held from the base on; the frames before the
+            # base are all received
+            bitmap = self.rx.bitmap(self.recv_base, self.window_size)
+            frame = encode_frame(bitmap, self.recv_base, FLAG_ACK | FLAG_BLOCK_ACK, self.session,
+                                 self.ofdm_tx.packet_bit_size)
+            self.ofdm_tx.put(frame)
+            print("[NodeB] LLCTx: block ACK base={}, bitmap={}".format(self.recv_base,
+                                                                      ''.join(str(b) for b in bitmap)))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+""" Reassembly buffer of the LLC-layer receiver, optionally journaled to disk
+"""
+
+import os
+
+import numpy as np
+
+# journal: path + '.part' holds the payload, path + '.bitmap' this header and the received bitset (np.packbits
+# order, one bit per frame)
+JOURNAL_MAGIC = b'RJ02'
+JOURNAL_HEADER = np.dtype([('magic', 'S4'), ('pkt_bytes', '>u4'), ('last', '>i4'), ('size', '>u4')])
+
+
+class Reassembly(object):
+    def __init__(self, pkt_size, num_frame=0, path=None):
+        """ payload of a transfer, each frame written in place at its sequence number
+        The payload bytes go into a preallocated buffer; a bitset of the received sequence numbers (one
+        bit per frame, packed like np.packbits) tells duplicates in O(1) before anything is copied. The
+        frame flagged last gives the frame number of the transfer, the buffer grows if it is larger than
+        expected.
+        With a journal path, the buffer and the bitset are memory-mapped files: the frames received
+        before the receiver was stopped are found there again, and only the others are still needed.
+        :param pkt_size:        payload bits of a frame, a multiple of 8
+        :param num_frame:       # of frames expected, the buffer is preallocated for them; 0: unknown
+        :param path:            journal path without suffix, None keeps the transfer in memory only
+        """
+        assert pkt_size % 8 == 0, "payloads are reassembled as bytes"
+        self.pkt_bytes = pkt_size // 8
+        self.num_frame = num_frame
+        self.path = path
+        self.last = None        # sequence number of the last frame, once received
+        self.size = 0           # bytes of the payload, up to the end of the furthest frame
+        self.meta = None        # journal header
+        if path is None:
+            self.capacity = -(-num_frame // 8) * 8  # frames the buffer holds, whole bytes of the bitset
+            self.buffer = np.zeros(self.capacity * self.pkt_bytes, dtype=np.uint8)
+            self.received = np.zeros(self.capacity // 8, dtype=np.uint8)
+        else:
+            self._open(num_frame)
+        self.nreceived = int(np.count_nonzero(np.unpackbits(self.received)))
+        self.nprefix = 0        # frames received in order from the first one
+        self._advance()
+
+    def __len__(self):
+        return self.nreceived
+
+    def __contains__(self, seq):
+        return seq < self.capacity and bool(self.received[seq >> 3] & 0x80 >> (seq & 7))
+
+    def add(self, seq, payload, last=False):
+        """ write the payload of frame seq
+        :param payload:         payload bits
+        :param last:            the frame is the last one of the transfer
+        :return:                False if seq was received already (nothing is written)
+        """
+        if seq in self:
+            return False
+        if last:
+            self.last = seq
+            self.num_frame = seq + 1
+        if seq >= self.capacity:
+            self._grow(max(seq + 1, 2 * self.capacity))
+        data = np.packbits(payload)
+        start = seq * self.pkt_bytes
+        self.buffer[start: start + data.size] = data
+        self.size = max(self.size, start + data.size)
+        if self.meta is not None:
+            self.meta['last'], self.meta['size'] = -1 if self.last is None else self.last, self.size
+        # flagged after its payload is written: a journaled frame is held only once complete
+        self.received[seq >> 3] |= 0x80 >> (seq & 7)
+        self.nreceived += 1
+        self._advance()
+        return True
+
+    def matches(self, seq, payload):
+        """ frame seq is held with the same payload bits """
+        data = np.packbits(payload)
+        start = seq * self.pkt_bytes
+        return seq in self and np.array_equal(self.buffer[start: start + data.size], data)
+
+    def _advance(self):
+        while self.nprefix in self:
+            self.nprefix += 1
+            # whole bytes of the bitset at a time once the prefix is byte-aligned
+            while not self.nprefix & 7 and self.nprefix < self.capacity and self.received[self.nprefix >> 3] == 0xff:
+                self.nprefix += 8
+
+    def _grow(self, num_frame):
+        num_frame = -(-num_frame // 8) * 8
+        if self.path is not None:
+            self._map(num_frame)
+            return
+        self.buffer = np.concatenate((self.buffer, np.zeros((num_frame - self.capacity) * self.pkt_bytes,
+                                                            dtype=np.uint8)))
+        self.received = np.concatenate((self.received, np.zeros((num_frame - self.capacity) // 8, dtype=np.uint8)))
+        self.capacity = num_frame
+
+    def _open(self, num_frame):
+        """ map the journal, the one of an interrupted run if it has the same frame size """
+        header = None
+        if os.path.exists(self.path + '.part') and os.path.exists(self.path + '.bitmap'):
+            header = np.fromfile(self.path + '.bitmap', dtype=JOURNAL_HEADER, count=1)
+        if header is None or header.size == 0 or header[0]['magic'] != JOURNAL_MAGIC or \
+                header[0]['pkt_bytes'] != self.pkt_bytes:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._map(num_frame, reset=True)
+            self.meta['magic'], self.meta['pkt_bytes'], self.meta['last'], self.meta['size'] = \
+                JOURNAL_MAGIC, self.pkt_bytes, -1, 0
+            return
+        self._map(num_frame)
+        if self.meta['last'] >= 0:
+            self.last = int(self.meta['last'])
+            self.num_frame = self.last + 1
+        self.size = int(self.meta['size'])
+
+    def _map(self, num_frame, reset=False):
+        """ map the journal files, grown to hold num_frame frames at least """
+        num_frame = -(-max(num_frame, 1) // 8) * 8
+        for suffix, size in [('.part', num_frame * self.pkt_bytes),
+                             ('.bitmap', JOURNAL_HEADER.itemsize + num_frame // 8)]:
+            with open(self.path + suffix, 'w+b' if reset else 'r+b') as fp:
+                if reset or os.path.getsize(self.path + suffix) < size:
+                    fp.truncate(size)
+        bitmap = np.memmap(self.path + '.bitmap', dtype=np.uint8, mode='r+')
+        part = np.memmap(self.path + '.part', dtype=np.uint8, mode='r+')
+        self.meta = bitmap[:JOURNAL_HEADER.itemsize].view(JOURNAL_HEADER)[0]
+        self.capacity = min(8 * (bitmap.size - JOURNAL_HEADER.itemsize), part.size // self.pkt_bytes) // 8 * 8
+        self.received = bitmap[JOURNAL_HEADER.itemsize:JOURNAL_HEADER.itemsize + self.capacity // 8]
+        self.buffer = part[:self.capacity * self.pkt_bytes]
+
+    def reset(self):
+        """ forget every frame, e.g. those of another transfer found in the journal """
+        self.received[:] = 0
+        self.last, self.size, self.nreceived, self.nprefix = None, 0, 0, 0
+        if self.meta is not None:
+            self.meta['last'], self.meta['size'] = -1, 0
+
+    def discard(self):
+        """ remove the journal once the transfer is delivered; the buffer stays readable """
+        if self.path is not None:
+            for suffix in ['.part', '.bitmap']:
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+            self.path, self.meta = None, None
+
+    def complete(self):
+        """ every frame up to the last one is received """
+        return self.last is not None and self.nprefix > self.last
+
+    def bitmap(self, base, size):
+        """ received flags of the frames base to base + size - 1, uint8 """
+        bitmap = np.zeros(size, dtype=np.uint8)
+        first = base >> 3
+        held = np.unpackbits(self.received[first: -(-(base + size) // 8)])[base - 8 * first: base - 8 * first + size]
+        bitmap[:held.size] = held
+        return bitmap
+
+    def seqs(self):
+        """ sequence numbers of the frames received, in order """
+        return np.flatnonzero(np.unpackbits(self.received))
+
+    def prefix_size(self):
+        """ # of payload bytes received in order from the start """
+        return min(self.nprefix * self.pkt_bytes, self.size)
+
+    def data(self):
+        """ payload bytes received so far, a view of the buffer """
+        return self.buffer[:self.size]
@@ -13,12 +13,12 @@ NSEQ = 1 << SEQ_LEN
 
 
 def calc_crc32(msg_bin):
-    return dec2bin(binascii.crc32(bytes(np.packbits(msg_bin))))
+    return dec2bin(binascii.crc32(np.packbits(msg_bin).tobytes()))
 
 def check_crc32(msg_bin):
     if len(msg_bin) <= 32:
         return False
-    return (msg_bin[-32:] == np.array(dec2bin(binascii.crc32(bytes(np.packbits(msg_bin[:-32])))), dtype=np.uint8)).all()
+    return binascii.crc32(np.packbits(msg_bin[:-32]).tobytes()) == bin2dec(msg_bin[-32:])
 
 def dec2bin(num_dec, size=32):
     """ converts a decimal number to a binary numpy array
@@ -26,12 +26,7 @@ def dec2bin(num_dec, size=32):
     :param size:        derived bit length
     :return:                binary array
     """
-    bin_arr = np.array([], dtype=int)
-    for _ in range(0, size):
-        temp = num_dec & 0x1
-        num_dec >>= 1
-        bin_arr = np.append(bin_arr, temp)
-    return bin_arr[::-1]
+    return (num_dec >> np.arange(size - 1, -1, -1, dtype=np.int64)) & 1
 
 def bin2dec(bin_arr, type='left-msb'):
     """ convert a binary array to a decimal number
@@ -39,10 +34,13 @@ def bin2dec(bin_arr, type='left-msb'):
     :param type:            'left-msb' or 'right-msb'
     :return:                decimal int number
     """
+    if isinstance(bin_arr, str):
+        bin_arr = [int(x) for x in bin_arr]
+    bin_arr = np.asarray(bin_arr, dtype=np.int64)
     if type == 'left-msb':
-        return int(''.join(str(x) for x in bin_arr), 2)
+        return int(bin_arr @ (1 << np.arange(bin_arr.size - 1, -1, -1, dtype=np.int64)))
     elif type == 'right-msb':
-        return int(''.join(str(x) for x in bin_arr[::-1]), 2)
+        return int(bin_arr @ (1 << np.arange(bin_arr.size, dtype=np.int64)))
     else:
         raise TypeError('Invalid type of MSB!')
 
@@ -1,12 +1,21 @@
 import math
 import os
+import time
 
+import numpy as np
 from PIL import Image
 from PySide6 import QtWidgets, QtGui, QtCore
 
 from UI import Ui_MainWindow
-from img_operate import read_image
-from threads import TransmitThread, ReceiveThread
+from img_operate import IMAGE_HEADER_LEN, image_packet_size, parse_image_header
+from llc.llc_frame import SEQ_NUM
+from threads import TransmitThread, ReceiveThread, PKT_SIZE, IMAGE_CODEC, IMAGE_QUALITY, IMAGE_MAX_BYTES
+
+RX_MISSING_COLOR = QtGui.QColor(64, 64, 64)  # pixels of the received image not received yet
+RX_PREVIEW_INTERVAL = 0.2  # seconds between two previews of the payloads that are not raw pixels
+# QImage layout of the image modes; LA is shown as RGBA
+RX_IMAGE_FORMATS = {'L': QtGui.QImage.Format_Grayscale8, 'LA': QtGui.QImage.Format_RGBA8888,
+                    'RGB': QtGui.QImage.Format_RGB888, 'RGBA': QtGui.QImage.Format_RGBA8888}
 
 
 class Window(QtWidgets.QMainWindow, Ui_MainWindow):
@@ -15,7 +24,6 @@ class Window(QtWidgets.QMainWindow, Ui_MainWindow):
         self.setupUi(self)
         self.TxImagePath = None
         self.RxImagePath = os.path.join(os.getcwd(), "recv.jpg")
-        self.TxDataToSend = None
         self.ButtonSendPicSelect.clicked.connect(self.TxSelectFile)
         self.ButtonSendStart.clicked.connect(self.TxStart)
         self.ButtonReceiveStart.clicked.connect(self.RxStart)
@@ -23,6 +31,14 @@ class Window(QtWidgets.QMainWindow, Ui_MainWindow):
         self.TxThread: QtCore.QThread | None = None
         self.RxThread: QtCore.QThread | None = None
 
+        # image being received, updated in place frame by frame
+        self.RxSource: ReceiveThread | None = None
+        self.RxInfo = None
+        self.RxImage: QtGui.QImage | None = None
+        self.RxFrames = 0
+        self.RxPreviewDue = False
+        self.RxPreviewTime = 0
+
         self.Timer = QtCore.QTimer()
         self.Timer.start()
         self.Timer.timeout.connect(self.Update)
@@ -32,24 +48,27 @@ class Window(QtWidgets.QMainWindow, Ui_MainWindow):
             self, "打开文件", os.getcwd(),
             "图片文件(*.png *.jpg *.bmp *.jpeg);;all files(*.*)")
         if filename[0]:
-            self.TxImagePath = filename[0]
-            self.LESendPicPath.setText(self.TxImagePath)
-            with open(self.TxImagePath, "rb") as fp:
+            img_path = filename[0]
+            self.TxImagePath = img_path
+            self.LESendPicPath.setText(img_path)
+            with open(img_path, "rb") as fp:
                 img = Image.open(fp)
                 self.LabelSendPicSize.setText(f"{img.size[0]}x{img.size[1]}")
-                pkt_size = 100 * 48 - 16 - 32
-                num_frame = math.ceil(len(list(read_image(self.TxImagePath))) / pkt_size)
+                num_frame = math.ceil(8 * image_packet_size(img_path, IMAGE_CODEC, IMAGE_QUALITY,
+                                                            IMAGE_MAX_BYTES) / PKT_SIZE)
                 self.LabelSendDataLength.setText(str(num_frame))
-                self.TxDataToSend = fp.read()
+                if num_frame > SEQ_NUM:
+                    # more frames than sequence numbers in the frame header, the image is shown but cannot be sent
+                    self.LabelSendDataLength.setText("{} > {}".format(num_frame, SEQ_NUM))
+                    self.TxImagePath = None
                 if img.size[0] > img.size[1]:
                     self.LabelSendImage.setPixmap(
-                        QtGui.QPixmap(self.TxImagePath).scaledToWidth(self.LabelSendImage.width()))
+                        QtGui.QPixmap(img_path).scaledToWidth(self.LabelSendImage.width()))
                 else:
                     self.LabelSendImage.setPixmap(
-                        QtGui.QPixmap(self.TxImagePath).scaledToHeight(self.LabelSendImage.height()))
+                        QtGui.QPixmap(img_path).scaledToHeight(self.LabelSendImage.height()))
         else:
             self.TxImagePath = None
-            self.TxDataToSend = None
             self.LabelSendImage.clear()
             self.LabelSendPicSize.clear()
             self.LabelSendDataLength.clear()
@@ -69,11 +88,70 @@ class Window(QtWidgets.QMainWindow, Ui_MainWindow):
         try:
             self.RxThread = ReceiveThread(self.RxImagePath, self.LEReceivePlutoIp.text(),
                                           self.SpinReceiveFrameCount.value())
+            self.RxSource, self.RxInfo, self.RxImage, self.RxFrames = self.RxThread, None, None, 0
+            self.RxThread.frameReceived.connect(self.RxFrame)
+            self.LabelReceiveImage.clear()
+            self.LabelReceiveDataLength.setText(f"0/{self.RxThread.frameCount}")
             self.RxThread.start()
         except Exception as e:
             self.RxThread = None
             raise e
 
+    def RxFrame(self, seq, start, end):
+        """ a frame filled the bytes [start, end) of the image packet: copy the rows it changed into the
+        received image, or schedule a preview for the payloads that are not raw pixels
+        """
+        self.RxFrames += 1
+        self.LabelReceiveDataLength.setText(f"{self.RxFrames}/{self.RxSource.frameCount}")
+        if self.RxInfo is None:
+            if self.RxSource.llc.rx.prefix_size() < IMAGE_HEADER_LEN:
+                return
+            info = self.RxInfo = parse_image_header(self.RxSource.received(0, IMAGE_HEADER_LEN))
+            self.RxImage = QtGui.QImage(info.width, info.height, RX_IMAGE_FORMATS[info.mode])
+            self.RxImage.fill(RX_MISSING_COLOR)
+            self.LabelReceivePicSize.setText(f"{info.width}x{info.height}")
+            # everything received before the header could be read
+            start = IMAGE_HEADER_LEN
+        if self.RxInfo.codec != 'raw':
+            self.RxPreviewDue = True
+            return
+        row_size = self.RxInfo.width * self.RxInfo.channels
+        first = max(start - IMAGE_HEADER_LEN, 0) // row_size
+        last = min(-(-(end - IMAGE_HEADER_LEN) // row_size), self.RxInfo.height)
+        if first < last:
+            # the end of the last row may still be missing
+            rows = np.full((last - first) * row_size, RX_MISSING_COLOR.red(), dtype=np.uint8)
+            data = self.RxSource.received(IMAGE_HEADER_LEN + first * row_size,
+                                          min(end, IMAGE_HEADER_LEN + last * row_size))
+            rows[:data.size] = data
+            self.RxSetRows(first, rows.reshape(last - first, self.RxInfo.width, self.RxInfo.channels))
+        self.RxShow()
+
+    def RxSetRows(self, first, pixels):
+        """ write pixels (rows, width, channels) into the received image from row first on """
+        if self.RxInfo.mode == 'LA':
+            pixels = pixels[..., [0, 0, 0, 1]]
+        lines = np.frombuffer(self.RxImage.bits(), dtype=np.uint8).reshape(self.RxImage.height(), -1)
+        lines[first: first + pixels.shape[0], :pixels[0].size] = pixels.reshape(pixels.shape[0], -1)
+
+    def RxPreview(self):
+        """ decode the payload received so far into the received image """
+        self.RxPreviewDue, self.RxPreviewTime = False, time.monotonic()
+        preview = self.RxSource.preview()
+        if preview is None:
+            return
+        info, img = preview
+        pixels = np.asarray(img, dtype=np.uint8).reshape(info.height, info.width, info.channels)
+        self.RxSetRows(0, pixels)
+        self.RxShow()
+
+    def RxShow(self):
+        pixmap = QtGui.QPixmap.fromImage(self.RxImage)
+        if self.RxImage.width() > self.RxImage.height():
+            self.LabelReceiveImage.setPixmap(pixmap.scaledToWidth(self.LabelReceiveImage.width()))
+        else:
+            self.LabelReceiveImage.setPixmap(pixmap.scaledToHeight(self.LabelReceiveImage.height()))
+
     def Update(self):
         if self.TxThread:
             if self.TxThread.isFinished():
@@ -89,21 +167,13 @@ class Window(QtWidgets.QMainWindow, Ui_MainWindow):
         if self.RxThread:
             if self.RxThread.isFinished():
                 self.RxThread = None
-                if os.path.exists(self.RxImagePath):
-                    with open(self.RxImagePath, "rb") as fp:
-                        img = Image.open(fp)
-                        self.LabelReceivePicSize.setText(f"{img.size[0]}x{img.size[1]}")
-                        pkt_size = 100 * 48 - 16 - 32
-                        num_frame = math.ceil(len(list(read_image(self.TxImagePath))) / pkt_size)
-                        self.LabelReceiveDataLength.setText(str(num_frame))
-                        if img.size[0] > img.size[1]:
-                            self.LabelReceiveImage.setPixmap(
-                                QtGui.QPixmap(self.TxImagePath).scaledToWidth(self.LabelSendImage.width()))
-                        else:
-                            self.LabelReceiveImage.setPixmap(
-                                QtGui.QPixmap(self.TxImagePath).scaledToHeight(self.LabelSendImage.height()))
+                if self.RxInfo is not None and self.RxInfo.codec != 'raw':
+                    # the whole payload is in, decode it once more
+                    self.RxPreview()
             elif self.RxThread.isRunning():
                 self.ButtonReceiveStart.setDisabled(True)
+                if self.RxPreviewDue and time.monotonic() - self.RxPreviewTime >= RX_PREVIEW_INTERVAL:
+                    self.RxPreview()
             else:
                 self.ButtonReceiveStart.setDisabled(False)
         else:
@@ -52,14 +52,57 @@ class GrayQamMod(object):
         bit_powers = np.array([2 ** (self.bit_num - 1 - bi) for bi in range(0, self.bit_num)], dtype=int)
         self.bit_powers = np.reshape(bit_powers, (bit_powers.size, 1))  # col vector
 
-    def _dec2bin(self, s):
-        bin_mat = np.zeros((self.bit_num, s.size), dtype=int)
-        for si in range(0, s.size):
-            tt = np.array(list(np.binary_repr(s[si], width=self.bit_num)), dtype=int)
-            # list() converts '1101' to '1','1','0','1'
-            bin_mat[:, si] = tt
+        # demapper lookup tables: the constellation is a grid of p x p points (2 x 1 for BPSK), the
+        # level of a received point on each axis indexes its gray code, and the gray code its bits
+        self.levels = (2, 1) if m == 2 else (self.p, self.p)
+        self.level_to_gray = np.zeros(self.levels, dtype=int)
+        for gray, point in enumerate(self.gray_to_constel if m != 2 else [-1, 1]):
+            self.level_to_gray[self._level(point.real, self.levels[0]),
+                               self._level(point.imag, self.levels[1])] = gray
+        self.gray_to_bits = np.reshape(self._dec2bin(np.arange(m)), (m, self.bit_num)).astype(np.uint8)
+        # every bit depends on the level of one axis only; for the max-log LLR keep, per bit, that axis
+        # and the levels carrying a 0 and a 1
+        level_bits = self.gray_to_bits[self.level_to_gray]  # (I level, Q level, bit)
+        self.bit_levels = []  # [(axis, levels of bit 0, levels of bit 1)]
+        for bi in range(self.bit_num):
+            if (level_bits[:, :, bi] == level_bits[:, :1, bi]).all():
+                axis, bits = 0, level_bits[:, 0, bi]
+            else:
+                assert (level_bits[:, :, bi] == level_bits[:1, :, bi]).all()
+                axis, bits = 1, level_bits[0, :, bi]
+            self.bit_levels.append((axis, np.flatnonzero(bits == 0), np.flatnonzero(bits == 1)))
+        # max-log LLR in closed form: the nearest level carrying a 0 (a0) and a 1 (a1) only change at the
+        # integers between two levels, so on each unit cell of an axis d(x, a0) - d(x, a1) is the line
+        # 2 (a1 - a0) x + a0^2 - a1^2; keep its slope and offset per bit of the axis and cell, the cell of x
+        # being floor(x) + level_num (the outer two unbounded). They are small integers, exact in float32.
+        self.axis_lines = []  # [(axis, bits of the axis, slope, offset)]
+        axes = np.array([axis for axis, _, _ in self.bit_levels])
+        for axis, level_num in enumerate(self.levels):
+            bits = np.flatnonzero(axes == axis)
+            if not bits.size:
+                continue
+            assert (np.diff(bits) == 1).all()  # the bits of an axis are adjacent
+            level_values = np.arange(1 - level_num, level_num, 2)
+            centers = np.arange(-level_num, level_num) + 0.5
+            nearest = [[level_values[levels][np.argmin(np.abs(centers[:, np.newaxis] - level_values[levels]),
+                                                       axis=1)] for levels in self.bit_levels[bi][1:]]
+                       for bi in bits]
+            slope = np.array([2 * (a1 - a0) for a0, a1 in nearest], dtype=np.float32)
+            offset = np.array([a0 ** 2 - a1 ** 2 for a0, a1 in nearest], dtype=np.float32)
+            self.axis_lines.append((axis, slice(bits[0], bits[-1] + 1), slope, offset))
 
-        return np.reshape(bin_mat, (bin_mat.size,), order='F')
+    def _level(self, x, level_num):
+        """ index of the nearest constellation level on one axis (levels -max, -max+2, ..., max) """
+        if level_num == 1:
+            return np.zeros(np.shape(x), dtype=int)
+        max_axis = level_num - 1
+        return np.clip(np.rint((np.asarray(x) + max_axis) / 2), 0, max_axis).astype(int)
+
+    def _dec2bin(self, s):
+        """ bits of the integers s, MSB first, symbol after symbol """
+        s = np.asarray(s, dtype=int)
+        bin_mat = (s[:, np.newaxis] >> np.arange(self.bit_num - 1, -1, -1)) & 1
+        return np.reshape(bin_mat, (bin_mat.size,))
 
     def modulate(self, b):
         """
@@ -81,3 +124,34 @@ class GrayQamMod(object):
             symbols = np.reshape(symbols, (symbols.size,))
 
             return self.gray_to_constel[symbols]
+
+    def demodulate(self, symbols):
+        """
+        hard-decision demapping of complex symbols, the inverse of modulate
+        :param symbols: 1-D array-like complex symbols, normalized as modulate(b) / qam_max_axis
+        :return: 1-D uint8 array of bits, bit_num bits per symbol, MSB first
+        """
+        symbols = np.asarray(symbols).ravel() * self.qam_max_axis
+        gray = self.level_to_gray[self._level(symbols.real, self.levels[0]),
+                                  self._level(symbols.imag, self.levels[1])]
+        return self.gray_to_bits[gray].ravel()
+
+    def llr(self, symbols, noise_var):
+        """
+        soft demapping of complex symbols, max-log approximation
+        :param symbols: complex symbols normalized as modulate(b) / qam_max_axis, shape (..., k)
+        :param noise_var: noise variance of the symbols, broadcast against symbols (e.g. per subcarrier)
+        :return: 1-D float array of log(P(b=1)/P(b=0)), positive for a 1, bit_num values per symbol, MSB first
+        """
+        symbols = np.asarray(symbols) * float(self.qam_max_axis)  # a python float keeps complex64 symbols
+        scale = 1 / (np.asarray(noise_var) * self.qam_max_axis ** 2)
+        # bit after bit, each a contiguous array, in the precision of the symbols (float32 for complex64)
+        llr = np.empty((self.bit_num,) + symbols.shape, dtype=symbols.real.dtype)
+        for axis, bits, slope, offset in self.axis_lines:
+            x = symbols.imag if axis else symbols.real
+            level_num = self.levels[axis]
+            cell = np.clip(x + level_num, 0, 2 * level_num - 1).astype(int)
+            np.multiply(np.take(slope, cell, axis=1), x, out=llr[bits])
+            llr[bits] += np.take(offset, cell, axis=1)
+        llr *= scale.astype(llr.dtype)
+        return np.moveaxis(llr, 0, -1).ravel()
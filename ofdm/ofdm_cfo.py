@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Carrier frequency offset (CFO) estimation and correction.
+
+"""
+
+# compatibility of Python 2/3
+from __future__ import division
+from __future__ import print_function
+
+from builtins import object
+
+import numpy as np
+
+from ofdm.support import coarse_cfo_estimation, cfo_estimation
+
+
+class OfdmCfo(object):
+    """CFO stage: coarse estimate from the STS, fine estimate from the LTS, phase-continuous correction
+
+    Attributes:
+        sts_period: period of the short training sequence
+        cfo: current CFO estimate in cycles per sample
+        phase: NCO phase carried from one call of correct() to the next
+    """
+
+    def __init__(self, sts_period=16, max_len=16384):
+        self.sts_period = sts_period
+        self.cfo = 0.0
+        self.phase = 0.0
+        self._ramp = np.arange(max_len)
+
+    def estimate(self, rx_samples_sts, rx_samples_lts):
+        """ estimate the CFO of a new packet and restart the NCO at its first LTS sample
+        :param rx_samples_sts:  received STS samples, None if they are not available
+        :param rx_samples_lts:  received LTS samples (two 64-sample copies, without CP)
+        :return:                CFO in cycles per sample
+        """
+        coarse = 0.0
+        if rx_samples_sts is not None and len(rx_samples_sts) > 2 * self.sts_period:
+            coarse = coarse_cfo_estimation(rx_samples_sts, self.sts_period)
+            rx_samples_lts = rx_samples_lts * np.exp(-2j * np.pi * coarse * self._arange(len(rx_samples_lts)))
+        self.cfo = coarse + cfo_estimation(rx_samples_lts)
+        self.phase = 0.0
+        return self.cfo
+
+    def correct(self, samples, out=None):
+        """ remove the CFO from consecutive chunks of a packet, the NCO phase is kept between calls """
+        num = len(samples)
+        step = 2 * np.pi * self.cfo
+        phasor = np.exp(-1j * (self.phase + step * self._arange(num)))
+        self.phase = np.mod(self.phase + step * num, 2 * np.pi)
+        return np.multiply(samples, phasor, out=out)
+
+    def _arange(self, num):
+        if num > self._ramp.size:
+            self._ramp = np.arange(num)
+        return self._ramp[:num]
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+"""Channel coding between the LLC frames and the QAM mapper: 802.11 convolutional code, puncturing and
+block interleaver.
+
+"""
+
+# compatibility of Python 2/3
+from __future__ import division
+from __future__ import print_function
+
+import time
+from builtins import object
+
+import numpy as np
+
+# 802.11 K=7 rate-1/2 mother code, generators 133 and 171 (octal), MSB on the current input bit
+CONSTRAINT_LEN = 7
+GENERATORS = [0o133, 0o171]
+# puncturing patterns over the mother code output A0 B0 A1 B1 ..., 1 keeps the bit
+PUNCTURE_PATTERNS = {
+    '1/2': [1, 1],
+    '2/3': [1, 1, 1, 0],
+    '3/4': [1, 1, 1, 0, 0, 1],
+}
+
+
+def make_coding(coding, n_cbps, n_bpsc):
+    """ create the channel coding stage of the PHY layer
+    :param coding:      None (uncoded), 'conv-1/2', 'conv-2/3' or 'conv-3/4'
+    :param n_cbps:      coded bits per OFDM symbol
+    :param n_bpsc:      coded bits per subcarrier
+    :return:            None or a ConvCoding
+    """
+    if coding is None:
+        return None
+    elif coding.startswith('conv-') and coding[5:] in PUNCTURE_PATTERNS:
+        return ConvCoding(coding[5:], n_cbps, n_bpsc)
+    else:
+        raise ValueError("Invalid coding.")
+
+
+def _taps(generator):
+    """ delays (0 for the current input bit) of the register taps of a generator """
+    return [d for d in range(CONSTRAINT_LEN) if generator >> (CONSTRAINT_LEN - 1 - d) & 1]
+
+
+def _output_pair(register):
+    """ output pair A * 2 + B of the encoder for the register content (current input bit as MSB) """
+    pair = 0
+    for generator in GENERATORS:
+        masked = register & generator
+        pair = pair * 2 + (sum((masked >> d) & 1 for d in range(CONSTRAINT_LEN)) & 1)
+    return pair
+
+
+def _butterfly_signs():
+    """ signs of the two LLRs of a step in the branch metric of the butterflies
+    Both generators tap the input bit and the oldest register bit, so the output pair from state (k, x6)
+    (k the 5 latest bits) with input u is the pair of input 0 from (k, 0), complemented when u != x6:
+    the branch metric is m_k or -m_k, m_k = sa[k] * A + sb[k] * B for the LLRs A, B of the step.
+    :return:            sa, sb of shape (32,)
+    """
+    pairs = np.array([_output_pair(k << 1) for k in range(1 << (CONSTRAINT_LEN - 2))])
+    return (2 * (pairs >> 1) - 1).astype(np.float32), (2 * (pairs & 1) - 1).astype(np.float32)
+
+
+_BUTTERFLY_SIGNS = _butterfly_signs()
+# sign of m_k in the branch from (k, x6) with input u, indexed by (x6, u)
+_BRANCH_SIGNS = np.array([[1, -1], [-1, 1]], dtype=np.float32)
+
+
+def conv_encode(bits):
+    """ rate-1/2 convolutional encoding from the zero state
+    :param bits:        1-D array of bits (including the tail bits that flush the register)
+    :return:            1-D uint8 array A0 B0 A1 B1 ...
+    """
+    bits = np.asarray(bits, dtype=np.uint8).ravel()
+    coded = np.empty((bits.size, len(GENERATORS)), dtype=np.uint8)
+    for gi, generator in enumerate(GENERATORS):
+        taps = np.zeros(CONSTRAINT_LEN, dtype=np.uint8)
+        taps[_taps(generator)] = 1
+        coded[:, gi] = np.convolve(bits, taps)[:bits.size] & 1
+    return coded.ravel()
+
+
+def interleaver_permutation(n_cbps, n_bpsc):
+    """ 802.11 block interleaver of one OFDM symbol: bit k goes to position perm[k]
+    The first permutation spreads adjacent coded bits over non-adjacent subcarriers, the second one
+    alternates them between more and less significant bits of the constellation.
+    """
+    k = np.arange(n_cbps)
+    s = max(n_bpsc // 2, 1)
+    i = (n_cbps // 16) * (k % 16) + k // 16
+    return s * (i // s) + (i + n_cbps - (16 * i // n_cbps)) % s
+
+
+def viterbi_decode(llr, block_len=256, overlap=64, chunk=8):
+    """ maximum likelihood decoding of the rate-1/2 code, vectorized across the 64 states
+    The trellis is cut into blocks of block_len steps decoded side by side, each one run over overlap
+    extra steps on both sides so that its survivors have merged with the full-length decision
+    (overlap is about 9 constraint lengths). A step is one add-compare-select over the 64 states of every
+    block, the blocks along the last axis of the arrays, whose branch metrics are computed chunk steps at a
+    time. The blocks of several packets share the steps, so a batch costs little more Python work than one
+    packet.
+    :param llr:         1-D array A0 B0 A1 B1 ... of log(P(b=1)/P(b=0)) (0 for punctured bits), or a 2-D
+                        array of such packets of the same length, one per row; hard bits can be given as
+                        2 * bits - 1
+    :param block_len:   trellis steps of a block
+    :param overlap:     extra steps decoded on each side of a block
+    :param chunk:       steps whose branch metrics are computed at once
+    :return:            uint8 array of the decoded bits, 1-D or one row per packet like llr; every path
+                        starts in the zero state
+    """
+    llr = np.asarray(llr, dtype=np.float32)
+    packets = llr.reshape(-1, llr.shape[-1] // 2, 2)
+    packet_num, step_num = packets.shape[:2]
+
+    # blocks of the trellis, in steps; outside of a packet only zero inputs are allowed, which holds its
+    # first block in the zero state before the packet starts
+    block_num = -(-step_num // block_len)
+    window_len = block_len + 2 * overlap
+    padded_len = block_num * block_len + 2 * overlap
+    padded = np.zeros((packet_num, padded_len, 2), dtype=np.float32)
+    padded[:, overlap:overlap + step_num] = packets
+    forced = np.ones(padded_len, dtype=bool)
+    forced[overlap:overlap + step_num] = False
+    # first step of every block, blocks of all packets side by side
+    starts = (np.arange(packet_num)[:, np.newaxis] * padded_len + np.arange(block_num) * block_len).ravel()
+    total = starts.size
+    steps = np.arange(window_len)[:, np.newaxis] + starts
+    windows = padded.reshape(-1, 2)[steps]  # (w, b, 2)
+    window_forced = forced[steps % padded_len]  # (w, b)
+    step_forced = window_forced.any(axis=1)
+
+    # add-compare-select with the blocks along the last axis, so that every operation runs over contiguous
+    # rows: state (k, x6) is path[2 * k + x6], its successor (u, k) path[32 * u + k]
+    state_num = 1 << (CONSTRAINT_LEN - 1)
+    half = state_num // 2
+    sa, sb = _BUTTERFLY_SIGNS[0][:, np.newaxis], _BUTTERFLY_SIGNS[1][:, np.newaxis]
+    path = np.zeros((state_num, total), dtype=np.float32)
+    path_in = path.reshape(half, 2, total).transpose(1, 0, 2)[:, np.newaxis]  # (x6, 1, k, b) view
+    path_out = path.reshape(2, half, total)  # (u, k, b) view
+    candidates = np.empty((2, 2, half, total), dtype=np.float32)  # (x6, u, k, b)
+    # (w, u, k, b): x6 of the survivor; the steps before the block are never traced back
+    decisions = np.empty((window_len - overlap, 2, half, total), dtype=np.uint8)
+    signs = _BRANCH_SIGNS[:, :, np.newaxis, np.newaxis]
+    for c in range(0, window_len, chunk):
+        pairs = windows[c:c + chunk, np.newaxis]
+        metrics = pairs[..., 0] * sa + pairs[..., 1] * sb  # (chunk, k, b)
+        metrics = metrics[:, np.newaxis, np.newaxis] * signs  # (chunk, x6, u, k, b)
+        for t in range(c, min(c + chunk, window_len)):
+            np.add(path_in, metrics[t - c], out=candidates)
+            if t >= overlap:
+                np.greater(candidates[1], candidates[0], out=decisions[t - overlap])
+            np.maximum(candidates[0], candidates[1], out=path_out)
+            if step_forced[t]:
+                path_out[1][:, window_forced[t]] -= np.float32(1e9)
+        path -= path.max(axis=0)
+
+    # trace back every block from its best state through the predecessors of the survivors; a state holds
+    # the input of its step as MSB
+    previous = decisions | (np.arange(half, dtype=np.uint8) << 1)[:, np.newaxis]
+    previous = previous.reshape(window_len - overlap, state_num, total)
+    blocks = np.arange(total)
+    state = path.argmax(axis=0)
+    states = np.empty((block_len, total), dtype=state.dtype)
+    for t in range(window_len - overlap - 1, -1, -1):
+        if t < block_len:
+            states[t] = state
+        state = previous[t, state, blocks]
+    bits = (states.T >> (CONSTRAINT_LEN - 2)).astype(np.uint8).reshape(packet_num, -1)[:, :step_num]
+    return bits if llr.ndim > 1 else bits[0]
+
+
+class ConvCoding(object):
+    """802.11 convolutional coding stage: encoder, puncturing and interleaver on TX, the reverse with a
+    Viterbi decoder on RX
+
+    A packet of sym_num OFDM symbols carries sym_num * n_dbps bits, of which the last tail_len are zeros
+    that bring the encoder back to the zero state.
+
+    Attributes:
+        rate: '1/2', '2/3' or '3/4'
+        n_cbps: coded bits per OFDM symbol
+        n_dbps: data bits per OFDM symbol
+        tail_len: tail bits per packet
+    """
+
+    tail_len = CONSTRAINT_LEN - 1
+
+    def __init__(self, rate, n_cbps, n_bpsc):
+        self.rate = rate
+        self.pattern = np.array(PUNCTURE_PATTERNS[rate], dtype=bool)
+        self.n_cbps = n_cbps
+        # data bits per pattern period / coded bits kept per period
+        self.n_dbps = n_cbps * (self.pattern.size // 2) // int(self.pattern.sum())
+        assert self.n_dbps * int(self.pattern.sum()) == n_cbps * (self.pattern.size // 2)
+        self.perm = interleaver_permutation(n_cbps, n_bpsc)
+
+    def encode(self, bits, sym_num):
+        """ encode the bits of a packet, zero-padded to sym_num symbols
+        :return:            coded and interleaved bits, sym_num * n_cbps
+        """
+        data = np.zeros(sym_num * self.n_dbps, dtype=np.uint8)
+        data[:np.size(bits)] = np.ravel(bits)
+        coded = conv_encode(data).reshape(-1, self.pattern.size)[:, self.pattern].ravel()
+        interleaved = np.empty((sym_num, self.n_cbps), dtype=np.uint8)
+        interleaved[:, self.perm] = coded.reshape(sym_num, self.n_cbps)
+        return interleaved.ravel()
+
+    def decode(self, rx, soft=True):
+        """ decode a received packet
+        :param rx:          demodulated bits (soft=False) or their LLRs log(P(b=1)/P(b=0)), sym_num * n_cbps
+        :return:            decoded bits of shape (sym_num * n_dbps - tail_len, 1)
+        """
+        return self.decode_batch([rx], soft)[0]
+
+    def decode_batch(self, rxs, soft=True):
+        """ decode received packets of the same size in one pass of the Viterbi decoder
+        :param rxs:         sequence of packets as taken by decode
+        :return:            decoded bits of shape (packets, sym_num * n_dbps - tail_len, 1)
+        """
+        rx = np.asarray(rxs, dtype=np.float32).reshape(len(rxs), -1, self.n_cbps)
+        if not soft:
+            rx = rx * 2 - 1
+        kept = int(self.pattern.sum())
+        llr = np.zeros((len(rxs), rx.shape[1] * self.n_cbps // kept, self.pattern.size), dtype=np.float32)
+        llr[:, :, self.pattern] = rx[:, :, self.perm].reshape(len(rxs), -1, kept)
+        return viterbi_decode(llr.reshape(len(rxs), -1))[:, :-self.tail_len, np.newaxis]
+
+    def decode_rate(self, sym_num, batch=1, repeat=3):
+        """ packets of sym_num symbols decoded per second, batch packets per pass, best of repeat passes """
+        rxs = np.zeros((batch, sym_num * self.n_cbps), dtype=np.float32)
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            self.decode_batch(rxs)
+            best = min(best, time.perf_counter() - start)
+        return batch / best
+
+    def packet_bit_size(self, sym_num):
+        """ data bits carried by sym_num OFDM symbols """
+        return sym_num * self.n_dbps - self.tail_len
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""Queues between the PlutoSDR/socket watcher threads and the OFDM processing.
+
+"""
+
+# compatibility of Python 2/3
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import queue
+import threading
+from builtins import object
+from multiprocessing import Manager, shared_memory
+
+import numpy as np
+
+
+def make_queue(queue_type='thread', maxsize=20, slot_bytes=None):
+    """ create a bounded FIFO queue of the PHY layer
+    :param queue_type:      'thread': lock-based in-process queue, for producers and consumers in threads
+                            'shm': shared-memory ring of numpy arrays, for a consumer in another process
+                            'manager': multiprocessing.Manager proxy queue
+    :param maxsize:         capacity of the queue
+    :param slot_bytes:      largest array (in bytes) the 'shm' ring has to carry
+    :return:                a queue with the interface of queue.Queue, plus put_drop_oldest(), close() and
+                            the noverflow/ndrop counters of QueueCounters
+    """
+    if queue_type == 'thread':
+        return ThreadQueue(maxsize)
+    elif queue_type == 'shm':
+        return ShmQueue(maxsize, slot_bytes)
+    elif queue_type == 'manager':
+        return ManagerQueue(maxsize)
+    else:
+        raise ValueError("Invalid queue type.")
+
+
+class QueueCounters(object):
+    """Overflow accounting of a bounded queue
+
+    Attributes:
+        noverflow: number of put() calls that found the queue full (they blocked or failed)
+        ndrop: number of items thrown away by put_drop_oldest()
+    """
+
+    noverflow = 0
+    ndrop = 0
+
+    def put_drop_oldest(self, item):
+        """ put without blocking, the oldest item is dropped when the queue is full; for producers that
+        cannot wait, e.g. the receiver
+        """
+        while True:
+            try:
+                self.put(item, block=False)
+                return
+            except queue.Full:
+                try:
+                    self.get(block=False)
+                    self.ndrop += 1
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        """ release the resources of the queue once its producers and consumers stopped """
+        pass
+
+
+class ThreadQueue(QueueCounters, queue.Queue):
+    """queue.Queue with overflow counters"""
+
+    def put(self, item, block=True, timeout=None):
+        if self.full():
+            self.noverflow += 1
+        queue.Queue.put(self, item, block, timeout)
+
+
+class ManagerQueue(QueueCounters):
+    """multiprocessing.Manager queue proxy with overflow counters"""
+
+    def __init__(self, maxsize):
+        self._manager = Manager()
+        self._queue = self._manager.Queue(maxsize)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_manager'] = None  # the proxy reaches the manager process, only the creator stops it
+        return state
+
+    def put(self, item, block=True, timeout=None):
+        if self._queue.full():
+            self.noverflow += 1
+        self._queue.put(item, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        return self._queue.get(block, timeout)
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
+
+    def full(self):
+        return self._queue.full()
+
+    def close(self):
+        """ stop the manager process, from the creating process """
+        if self._manager is not None:
+            self._manager.shutdown()
+
+
+class ShmQueue(QueueCounters):
+    """Queue of numpy arrays over a ring of fixed-size slots in shared memory
+
+    Items are copied into the ring by put() and out of it by get(), nothing is pickled. The queue can be
+    handed to a multiprocessing.Process at its creation and used from both processes (the overflow
+    counters are per process).
+
+    Attributes:
+        maxsize: number of slots of the ring
+        slot_bytes: size of a slot in bytes
+    """
+
+    _meta_len = 4  # nbytes, ndim, dim0, dim1
+    _dtype_len = 8
+
+    def __init__(self, maxsize, slot_bytes, ctx=None):
+        assert maxsize > 0 and slot_bytes > 0
+        ctx = ctx or multiprocessing.get_context()
+        self.maxsize = maxsize
+        self.slot_bytes = int(slot_bytes)
+        self._shm = shared_memory.SharedMemory(create=True, size=maxsize * self.slot_bytes)
+        self._owner = True
+        self._meta = ctx.Array('q', maxsize * self._meta_len, lock=False)
+        self._dtype = ctx.Array('c', maxsize * self._dtype_len, lock=False)
+        self._state = ctx.Array('q', 3, lock=False)  # head, tail, count
+        self._lock = ctx.Lock()
+        self._items = ctx.Semaphore(0)
+        self._slots = ctx.Semaphore(maxsize)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = self._shm.name
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=state['_shm'])
+
+    def put(self, item, block=True, timeout=None):
+        item = np.ascontiguousarray(item)
+        if item.nbytes > self.slot_bytes or item.ndim > 2:
+            raise ValueError("item of {} bytes does not fit a slot of {} bytes".format(item.nbytes,
+                                                                                      self.slot_bytes))
+        if not self._slots.acquire(False):
+            self.noverflow += 1
+            if not block or not self._slots.acquire(True, timeout):
+                raise queue.Full
+        with self._lock:
+            slot = self._state[1]
+            self._state[1] = (slot + 1) % self.maxsize
+            self._state[2] += 1
+            offset = slot * self.slot_bytes
+            self._shm.buf[offset:offset + item.nbytes] = item.reshape(-1).view(np.uint8)
+            shape = item.shape + (0,) * (2 - item.ndim)
+            self._meta[slot * self._meta_len:(slot + 1) * self._meta_len] = [item.nbytes, item.ndim] + list(shape)
+            self._dtype[slot * self._dtype_len:(slot + 1) * self._dtype_len] = \
+                item.dtype.str.encode().ljust(self._dtype_len)
+        self._items.release()
+
+    def get(self, block=True, timeout=None):
+        if not self._items.acquire(block, timeout):
+            raise queue.Empty
+        with self._lock:
+            slot = self._state[0]
+            self._state[0] = (slot + 1) % self.maxsize
+            self._state[2] -= 1
+            nbytes, ndim, dim0, dim1 = self._meta[slot * self._meta_len:(slot + 1) * self._meta_len]
+            dtype = np.dtype(self._dtype[slot * self._dtype_len:(slot + 1) * self._dtype_len].strip().decode())
+            offset = slot * self.slot_bytes
+            item = np.frombuffer(self._shm.buf[offset:offset + nbytes], dtype=dtype).copy()
+        self._slots.release()
+        return item.reshape((dim0, dim1)[:ndim])
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self._state[2]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return self.qsize() >= self.maxsize
+
+    def close(self):
+        """ release the shared memory, the creating process also removes it """
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class SampleRing(object):
+    """Preallocated complex64 ring buffer of the received sample stream
+
+    The receive thread copies every buffer into the ring in place, readers get numpy views of any window
+    of up to max_window samples: the first max_window samples of the ring are mirrored behind its end,
+    so a window that wraps around is still contiguous. Positions are absolute sample counts.
+
+    A reader releases the samples it no longer needs. When the writer has to overwrite samples that are
+    not released yet, the overrun is counted instead of being silent.
+
+    Attributes:
+        capacity: number of samples held by the ring
+        max_window: longest window a reader can ask for
+        write_count: absolute position of the end of the stream written so far
+        read_count: absolute position before which samples are released
+        noverrun: number of writes that overwrote unreleased samples
+        nlost: number of unreleased samples overwritten
+    """
+
+    def __init__(self, capacity, max_window):
+        assert 0 < max_window <= capacity
+        self.capacity = int(capacity)
+        self.max_window = int(max_window)
+        self._buf = np.zeros(self.capacity + self.max_window, dtype=np.complex64)
+        self.write_count = 0
+        self.read_count = 0
+        self.noverrun = 0
+        self.nlost = 0
+        self._cond = threading.Condition()
+
+    @property
+    def oldest(self):
+        """ absolute position of the oldest sample still in the ring """
+        return max(self.write_count - self.capacity, 0)
+
+    def write(self, samples):
+        """ copy samples into the ring, called by the receive thread """
+        num = len(samples)
+        assert num <= self.capacity
+        pos = self.write_count % self.capacity
+        first = min(num, self.capacity - pos)
+        self._buf[pos:pos + first] = samples[:first]
+        self._buf[:num - first] = samples[first:]
+        # mirror of the head of the ring
+        if pos < self.max_window:
+            self._buf[self.capacity + pos:self.capacity + min(pos + first, self.max_window)] = \
+                self._buf[pos:min(pos + first, self.max_window)]
+        if num > first:
+            end = min(num - first, self.max_window)
+            self._buf[self.capacity:self.capacity + end] = self._buf[:end]
+        with self._cond:
+            lost = self.write_count + num - self.capacity - self.read_count
+            if lost > 0:
+                self.noverrun += 1
+                self.nlost += lost
+                self.read_count += lost
+            self.write_count += num
+            self._cond.notify_all()
+
+    def wait(self, position, timeout=None):
+        """ block until the stream reaches position or timeout, return the current write_count """
+        with self._cond:
+            self._cond.wait_for(lambda: self.write_count >= position, timeout)
+            return self.write_count
+
+    def window(self, start, stop):
+        """ view of the samples [start, stop) of the stream, start must not be older than oldest """
+        assert start <= stop <= self.write_count and stop - start <= self.max_window
+        pos = start % self.capacity
+        return self._buf[pos:pos + stop - start]
+
+    def release(self, position):
+        """ samples before position may be overwritten """
+        with self._cond:
+            self.read_count = max(self.read_count, min(position, self.write_count))
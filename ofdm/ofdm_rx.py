@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 
 
+import queue
 import socket
 import sys
 import threading
-from multiprocessing import Manager
+from collections import Counter
 
 sys.path.append('..')
 
+from ofdm.ofdm_cfo import OfdmCfo
+from ofdm.ofdm_queue import make_queue, SampleRing
+from ofdm.ofdm_sync import OfdmSync, OfdmSquelch
 from ofdm.ofdm_utils import OfdmConfig
 from ofdm.pluto_interface import pluto_receiver
 from ofdm.support import *
@@ -15,7 +19,8 @@ from ofdm.support import *
 class OfdmRx(threading.Thread):
     def __init__(self, rx_type, rx_args,
                  n=64, cp_len=16, qam_mod_size=2, pilot_pattern='custom', preamble_type='802.11', num_symbol=100,
-                 verbose=False):
+                 verbose=False, multi_packet=True, detector='cross', squelch_db=6.0, queue_type='thread',
+                 soft_output=None, coding=None):
         """ OFDM receiver
         :param rx_type:                 'pluto', 'socket'
         :param rx_args:                 including parameters below
@@ -32,56 +37,116 @@ class OfdmRx(threading.Thread):
         :param preamble_type:           only '802.11' is supported
         :param num_symbol:              the number of ofdm symbols
         :param verbose:                 print PHY-layer info
+        :param multi_packet:            decode every packet of a receive buffer, not only the first one
+        :param detector:                'cross' (LTS cross-correlation) or 'auto' (STS auto-correlation)
+        :param squelch_db:              energy rise above the noise floor needed to search a buffer for
+                                        a preamble, None disables the squelch
+        :param queue_type:              'thread', 'shm' or 'manager', see ofdm.ofdm_queue.make_queue
+        :param soft_output:             None: hard bits (uint8) per packet, 'float16' or 'float32': per-bit
+                                        LLRs log(P(b=1)/P(b=0)) in the same order and shape, to be turned
+                                        into bits by decode() (e.g. after combining retransmissions)
+        :param coding:                  None, 'conv-1/2', 'conv-2/3' or 'conv-3/4', see ofdm.ofdm_coding;
+                                        packets then carry the decoded bits, the decoder takes LLRs and runs
+                                        in its own thread (rx_decoder_thread); with soft_output they carry
+                                        the LLRs of the coded bits
         """
         # Rx params
         threading.Thread.__init__(self)
-        self.rx_sample_queue = Manager().Queue()  # raw samples from PlutoSDR device
-        self.rx_sample_queue_size = 20
-        self.rx_packet_queue = Manager().Queue()  # packet bits
+        self.rx_sample_queue_size = 20  # receive buffers held by the sample ring
         self.rx_packet_queue_size = 20
         self.rx_type = rx_type
+        assert soft_output in [None, 'float16', 'float32']
+        self.soft_output = soft_output
+        # packet bits or LLRs (up to 4 bytes per bit, up to 8 bits per subcarrier); the radio cannot be held
+        # back, so when the upper layer falls behind the oldest packet is dropped and counted in
+        # rx_packet_queue.ndrop
+        self.rx_packet_queue = make_queue(queue_type, self.rx_packet_queue_size,
+                                          num_symbol * 48 * 8 * (4 if soft_output else 1))
         self.preamble_lts = np.load("preamble_lts.npy")
         if self.rx_type == "pluto":
             rx_args, rx_freq, bandwidth, rx_gain, rx_buffer_size, gain_control_mode = rx_args
             sdr_rx = pluto_receiver(rx_args, rx_freq, bandwidth, rx_gain, rx_buffer_size,
                                     gain_control_mode, verbose=True).pluto
+            # raw samples from PlutoSDR device; the synchronizer looks back at most one packet plus
+            # timing margins before a new buffer
+            self.rx_buffer_size = int(rx_buffer_size or 10000)
+            self.rx_ring = SampleRing(self.rx_sample_queue_size * self.rx_buffer_size,
+                                      self.rx_buffer_size + (num_symbol + 4) * (n + cp_len) + 4 * n)
             self.rx_sample_queue_watcher_thread = rx_sample_queue_watcher_thread(sdr_rx,
-                                                                                 self.rx_sample_queue,
-                                                                                 self.rx_sample_queue_size,
+                                                                                 self.rx_ring,
                                                                                  verbose=verbose)
         elif self.rx_type == "socket":
             rx_ipaddr, rx_port = rx_args
             self.rx_packet_queue_watcher_thread = rx_packet_queue_watcher_thread(rx_ipaddr, rx_port,
                                                                                  self.rx_packet_queue,
-                                                                                 self.rx_packet_queue_size,
                                                                                  verbose=verbose)
         else:
             raise ValueError("Invalid rx type.")
 
         # OFDM params
-        self.ofdm_config = OfdmConfig(n, cp_len, qam_mod_size, pilot_pattern)  # type: OfdmConfig
+        self.ofdm_config = OfdmConfig(n, cp_len, qam_mod_size, pilot_pattern, coding=coding)  # type: OfdmConfig
+        self.rx_soft_queue = None
+        if self.rx_type == "pluto" and coding and not soft_output:
+            # LLRs of the coded packets waiting for the decoder, so that the sample processing never waits
+            # for the Viterbi decoder
+            self.rx_soft_queue = make_queue('thread', self.rx_packet_queue_size)
+            self.rx_decoder_thread = rx_decoder_thread(self.ofdm_config.coding, self.rx_soft_queue,
+                                                       self.rx_packet_queue, verbose=verbose)
         self.preamble_type = preamble_type
         self.num_symbol = num_symbol
         self.pilot_index = [7, 21, 43, 57]                    # note: data are arranged in this order
         self.data_index = list(range(1,7))+list(range(8,21))+list(range(22,27))+list(range(38,43))+list(range(44,57))+list(range(58,64))
         self.index=list(range(64))   # note: data are arranged in this order
-        self.nbits = num_symbol * 48
+        self.nbits = num_symbol * self.ofdm_config.n_cbps   # coded bits of a packet
+        self.packet_bit_size = self.ofdm_config.packet_bit_size(num_symbol)
         self.preamble_lts = np.load("preamble_lts.npy")  
         self.preamble_sts = np.load("preamble_sts.npy")
         self.lts_frequency = np.fft.fft(self.preamble_lts, 64)
-        self.prev_samples = np.array([])
+        self.pilot_values = self.ofdm_config.training_signal_freq[self.pilot_index]
+        self.noise_var = None                                # noise variance of the data subcarriers
+        self.cfo_stage = OfdmCfo(len(self.preamble_sts))
         self.packet_length = self.ofdm_config.preamble_sts_len + self.ofdm_config.preamble_lts_len + \
                              self.num_symbol * self.ofdm_config.sym_len
+        # the first LTS period follows the STS and the LTS cyclic prefix
+        self.lts_start = self.ofdm_config.preamble_sts_len + self.ofdm_config.preamble_lts_len - 2 * n
+        self.sync = OfdmSync(self.preamble_lts, self.lts_start, self.packet_length, multi=multi_packet,
+                             detector=detector, sts_period=len(self.preamble_sts))
+        self.squelch = OfdmSquelch(threshold_db=squelch_db) if squelch_db is not None else None
+        if self.rx_type == "pluto" and coding:
+            # the Viterbi decoder runs in numpy and falls behind back-to-back packets at the higher rates
+            # (16-QAM, 64-QAM); the packets it cannot take are dropped, so say so whatever verbose is
+            batch = 1 if soft_output else self.rx_decoder_thread.max_batch
+            decode_rate = self.ofdm_config.coding.decode_rate(num_symbol, batch)
+            air_rate = bandwidth / self.packet_length
+            if decode_rate < air_rate:
+                print("[OfdmRx] WARNING: the {} decoder takes {:.0f} packets/s ({} at a time), {:.0f} packets/s "
+                      "fit on air at {}-QAM: back-to-back packets will be dropped".format(
+                          coding, decode_rate, batch, air_rate, qam_mod_size))
 
         self.verbose = verbose
         self.nrx = 0
         self.nrxok = 0
+        self.nbuf = 0                                        # receive buffers processed
+        self.npkt = 0                                        # packets found
+        self.packets_per_buffer = Counter()                  # {packets found in a buffer: # of buffers}
 
         self.keep_running = True
         self.start()
 
     def done(self):
+        """ stop the receiver and release its queues; the upper layer no longer calls get() """
         self.keep_running = False
+        if self.rx_type == "pluto":
+            self.rx_sample_queue_watcher_thread.done()
+            self.join()
+            if self.rx_soft_queue is not None:
+                self.rx_decoder_thread.done()
+                self.rx_decoder_thread.join()
+                self.rx_soft_queue.close()
+        else:
+            self.rx_packet_queue_watcher_thread.done()
+            self.rx_packet_queue_watcher_thread.join()
+        self.rx_packet_queue.close()
 
     def run(self):
         """ thread for sample process
@@ -92,57 +157,142 @@ class OfdmRx(threading.Thread):
         elif self.rx_type == "socket":
             return
 
-    def get(self):
+    def get(self, timeout=0.1):
         """ interface for upper layers
+        :param timeout:     longest wait in seconds for a packet
+        :return:            the bits of the next packet, None if none arrived within timeout
         """
-        return self.rx_packet_queue.get() if not self.rx_packet_queue.empty() else None
+        try:
+            return self.rx_packet_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def decode(self, llr):
+        """ bits of a packet from its LLRs (soft_output), e.g. combined over several receptions
+        :param llr:         LLRs of a packet as returned by get()
+        :return:            the bits get() returns without soft_output, shape (packet_bit_size, 1)
+        """
+        if self.ofdm_config.coding:
+            return self.ofdm_config.coding.decode(llr)
+        return (np.reshape(llr, (-1, 1)) > 0).astype(np.uint8)
 
     def process(self):
         """ Demodulate received samples and put packet into rx_packet_queue """
-        signal = self.rx_sample_queue.get()
-        index = detect_preamble_cross_correlation(self.preamble_lts, signal)
-        if index is not None:
-            if index  > 1680:
-                signal1 = self.rx_sample_queue.get()
-                signal = np.hstack((signal[index:], signal1[0:index]))
-                index = 0
-            #print(index)
-            #np.save("signal.npy", signal)
-            start_pos = index
-            rx_samples = signal[start_pos:start_pos+64*2+self.num_symbol*80-1]
-            rx_samples_lts_raw = rx_samples[0:127]
-            cfo = cfo_estimation(rx_samples_lts_raw)
-
-            # #cfo compensation
-            for i in range(len(rx_samples)):
-                rx_samples[i] = rx_samples[i]* np.exp( -1j * 2 * np.pi * cfo * i)
-
-            # #channel estimation by preamble
-            rx_samples_lts = rx_samples[0:127]
-            h_tilde = channel_estimation(rx_samples_lts, self.index, self.lts_frequency)
-
-            # #demodulation
-
-            rx_samples_data = rx_samples[128:-1]
-            demod_signal,p = detfcount(rx_samples_data,h_tilde,self.num_symbol,self.pilot_index,self.data_index)
-            """ Put packet to FIFO queue """
-            if self.rx_packet_queue.qsize() > self.rx_packet_queue_size:
-                self.rx_packet_queue.get()
-            self.rx_packet_queue.put(demod_signal)
+        ring = self.rx_ring
+        stop = ring.wait(self.sync.sample_count + 1, timeout=0.1)
+        if stop <= self.sync.sample_count:
+            return
+        if self.sync.sample_count < ring.oldest:
+            # samples overwritten before they were processed (counted by the ring), resynchronize
+            self.sync.reset(ring.oldest)
+        stop = min(stop, self.sync.sample_count + self.rx_buffer_size)
+        begin = max(self.sync.keep_from, ring.oldest, stop - ring.max_window)
+        window = ring.window(begin, stop)
+
+        signal = window[self.sync.sample_count - begin:]
+        search = self.squelch is None or self.sync.busy or self.squelch.check(signal)
+        packets = self.sync.push_window(window, begin, search)
+        self.nbuf += 1
+        self.npkt += len(packets)
+        self.packets_per_buffer[len(packets)] += 1
+        for start, packet in packets:
+            if self.verbose:
+                print("[OfdmRx] packet at sample {}, {} packets in buffer".format(start, len(packets)))
+            self.demodulate(packet)
+        ring.release(self.sync.keep_from)
+
+    def demodulate(self, packet):
+        """ Demodulate one synchronized packet (packet_length samples from the STS on) """
+        sts_len = self.ofdm_config.preamble_sts_len
+        rx_samples_sts = packet[0:sts_len]
+
+        # #cfo estimation (coarse by STS, fine by LTS) and compensation
+        cfo = self.cfo_stage.estimate(rx_samples_sts, packet[self.lts_start:self.lts_start + 128])
+        rx_samples = self.cfo_stage.correct(packet[self.lts_start:])
+
+        # #channel estimation by preamble
+        rx_samples_lts = rx_samples[0:128]
+        h_tilde = channel_estimation(rx_samples_lts, self.index, self.lts_frequency)
+
+        # #demodulation
+
+        rx_samples_data = rx_samples[128:]
+        if self.soft_output or self.ofdm_config.coding:
+            demod_signal, self.noise_var, p = ofdm_soft_demodulation(
+                rx_samples_data, h_tilde, self.num_symbol, self.pilot_index, self.data_index, self.pilot_values,
+                self.ofdm_config.n, self.ofdm_config.cp_len, self.ofdm_config.qam_mod, self.soft_output or np.float32)
+            if not self.soft_output:
+                ndrop = self.rx_soft_queue.ndrop
+                self.rx_soft_queue.put_drop_oldest(demod_signal)
+                if self.verbose and self.rx_soft_queue.ndrop > ndrop:
+                    # the decoder does not keep up with the received packets
+                    print("[OfdmRx] decoder queue full: ndrop={}".format(self.rx_soft_queue.ndrop))
+                return
+        else:
+            demod_signal, p = ofdm_demodulation(rx_samples_data, h_tilde, self.num_symbol, self.pilot_index,
+                                                self.data_index, self.ofdm_config.n, self.ofdm_config.cp_len,
+                                                self.ofdm_config.qam_mod)
+        """ Put packet to FIFO queue """
+        ndrop = self.rx_packet_queue.ndrop
+        self.rx_packet_queue.put_drop_oldest(demod_signal)
+        if self.verbose and self.rx_packet_queue.ndrop > ndrop:
+            # rx packets are not processed timely by the upper layer
+            print("[OfdmRx] RX queue full: ndrop={}".format(self.rx_packet_queue.ndrop))
+
+
+class rx_decoder_thread(threading.Thread):
+    """ Rx Decoder, turns the LLRs of the coded packets into bits; the packets waiting are decoded in one
+    pass of the Viterbi decoder, up to max_batch at once, which keeps up with a backlog faster than one by one
+    """
+
+    def __init__(self, coding, rx_soft_queue, rx_packet_queue, max_batch=8, verbose=False):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.keep_running = True
+        self.coding = coding
+        self.rx_soft_queue = rx_soft_queue
+        self.rx_packet_queue = rx_packet_queue
+        self.max_batch = max_batch
+        self.verbose = verbose
+        self.nbatch = 0                                      # decoder passes
+        self.npkt = 0                                        # packets decoded
+        self.start()
+
+    def done(self):
+        self.keep_running = False
+
+    def run(self):
+        while self.keep_running:
+            try:
+                batch = [self.rx_soft_queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.rx_soft_queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.nbatch += 1
+            self.npkt += len(batch)
+            for bits in self.coding.decode_batch(batch):
+                """ Put packet to FIFO queue """
+                ndrop = self.rx_packet_queue.ndrop
+                self.rx_packet_queue.put_drop_oldest(bits)
+                if self.verbose and self.rx_packet_queue.ndrop > ndrop:
+                    # rx packets are not processed timely by the upper layer
+                    print("[OfdmRx] RX queue full: ndrop={}".format(self.rx_packet_queue.ndrop))
 
 
 class rx_sample_queue_watcher_thread(threading.Thread):
-    """ Rx Queue Monitor
+    """ Rx Sample Monitor, fills the sample ring with the buffers of the PlutoSDR device
     """
 
-    # TODO
-    def __init__(self, sdr_rx, rx_queue, rx_queue_size, verbose=False):
+    def __init__(self, sdr_rx, rx_ring, verbose=False):
         threading.Thread.__init__(self)
         self.setDaemon(True)
         self.keep_running = True
         self.sdr_rx = sdr_rx
-        self.rx_queue = rx_queue
-        self.rx_queue_size = rx_queue_size
+        self.rx_ring = rx_ring  # type: SampleRing
         self.verbose = verbose
         self.start()
 
@@ -150,16 +300,14 @@ class rx_sample_queue_watcher_thread(threading.Thread):
         self.keep_running = False
 
     def run(self):
+        noverrun = 0
         while self.keep_running:
             try:
-                """ Put packet to FIFO queue """
-                if self.rx_queue.qsize() > self.rx_queue_size:
-                    self.rx_queue.get()
-                self.rx_queue.put_nowait(self.sdr_rx.rx())
-                if self.verbose:
-                    # can be used to check if rx queue is processed timely
-                    pass
-                    #print("[PlutoRxQueue] RX queue size: {}".format(self.rx_queue.qsize()))
+                self.rx_ring.write(self.sdr_rx.rx())
+                if self.verbose and self.rx_ring.noverrun > noverrun:
+                    # rx samples are not processed timely
+                    noverrun = self.rx_ring.noverrun
+                    print("[PlutoRxRing] overrun: noverrun={}, nlost={}".format(noverrun, self.rx_ring.nlost))
             except:
                 break
 
@@ -168,16 +316,16 @@ class rx_packet_queue_watcher_thread(threading.Thread):
     """ Rx Queue Monitor
     """
 
-    def __init__(self, rx_ipaddr, rx_port, rx_queue, rx_queue_size, verbose=False):
+    def __init__(self, rx_ipaddr, rx_port, rx_queue, verbose=False, poll_interval=0.5):
         threading.Thread.__init__(self)
         self.setDaemon(True)
         self.keep_running = True
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(poll_interval)  # how often keep_running is checked while idle
         self.rx_ipaddr = rx_ipaddr
         self.rx_port = rx_port
         self.sock.bind((self.rx_ipaddr, self.rx_port))
         self.rx_queue = rx_queue
-        self.rx_queue_size = rx_queue_size
         self.verbose = verbose
         self.start()
 
@@ -187,15 +335,17 @@ class rx_packet_queue_watcher_thread(threading.Thread):
     def run(self):
         while self.keep_running:
             try:
-                """ Put packet to FIFO queue """
-                if self.rx_queue.qsize() > self.rx_queue_size:
-                    self.rx_queue.get()
-                # byte->decimal->bit
-                data_bits = np.unpackbits(np.frombuffer(self.sock.recvfrom(10240)[0], dtype=np.uint8))
-                self.rx_queue.put_nowait(data_bits)
-                if self.verbose:
-                    # can be used to check if rx queue is processed timely
-                    print("[SocketRxQueue] RX queue size: {}".format(self.rx_queue.qsize()))
+                data = self.sock.recvfrom(10240)[0]
+            except socket.timeout:
+                continue
             except:
-                self.sock.close()
                 break
+            # byte->decimal->bit
+            data_bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+            """ Put packet to FIFO queue """
+            self.rx_queue.put_drop_oldest(data_bits)
+            if self.verbose:
+                # can be used to check if rx queue is processed timely
+                print("[SocketRxQueue] RX queue size: {}, ndrop={}".format(self.rx_queue.qsize(),
+                                                                          self.rx_queue.ndrop))
+        self.sock.close()
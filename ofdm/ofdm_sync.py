@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming packet synchronization.
+
+"""
+
+# compatibility of Python 2/3
+from __future__ import division
+from __future__ import print_function
+
+from builtins import object
+
+import numpy as np
+
+from ofdm.support import find_peaks, auto_correlation_metric, block_energy
+
+
+class OfdmSync(object):
+    """Streaming preamble detector based on the LTS matched filter or the STS auto-correlation
+
+    The matched filter and the energy normalization are computed by overlap-save over the stream:
+    trailing samples of the previous buffer are kept, so packets are found at exact positions even
+    when they straddle buffer boundaries.
+
+    Attributes:
+        preamble_lts: one period of the long training sequence (time domain)
+        lead_len: samples in front of the first LTS period (STS + LTS cyclic prefix)
+        packet_len: samples of a whole packet, preamble included
+        threshold: detection threshold of the normalized metric in [0, 1]
+        nfft: FFT size of the overlap-save blocks
+        multi: detect every packet of a buffer in one pass, otherwise one packet per pass, the search
+               resuming at the end of each detected packet until the buffer is exhausted
+        detector: 'cross' (LTS matched filter) or 'auto' (Schmidl-Cox auto-correlation of the STS,
+                  refined by the LTS matched filter around the STS plateau)
+        sample_count: absolute time (in samples) of the end of the stream received so far
+    """
+
+    def __init__(self, preamble_lts, lead_len, packet_len, threshold=0.7, nfft=512, multi=True,
+                 detector='cross', sts_period=16):
+        self.preamble_lts = np.asarray(preamble_lts)
+        self.lts_len = self.preamble_lts.size
+        self.corr_len = 2 * self.lts_len  # both LTS periods are combined in the metric
+        self.lead_len = lead_len
+        self.packet_len = packet_len
+        self.threshold = threshold
+        self.pn1 = np.real(np.vdot(self.preamble_lts, self.preamble_lts))
+
+        self.sample_count = 0
+        self._tail = np.zeros(0, dtype=complex)  # trailing samples, self._tail[-1] is at sample_count - 1
+        self._search_from = 0  # absolute position where the search resumes
+        self._pending = []  # absolute LTS positions of packets waiting for the rest of their samples
+        self.nfft = nfft
+        self.multi = multi
+        assert detector in ['cross', 'auto']
+        self.detector = detector
+        self.sts_period = sts_period
+        self.sts_window = 3 * sts_period
+        self.sts_threshold = 0.8
+        self.sts_plateau = 3 * sts_period
+        self.refine_len = self.lts_len // 2
+        self._spectrum = np.fft.fft(self.preamble_lts[::-1].conj(), nfft)  # cached matched filter spectrum
+
+    def reset(self, position=0):
+        """ restart the search at the absolute position, e.g. after samples were lost """
+        self.sample_count = position
+        self._tail = np.zeros(0, dtype=complex)
+        self._search_from = position
+        self._pending = []
+
+    def push(self, samples, search=True):
+        """ feed the next buffer of the stream
+        :param samples:     received samples
+        :param search:      False if the buffer is known to hold no preamble (e.g. closed squelch), it is
+                            then only kept for packets in progress and for a preamble starting at its end
+        :return:            list of (start, packet) of complete packets, start is the absolute position of
+                            the first LTS period and packet holds packet_len samples from the STS on
+        """
+        window = np.concatenate((self._tail, samples))
+        packets = self.push_window(window, self.sample_count - self._tail.size, search)
+        keep = min(window.size, max(self.sample_count - self.keep_from, self.corr_len))
+        self._tail = window[window.size - keep:]
+        return packets
+
+    def push_window(self, window, window_start, search=True):
+        """ same as push, for a caller that keeps the stream itself (e.g. in a SampleRing)
+        :param window:      the stream from window_start on, covering keep_from to the end of the new samples
+        :param window_start: absolute position of window[0]
+        :return:            list of (start, packet) of complete packets, packets are views of window
+        """
+        self.sample_count = window_start + len(window)
+
+        if search:
+            self._search(window, window_start)
+        else:
+            self._search_from = max(self._search_from, self.sample_count - self.lead_len)
+
+        packets = []
+        while self._pending and self._pending[0] - self.lead_len + self.packet_len <= self.sample_count:
+            start = self._pending.pop(0)
+            offset = start - self.lead_len - window_start
+            if offset >= 0:
+                packets.append((start, window[offset:offset + self.packet_len]))
+        return packets
+
+    @property
+    def keep_from(self):
+        """ absolute position of the oldest sample still needed by the search or by a pending packet """
+        return min([self._search_from] + self._pending) - self.lead_len - self.refine_len
+
+    @property
+    def busy(self):
+        """ True while a detected packet is waiting for the rest of its samples """
+        return len(self._pending) > 0
+
+    def metric(self, segment):
+        """ normalized matched filter output over both LTS periods
+        :return:    metric m[k] for the packet whose first LTS period starts at segment[k]
+        """
+        corr = self._correlate(segment)
+        c = np.sqrt(corr.real ** 2 + corr.imag ** 2)
+        energy = np.zeros(segment.size + 1)
+        np.cumsum(segment.real ** 2 + segment.imag ** 2, out=energy[1:])
+        e = energy[self.lts_len:] - energy[:-self.lts_len]
+        num = segment.size - self.corr_len + 1
+        c_sum = c[:num] + c[self.lts_len:self.lts_len + num]
+        e_sum = e[:num] + e[self.lts_len:self.lts_len + num]
+        return c_sum / np.sqrt(2 * self.pn1 * np.maximum(e_sum, 1e-20))
+
+    def _search(self, window, window_start):
+        while self._search_pass(window, window_start) and not self.multi:
+            pass
+
+    def _search_pass(self, window, window_start):
+        """ search the window from _search_from on, queue the packets found
+        :return:            # of packets found
+        """
+        # positions are those of the first LTS period; the auto-correlation detector also needs the STS
+        # in front of them
+        lead = self.lead_len + self.refine_len if self.detector == 'auto' else 0
+        begin = max(self._search_from - lead - window_start, 0)
+        segment = window[begin:]
+        offset = window_start + begin
+        if self.detector == 'auto':
+            peaks, last = self._auto_correlation_peaks(segment)
+        else:
+            peaks, last = self._cross_correlation_peaks(segment)
+        if last <= 0:
+            return 0
+        peaks = peaks[(peaks < last) & (offset + peaks >= self._search_from)]
+        self._search_from = offset + last
+        if peaks.size > 0:
+            if not self.multi:
+                # the next pass resumes at the end of this packet
+                peaks = peaks[:1]
+                self._search_from = offset
+            self._search_from = max(self._search_from, offset + peaks[-1] + self.packet_len - self.lead_len)
+        self._pending.extend(int(peak) for peak in offset + peaks)
+        return peaks.size
+
+    def _cross_correlation_peaks(self, segment):
+        # a peak is only accepted once the following corr_len positions are known, so that the
+        # partial match of the LTS cyclic prefix is never taken for the packet
+        if segment.size < 2 * self.corr_len:
+            return None, 0
+        m = self.metric(segment)
+        peaks = find_peaks(m, self.corr_len, self.threshold, self.packet_len - self.lead_len)
+        return peaks, m.size - self.corr_len
+
+    def _auto_correlation_peaks(self, segment):
+        # the STS plateau gives a coarse position, refined by the LTS metric over +-refine_len samples
+        last = segment.size - self.refine_len - self.corr_len
+        if last <= self.lead_len:
+            return None, 0
+        m = auto_correlation_metric(segment, self.sts_period, self.sts_window)
+        starts = find_peaks(m, self.sts_period, self.sts_threshold, self.packet_len - self.lead_len,
+                            left=True, min_len=self.sts_plateau)
+        peaks = []
+        for coarse in starts + self.lead_len:
+            if coarse >= last:
+                break
+            lo = max(coarse - self.refine_len, 0)
+            peaks.append(lo + int(np.argmax(self.metric(segment[lo:coarse + self.refine_len + self.corr_len]))))
+        return np.array(peaks, dtype=int), last
+
+    def _correlate(self, segment):
+        """ overlap-save FFT correlation with the LTS, valid part only """
+        step = self.nfft - self.lts_len + 1
+        num = segment.size - self.lts_len + 1
+        block_num = -(-num // step)
+        padded = np.zeros(block_num * step + self.lts_len - 1, dtype=complex)
+        padded[:segment.size] = segment
+        blocks = np.lib.stride_tricks.as_strided(padded, (block_num, self.nfft),
+                                                 (step * padded.itemsize, padded.itemsize))
+        full = np.fft.ifft(np.fft.fft(blocks, axis=1) * self._spectrum, axis=1)
+        return full[:, self.lts_len - 1:].ravel()[:num]
+
+
+class OfdmSquelch(object):
+    """Energy gate in front of the preamble search
+
+    A buffer opens the gate when the energy of one of its blocks rises threshold_db above the noise floor.
+    The noise floor drops at once to the quietest block of any buffer and rises slowly toward the mean block
+    energy of gated buffers and the quiet blocks of open ones. A floor taken from a transmission already on
+    air when the receiver starts comes down at its first pause, and until then every max_gated-th buffer
+    in a row is searched anyway, so the gate fails open rather than closed.
+
+    Attributes:
+        block_len: samples per energy block
+        threshold_db: energy rise that opens the gate
+        alpha: forgetting factor of the noise floor
+        max_gated: gated buffers in a row before one is searched anyway
+        noise_floor: mean energy per sample of the noise
+        ngated: number of buffers skipped
+        nsearched: number of buffers passed to the preamble search
+        nforced: number of them searched only because max_gated buffers in a row were skipped
+    """
+
+    def __init__(self, block_len=80, threshold_db=6.0, alpha=0.05, max_gated=20):
+        self.block_len = block_len
+        self.threshold_db = threshold_db
+        self.alpha = alpha
+        self.max_gated = max_gated
+        self.noise_floor = None
+        self.ngated = 0
+        self.nsearched = 0
+        self.nforced = 0
+        self._run = 0  # buffers gated in a row
+
+    def check(self, samples):
+        """ return True if the buffer has to be searched for a preamble """
+        energy = block_energy(samples, self.block_len)
+        quietest = np.min(energy)
+        if self.noise_floor is None or quietest < self.noise_floor:
+            self.noise_floor = quietest
+        threshold = self.noise_floor * 10 ** (self.threshold_db / 10)
+        is_open = np.max(energy) > threshold
+        if is_open:
+            if quietest < threshold:
+                self.noise_floor = (1 - self.alpha) * self.noise_floor + self.alpha * quietest
+        else:
+            self.noise_floor = (1 - self.alpha) * self.noise_floor + self.alpha * np.mean(energy)
+            if self._run >= self.max_gated:
+                is_open = True
+                self.nforced += 1
+        if is_open:
+            self._run = 0
+            self.nsearched += 1
+        else:
+            self._run += 1
+            self.ngated += 1
+        return is_open
@@ -8,15 +8,16 @@
 from __future__ import division
 from __future__ import print_function
 
+import queue
 import socket
 import sys
 import threading
-from multiprocessing import Manager
 
 import numpy as np
 
 sys.path.append('..')
 
+from ofdm.ofdm_queue import make_queue
 from ofdm.ofdm_utils import OfdmConfig
 from ofdm.pluto_interface import pluto_transmitter
 
@@ -24,7 +25,7 @@ from ofdm.pluto_interface import pluto_transmitter
 class OfdmTx(object):
     def __init__(self, tx_type, tx_args,
                  n=64, cp_len=16, qam_mod_size=2, pilot_pattern='custom', preamble_type='802.11', num_symbol=100,
-                 verbose=False):
+                 verbose=False, queue_type='thread', coding=None):
         """ OFDM transmitter
         :param tx_type:             'pluto', 'socket'
         :param tx_args:             including parameters below
@@ -39,99 +40,186 @@ class OfdmTx(object):
         :param preamble_type:       only '802.11' is supported
         :param num_symbol:          the number of ofdm symbols
         :param verbose:             print PHY-layer info
+        :param queue_type:          'thread', 'shm' or 'manager', see ofdm.ofdm_queue.make_queue
+        :param coding:              None, 'conv-1/2', 'conv-2/3' or 'conv-3/4', see ofdm.ofdm_coding
         """
         # Tx params
-        self.tx_queue = Manager().Queue()  # thread safe
         self.tx_queue_size = 20
+        # samples of a packet (preamble of 4 OFDM symbols) or its bits, whichever is larger; the queue is
+        # bounded, a full queue blocks put() instead of dropping frames
+        self.tx_queue = make_queue(queue_type, self.tx_queue_size,
+                                   (num_symbol + 4) * (n + cp_len) * 16)  # thread safe
         self.tx_type = tx_type
         if self.tx_type == "pluto":
             tx_ipaddr, tx_freq, bandwidth, tx_gain = tx_args
             sdr_tx = pluto_transmitter(tx_ipaddr, tx_freq, bandwidth, tx_gain, verbose=True).pluto
             self.tx_sample_queue_watcher_thread = tx_sample_queue_watcher_thread(sdr_tx,
                                                                                  self.tx_queue,
-                                                                                 self.tx_queue_size,
                                                                                  verbose=verbose)
         elif self.tx_type == "socket":
             tx_ipaddr, tx_port = tx_args
             self.tx_packet_queue_watcher_thread = tx_packet_queue_watcher_thread(tx_ipaddr, tx_port,
                                                                                  self.tx_queue,
-                                                                                 self.tx_queue_size,
                                                                                  verbose=verbose)
         else:
             raise ValueError("Invalid tx type.")
 
         # OFDM params
-        self.ofdm_config = OfdmConfig(n, cp_len, qam_mod_size, pilot_pattern)  # type: OfdmConfig
+        self.ofdm_config = OfdmConfig(n, cp_len, qam_mod_size, pilot_pattern, coding=coding)  # type: OfdmConfig
         self.preamble_type = preamble_type
         self.num_symbol = num_symbol
-        self.packet_bit_size = 48 * num_symbol
+        self.packet_bit_size = self.ofdm_config.packet_bit_size(num_symbol)
         self.verbose = verbose
+        self.tx_scale = 2 ** 14  # amplitude of the samples for the DAC of the PlutoSDR device
+        self.plans = {}  # {(# of OFDM symbols, is_with_preamble): OfdmTxPlan}
 
-    def put(self, bin_message):
-        """ interface for upper layers """
+    def done(self):
+        """ stop the transmitter once the packets queued are sent, and release its queue; the upper layer
+        no longer calls put()
+        """
         if self.tx_type == "pluto":
-            self.tx_queue.put(self.process(bin_message) * (2 ** 14))
-        elif self.tx_type == "socket":
-            # put packet for socket
-            self.tx_queue.put(bin_message)
+            watcher = self.tx_sample_queue_watcher_thread
+        else:
+            watcher = self.tx_packet_queue_watcher_thread
+        watcher.done()
+        watcher.join()
+        self.tx_queue.close()
+
+    def put(self, bin_message, block=True, timeout=None):
+        """ interface for upper layers
+        :param bin_message:     bits of the frame, or its bytes (bytes, bytearray or memoryview, MSB first)
+        :param block:           wait for room in the tx queue, otherwise fail at once if it is full
+        :param timeout:         longest wait in seconds when blocking, None waits until there is room
+        :return:                True if the frame is queued, False if the tx queue stayed full (the frame
+                                is not sent, counted in tx_queue.noverflow)
+        """
+        if self.tx_type == "pluto":
+            item = self.process(bin_message)
+        else:
+            # put packet for socket, the datagram bytes
+            if isinstance(bin_message, (bytes, bytearray, memoryview)):
+                item = np.frombuffer(bin_message, dtype=np.uint8)
+            else:
+                item = np.packbits(bin_message)
+        try:
+            self.tx_queue.put(item, block, timeout)
+        except queue.Full:
+            if self.verbose:
+                print("[OfdmTx] TX queue full: noverflow={}".format(self.tx_queue.noverflow))
+            return False
+        return True
 
     def process(self, bin_message, is_with_preamble=True):
         """ Calculate the time-domain samples to be transmitted
+        :return:    complex64 samples scaled by tx_scale for the PlutoSDR DAC; the array belongs to the
+                    modulation plan and is reused tx_queue_size + 2 frames later
         """
-        # TODO
-        encoded = bin_message
-        # zero-padding the encoded to fill a multiple of OFDM symbols
-        encoded = np.concatenate((encoded, np.zeros(
-            (self.ofdm_config.n_cbps - encoded.size % self.ofdm_config.n_cbps) % self.ofdm_config.n_cbps, dtype=int)))
-        assert encoded.size % self.ofdm_config.n_cbps == 0
+        if isinstance(bin_message, (bytes, bytearray, memoryview)):
+            # frames travel as bytes down to here, the bits are unpacked at the modulator input only
+            bin_message = np.unpackbits(np.frombuffer(bin_message, dtype=np.uint8))
+        # the OFDM symbol number that can hold the frame and the tail bits of the coding, zero-padded
+        sym_num = self.ofdm_config.symbols_for_bits(bin_message.size)
+        if self.ofdm_config.coding:
+            bin_message = self.ofdm_config.coding.encode(bin_message, sym_num)
+        key = (sym_num, is_with_preamble)
+        if key not in self.plans:
+            self.plans[key] = OfdmTxPlan(self.ofdm_config, sym_num, is_with_preamble, self.tx_scale,
+                                         self.tx_queue_size + 2)
+        return self.plans[key].build(bin_message)
 
-        """ QAM Modulation """
-        modulated = self.ofdm_config.qam_mod.modulate(encoded) / self.ofdm_config.qam_mod.qam_max_axis
-        modulated_len = modulated.size
-
-        """ frequency domain: fill in data and pilots """
-        ofdm_sym_num = self.ofdm_config.how_many_symbols(modulated_len)  # the OFDM symbol number that can hold the data
-        all_sc = np.zeros((self.ofdm_config.n, ofdm_sym_num), dtype=complex)
-        pilot_index_array, data_index_array = self.ofdm_config.ofdm_pilot.get_index_array_at_symbol(
-            np.array(range(0, ofdm_sym_num)))
-        all_sc[pilot_index_array] = self.ofdm_config.training_signal_freq[pilot_index_array[0]]
-        all_sc[data_index_array] = np.concatenate(
-            (modulated, np.zeros(len(data_index_array[0]) - modulated_len, dtype=complex)))
-
-        """ IFFT: freq domain to time domain """
-        time_symbols = np.fft.ifft(all_sc, n=self.ofdm_config.n, axis=0)
-
-        """ cyclic prefix (CP) """
-        time_symbols_cp = np.concatenate((time_symbols[-self.ofdm_config.cp_len:, :], time_symbols), axis=0)
-        # serialization
-        ofdm_symbols = np.reshape(time_symbols_cp, (self.ofdm_config.sym_len * ofdm_sym_num,), order='F')
-
-        """ packet format: preamble + OFDM symbols
-        10 STS + 2 LTS as the preamble
+
+class OfdmTxPlan(object):
+    """Modulation plan of the frames of one geometry
+
+    Everything that does not depend on the frame bits is computed once: the subcarrier indices, the
+    scaled constellation and pilots, the preamble, and a ring of output buffers holding the preamble
+    already. Building a frame is then a symbol lookup, a scatter onto the subcarriers, one batched IFFT
+    and an in-place copy of the cyclic prefix.
+
+    A buffer handed out by build() is only overwritten nbuf calls later, so a bounded tx queue of
+    nbuf - 2 packets never sees its content change.
+
+    Attributes:
+        sym_num: number of OFDM symbols of a frame
+        bit_num: number of data bits the frame holds
+        frame_len: number of samples of a frame
+    """
+
+    def __init__(self, ofdm_config, sym_num, is_with_preamble=True, scale=1, nbuf=1):
+        """
+        :param ofdm_config:         OfdmConfig of the transmitter
+        :param sym_num:             number of OFDM symbols of a frame
+        :param is_with_preamble:    put the 10 STS + 2 LTS preamble in front of the symbols
+        :param scale:               amplitude of the output (e.g. 2 ** 14 for the PlutoSDR DAC)
+        :param nbuf:                number of output buffers used in turn
+        """
+        config = ofdm_config  # type: OfdmConfig
+        qam_mod = config.qam_mod
+        self.sym_num = sym_num
+        self.n = config.n
+        self.cp_len = config.cp_len
+        self.point_num = sym_num * config.data_sc_num  # constellation points per frame
+        self.bit_num = self.point_num * qam_mod.bit_num
+        self.bit_powers = qam_mod.bit_powers.ravel()
+        self.constellation = qam_mod.gray_to_constel * (scale / qam_mod.qam_max_axis)
+        if qam_mod.bit_num == 1:
+            self.constellation = np.array([-scale, scale], dtype=complex)
+
+        self.pilot_index, self.data_index = config.pilot_sc_index, config.data_sc_index
+        self._grid = np.zeros((sym_num, config.n), dtype=complex)
+        self._grid[:, self.pilot_index] = config.training_signal_freq[self.pilot_index] * scale
+        self._bits = np.zeros(self.bit_num, dtype=int)
+        self._points = np.zeros(self.point_num, dtype=complex)
+
+        preamble = config.preamble * scale if is_with_preamble else np.zeros(0)
+        self.preamble_len = preamble.size
+        self.frame_len = self.preamble_len + sym_num * config.sym_len
+        self._out = np.zeros((nbuf, self.frame_len), dtype=np.complex64)
+        self._out[:, :self.preamble_len] = preamble
+        self._next = 0
+
+    def build(self, bits):
+        """ modulate the bits of a frame, zero-padded to the frame size
+        :return:    the samples of the frame (a view of the next output buffer)
         """
-        if is_with_preamble:
-            tx_packet = np.concatenate((self.ofdm_config.preamble, ofdm_symbols))
+        bits = np.asarray(bits).ravel()
+        num = bits.size
+        assert num <= self.bit_num
+        self._bits[:num] = bits
+        self._bits[num:] = 0
+
+        """ QAM Modulation """
+        bits_per_point = self.bit_powers.size
+        if bits_per_point == 1:
+            index = self._bits
         else:
-            tx_packet = ofdm_symbols
+            index = self._bits.reshape(-1, bits_per_point) @ self.bit_powers
+        np.take(self.constellation, index, out=self._points)
 
-        assert tx_packet.size % self.ofdm_config.sym_len == 0
+        """ frequency domain: fill in data, pilots are already in place """
+        self._grid[:, self.data_index] = self._points.reshape(self.sym_num, -1)
 
-        return tx_packet
+        """ IFFT: freq domain to time domain, then the cyclic prefix (CP) """
+        out = self._out[self._next]
+        self._next = (self._next + 1) % self._out.shape[0]
+        symbols = out[self.preamble_len:].reshape(self.sym_num, self.cp_len + self.n)
+        symbols[:, self.cp_len:] = np.fft.ifft(self._grid, axis=1)
+        symbols[:, :self.cp_len] = symbols[:, self.n:]
+        return out
 
 
 class tx_sample_queue_watcher_thread(threading.Thread):
-    """ TX Sample Queue Monitor
+    """ TX Sample Queue Monitor, sends the queued packets in order and sleeps while the queue is empty
     """
 
-    # TODO
-    def __init__(self, sdr_tx, tx_queue, tx_queue_size, verbose=False):
+    def __init__(self, sdr_tx, tx_queue, verbose=False, poll_interval=0.5):
         threading.Thread.__init__(self)
         self.setDaemon(True)
         self.sdr_tx = sdr_tx
         self.ntx = 0
         self.tx_queue = tx_queue
-        self.tx_queue_size = tx_queue_size
         self.verbose = verbose
+        self.poll_interval = poll_interval  # how often keep_running is checked while idle
         self.keep_running = True
         self.start()
 
@@ -139,24 +227,28 @@ class tx_sample_queue_watcher_thread(threading.Thread):
         self.keep_running = False
 
     def run(self):
-        while self.keep_running:
+        # after done() the packets still queued are sent before the thread ends
+        while True:
+            try:
+                samples = self.tx_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if not self.keep_running:
+                    break
+                continue
             try:
-                if self.tx_queue.qsize() > self.tx_queue_size:
-                    self.tx_queue.get()
-                if not self.tx_queue.empty():
-                    self.sdr_tx.tx(self.tx_queue.get())
-                    if self.verbose:
-                        self.ntx += 1
-                        print("[PlutoTx] TX: ntx={}".format(self.ntx))
+                self.sdr_tx.tx(samples)
             except:
                 break
+            self.ntx += 1
+            if self.verbose:
+                print("[PlutoTx] TX: ntx={}".format(self.ntx))
 
 
 class tx_packet_queue_watcher_thread(threading.Thread):
-    """ TX UDP Packet Queue Monitor
+    """ TX UDP Packet Queue Monitor, sends the queued packets in order and sleeps while the queue is empty
     """
 
-    def __init__(self, tx_ipaddr, tx_port, tx_queue, tx_queue_size, verbose=False):
+    def __init__(self, tx_ipaddr, tx_port, tx_queue, verbose=False, poll_interval=0.5):
         threading.Thread.__init__(self)
         self.setDaemon(True)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -164,8 +256,8 @@ class tx_packet_queue_watcher_thread(threading.Thread):
         self.tx_port = tx_port
         self.ntx = 0
         self.tx_queue = tx_queue
-        self.tx_queue_size = tx_queue_size
         self.verbose = verbose
+        self.poll_interval = poll_interval  # how often keep_running is checked while idle
         self.keep_running = True
         self.start()
 
@@ -173,17 +265,21 @@ class tx_packet_queue_watcher_thread(threading.Thread):
         self.keep_running = False
 
     def run(self):
-        while self.keep_running:
+        # after done() the packets still queued are sent before the thread ends
+        while True:
+            try:
+                packed = self.tx_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if not self.keep_running:
+                    break
+                continue
             try:
-                if self.tx_queue.qsize() > self.tx_queue_size:
-                    self.tx_queue.get()
-                if not self.tx_queue.empty():
-                    # bit->decimal->byte
-                    data_bytes = bytes(np.packbits(self.tx_queue.get()))
-                    self.sock.sendto(data_bytes, (self.tx_ipaddr, self.tx_port))
-                    if self.verbose:
-                        self.ntx += 1
-                        print("[SocketTx] TX: ntx={}".format(self.ntx))
+                # bits packed into bytes by OfdmTx.put
+                data_bytes = packed.tobytes()
+                self.sock.sendto(data_bytes, (self.tx_ipaddr, self.tx_port))
             except:
-                self.sock.close()
                 break
+            self.ntx += 1
+            if self.verbose:
+                print("[SocketTx] TX: ntx={}".format(self.ntx))
+        self.sock.close()
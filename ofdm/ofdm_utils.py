@@ -13,6 +13,7 @@ from builtins import object
 import numpy as np
 
 from ofdm.gray_qammod import GrayQamMod
+from ofdm.ofdm_coding import make_coding
 
 
 class OfdmConfig(object):
@@ -24,9 +25,10 @@ class OfdmConfig(object):
         f_s: sampling frequency
         qam_mod_size: size of the constellation of QAM modulation
         pilot_pattern: 'comb', 'staggered'
+        coding: channel coding between the frame bits and the QAM mapper, see ofdm.ofdm_coding.make_coding
     """
 
-    def __init__(self, n, cp_len, qam_mod_size, pilot_pattern, pilot_num=None):
+    def __init__(self, n, cp_len, qam_mod_size, pilot_pattern, pilot_num=None, coding=None):
         assert (np.log2(n) % 1) < 1e-10
         self.n = n
         self.cp_len = cp_len
@@ -74,7 +76,10 @@ class OfdmConfig(object):
 
         self.pilot_sc_index, self.data_sc_index = self.ofdm_pilot.get_pilot_and_data_index_at_symbol(0)
         self.pilot_sc_num, self.data_sc_num = self.ofdm_pilot.get_pilot_data_sc_num()
-        self.n_cbps = self.data_sc_num
+        self.n_cbps = self.data_sc_num * self.qam_mod.bit_num  # coded bits per OFDM symbol
+        self.coding = make_coding(coding, self.n_cbps, self.qam_mod.bit_num)
+        self.n_dbps = self.coding.n_dbps if self.coding else self.n_cbps  # data bits per OFDM symbol
+        self.tail_len = self.coding.tail_len if self.coding else 0  # bits of a packet used by the coding
 
     @staticmethod
     def _generate_freq_ref_signal(n, pilot_pattern, pilot_num=None,
@@ -105,6 +110,14 @@ class OfdmConfig(object):
     def how_many_symbols(self, data_point_num):
         return self.ofdm_pilot.how_many_symbols(data_point_num)
 
+    def packet_bit_size(self, sym_num):
+        """ frame bits carried by a packet of sym_num OFDM symbols """
+        return sym_num * self.n_dbps - self.tail_len
+
+    def symbols_for_bits(self, bit_num):
+        """ OFDM symbols of the packet of a frame of bit_num bits """
+        return -(-(bit_num + self.tail_len) // self.n_dbps)
+
 
 class OfdmPilot(object):
     def __init__(self, pilot_prototype, pilot_prototype_index, pilot_num):
@@ -36,7 +36,33 @@ def findindex(m, windowsize, model, sigma):
         return None
 
 
-def detect_preamble_cross_correlation(preamble, signal):
+def find_peaks(m, windowsize, sigma, min_distance, left=False, min_len=1):
+    """ pick the peaks of a detection metric
+    positions above sigma are clustered as in findindex (a gap of windowsize starts a new cluster),
+    the maximum (or the left edge) of each cluster is a peak and peaks closer than min_distance
+    to an earlier one are dropped
+    :param min_len:     clusters with fewer positions above sigma are ignored
+    :return:            sorted array of peak positions
+    """
+    index = np.nonzero(m > sigma)[0]
+    starts = np.concatenate(([0], np.nonzero(np.diff(index) >= windowsize)[0] + 1))
+    ends = np.concatenate((starts[1:], [index.size]))
+    keep = (ends - starts) >= min_len
+    starts, ends = starts[keep], ends[keep]
+    if starts.size == 0:
+        return np.array([], dtype=int)
+    if left:
+        peaks = index[starts]
+    else:
+        peaks = [index[a + np.argmax(m[index[a:b]])] for a, b in zip(starts, ends)]
+    picked = [peaks[0]]
+    for peak in peaks[1:]:
+        if peak - picked[-1] >= min_distance:
+            picked.append(peak)
+    return np.array(picked)
+
+
+def detect_preamble_cross_correlation(preamble, signal, multi=False, min_distance=None):
     len1 = len(preamble)
     len2 = len(signal)
     pn1 = sum(preamble * preamble.conj())
@@ -49,63 +75,76 @@ def detect_preamble_cross_correlation(preamble, signal):
     # plt.plot(range(len(m)), m, 'b')
     # plt.title("cross correlation")
     # plt.show()
+    if multi:
+        return [int(i) for i in find_peaks(m, len1, 0.7, min_distance or len1)]
     if max_v > 0.7:
         return np.argmax(m)
     else:
         return None
 
 
+def running_sum(x, window):
+    """ sums of every window of consecutive samples, O(N) by a cumulative sum """
+    cum = np.zeros(len(x) + 1, dtype=np.result_type(x, float))
+    np.cumsum(x, out=cum[1:])
+    return cum[window:] - cum[:-window]
+
+
+def auto_correlation_metric(signal, lag, window):
+    """ normalized delayed auto-correlation (Schmidl-Cox) of every window, O(N) by running sums
+    :return:    m[k] = |sum r*[n] r[n+lag]| / sqrt(sum |r[n]|^2 * sum |r[n+lag]|^2), n in [k, k+window)
+    """
+    c = np.abs(running_sum(signal[:-lag].conj() * signal[lag:], window))
+    e = running_sum(signal.real ** 2 + signal.imag ** 2, window)
+    return c / np.sqrt(np.maximum(e[:c.size] * e[lag:lag + c.size], 1e-20))
+
+
 def detect_preamble_auto_correlation(signal, short_preamble_len):
-    L = short_preamble_len
-    c = np.zeros((signal.shape[0], 1))
-    p = np.zeros((signal.shape[0], 1))
-    for k in range(signal.shape[0] - L - 1 - short_preamble_len):
-        c[k] = numpy.absolute(np.dot(signal[k:k + short_preamble_len], signal[k + L:k + L + short_preamble_len].conj()))
-        p[k] = np.sum(numpy.absolute(signal[k:k + short_preamble_len]) ** 2) * np.sum(
-            numpy.absolute(signal[k + L:k + L + short_preamble_len].conj()) ** 2)
-        # p[k]=np.sum(numpy.absolute(signal[k:k+L])**2)
-    m = c[:signal.shape[0] - L - 1 - short_preamble_len] / np.sqrt(p[:signal.shape[0] - L - 1 - short_preamble_len])
-    ##递归算法
-    # c=np.zeros((signal.shape[0],1),dtype=complex)
-    # p=np.zeros((signal.shape[0],1))
-    # c[0]=np.dot(signal[0:short_preamble_len],signal[L:2*L].conj())
-    # for k in range(signal.shape[0]-2*L):
-    #     c[k+1]=c[k]+signal[k+L]*signal[k+2*L].conj()-signal[k]*signal[k+L].conj()
-    #     p[k]=np.sum(numpy.absolute(signal[k:k+short_preamble_len])**2)*np.sum(numpy.absolute(signal[k+L:k+L+short_preamble_len].conj())**2)
-    # m=numpy.absolute(c[:signal.shape[0]-2*L])/np.sqrt(p[:signal.shape[0]-2*L])
-    pyplot.plot(m)
-    pyplot.show()
+    m = auto_correlation_metric(signal, short_preamble_len, short_preamble_len)
     return findindex(m, 160, 1, 0.95)
 
 
-def detect_preamble_by_energy(signal):
-    # L=20
-    np.zeros((signal.shape[0], 1))
-    # for k in range(signal.shape[0]-1):
-    #     c[k]=numpy.absolute(np.dot(signal[k:k+L],signal[k:k+L].conj()))
-    #     c[k]=np.sum(numpy.absolute(signal[k:k+L])**2)
-    c = numpy.absolute(signal) ** 2
-    # c=c/(np.sum(signal-np.mean(signal))**2)
-    # c=(c-min(c))/(max(c)-min(c))
-    pyplot.plot(c)
-    pyplot.show()
-    return findindex(c, 160, 1, 200000)
+def detect_preamble_schmidl_cox(signal, period=16, window=48, threshold=0.8, plateau=48, min_distance=160):
+    """ find the STS by its periodicity, CFO tolerant and O(N)
+    :param signal:          received samples
+    :param period:          period of the short training sequence
+    :param window:          correlation window
+    :param threshold:       threshold of the normalized metric in [0, 1]
+    :param plateau:         minimum number of positions above threshold to accept a plateau
+    :param min_distance:    minimum distance between two packets
+    :return:                list of the plateau starts, i.e. the coarse STS positions
+    """
+    m = auto_correlation_metric(signal, period, window)
+    return [int(i) for i in find_peaks(m, period, threshold, min_distance, left=True, min_len=plateau)]
+
+
+def block_energy(signal, block_len):
+    """ mean energy per sample of every block of block_len samples, a shorter last block included """
+    power = signal.real ** 2 + signal.imag ** 2
+    full = power.size // block_len * block_len
+    energy = np.mean(np.reshape(power[:full], (-1, block_len)), axis=1)
+    if full < power.size:
+        energy = np.append(energy, np.mean(power[full:]))
+    return energy
+
+
+def detect_preamble_by_energy(signal, sigma=200000, window=16):
+    c = running_sum(signal.real ** 2 + signal.imag ** 2, window) / window
+    return findindex(c, 160, 1, sigma)
 
 
 def detect_preamble_by_sliding_window(signal, short_preamble_len):
-    c = np.zeros((signal.shape[0], 1))
-    d = np.zeros((signal.shape[0], 1))
-    for k in range(signal.shape[0] - 2 * short_preamble_len):
-        # c[k]=np.dot(signal[k:k+short_preamble_len],signal[k:k+short_preamble_len].conj())
-        c[k] = np.sum(numpy.absolute(signal[k:k + short_preamble_len]) ** 2)
-        d[k] = np.sum(numpy.absolute(signal[k + short_preamble_len:k + 2 * short_preamble_len]) ** 2)
-        # d[k]=np.dot(signal[k+short_preamble_len:k+2*short_preamble_len],signal[k+short_preamble_len:k+2*short_preamble_len].conj())
-    m = d[:signal.shape[0] - 2 * short_preamble_len] / c[:signal.shape[0] - 2 * short_preamble_len]
-    pyplot.plot(m)
-    pyplot.show()
+    e = running_sum(signal.real ** 2 + signal.imag ** 2, short_preamble_len)
+    m = e[short_preamble_len:] / np.maximum(e[:-short_preamble_len], 1e-20)
     return list(np.asarray(findindex(m, 160, 0, 5)) + short_preamble_len)
 
 
+def coarse_cfo_estimation(rx_samples_sts, period=16):
+    """ estimate CFO from the periodicity of the short training sequence, range +-1/(2*period) """
+    sts_corr = np.vdot(rx_samples_sts[:-period], rx_samples_sts[period:])
+    return np.angle(sts_corr) / (2 * np.pi) / period
+
+
 def cfo_estimation(rx_samples_lts):
     preamble_lts_1 = rx_samples_lts[0:63]
     preamble_lts_2 = rx_samples_lts[64:127]
@@ -139,6 +178,91 @@ def detfcount(rx_samples_data, h_tilde, sym_num, pilot_index, data_index):
     return demod, phase
 
 
+def ofdm_equalization(rx_samples_data, h_tilde, sym_num, pilot_index, data_index, n=64, cp_len=16):
+    """ equalize a whole packet at once: strip CP, 2-D FFT, channel and pilot phase correction
+    :param rx_samples_data:     time-domain samples of the data symbols, at least sym_num * (n + cp_len) long
+    :param h_tilde:             channel estimate of the n subcarriers
+    :param sym_num:             the number of ofdm symbols
+    :param pilot_index:         pilot subcarrier indices
+    :param data_index:          data subcarrier indices, in the order the data are arranged
+    :return:                    equalized data subcarriers of shape (sym_num, len(data_index)),
+                                pilot phase of shape (sym_num, n)
+    """
+    rx_freq, phase = _equalize(rx_samples_data, h_tilde, sym_num, pilot_index, n, cp_len)
+    data_index = np.asarray(data_index)
+    rx_data_freq = rx_freq[:, data_index] * np.exp(-1j * phase[:, data_index])
+    return rx_data_freq, phase
+
+
+def _equalize(rx_samples_data, h_tilde, sym_num, pilot_index, n, cp_len):
+    """ channel-equalized subcarriers of every symbol and the pilot phase to remove from them """
+    sym_len = n + cp_len
+    pilot_index = np.asarray(pilot_index)
+    rx_symbols = np.reshape(rx_samples_data[:sym_num * sym_len], (sym_num, sym_len))[:, cp_len:]
+    rx_freq = np.fft.fft(rx_symbols, n, axis=1) / np.reshape(h_tilde, (1, n))
+
+    # fit a line y=ax+b to the unwrapped pilot phases of every symbol
+    detf = np.unwrap(np.angle(rx_freq[:, pilot_index]), discont=np.pi / 2, axis=1, period=np.pi)
+    x = pilot_index - np.mean(pilot_index)
+    a = detf @ x / np.dot(x, x)
+    b = np.mean(detf, axis=1) - a * np.mean(pilot_index)
+    phase = np.outer(a, np.arange(n)) + b[:, np.newaxis]
+    return rx_freq, phase
+
+
+def noise_variance(rx_pilot_freq, pilot_values, h_tilde, pilot_index, data_index):
+    """ per-subcarrier noise variance of the equalized data subcarriers
+    The noise power at the receiver input is measured on the pilots (error of the equalized and phase
+    corrected pilots, weighted back by the channel gain); equalization divides it by |H|^2 per subcarrier.
+    :param rx_pilot_freq:       equalized, phase-corrected pilots of shape (sym_num, len(pilot_index))
+    :param pilot_values:        transmitted pilot values
+    :param h_tilde:             channel estimate of the n subcarriers
+    :return:                    noise variance of the data subcarriers, shape (len(data_index),)
+    """
+    h_power = np.abs(np.ravel(h_tilde)) ** 2
+    error = rx_pilot_freq - np.reshape(pilot_values, (1, -1))
+    noise_power = np.mean((error.real ** 2 + error.imag ** 2) * h_power[np.asarray(pilot_index)])
+    return np.maximum(noise_power, 1e-12) / np.maximum(h_power[np.asarray(data_index)], 1e-12)
+
+
+def ofdm_demodulation(rx_samples_data, h_tilde, sym_num, pilot_index, data_index, n=64, cp_len=16, qam_mod=None):
+    """ vectorized replacement of detfcount, hard decision of a whole packet
+    :param qam_mod:             GrayQamMod of the transmitter, None for BPSK
+    :return:                    bits of shape (sym_num * len(data_index) * bits per point, 1), pilot phase
+    """
+    rx_data_freq, phase = ofdm_equalization(rx_samples_data, h_tilde, sym_num, pilot_index, data_index, n, cp_len)
+    if qam_mod is None:
+        demod = (rx_data_freq.real > 0).astype(np.uint8)
+    else:
+        demod = qam_mod.demodulate(rx_data_freq)
+    return demod.reshape((-1, 1)), phase
+
+
+def ofdm_soft_demodulation(rx_samples_data, h_tilde, sym_num, pilot_index, data_index, pilot_values, n=64,
+                           cp_len=16, qam_mod=None, dtype=np.float32):
+    """ soft decision of a whole packet: per-bit log-likelihood ratios, in the order of ofdm_demodulation
+    :param pilot_values:        transmitted pilot values, for the noise variance estimate
+    :param qam_mod:             GrayQamMod of the transmitter, None for BPSK
+    :param dtype:               np.float32 or np.float16
+    :return:                    LLRs log(P(b=1)/P(b=0)) of shape (sym_num * len(data_index) * bits per point, 1),
+                                noise variance of the data subcarriers, pilot phase
+    """
+    rx_freq, phase = _equalize(rx_samples_data, h_tilde, sym_num, pilot_index, n, cp_len)
+    data_index, pilot_index = np.asarray(data_index), np.asarray(pilot_index)
+    rx_data_freq = rx_freq[:, data_index] * np.exp(-1j * phase[:, data_index])
+    rx_pilot_freq = rx_freq[:, pilot_index] * np.exp(-1j * phase[:, pilot_index])
+    noise_var = noise_variance(rx_pilot_freq, pilot_values, h_tilde, pilot_index, data_index)
+    # both output types are computed in float32, then clipped to the range of the output type
+    rx_data_freq = rx_data_freq.astype(np.complex64)
+    if qam_mod is None:
+        llr = 4 * rx_data_freq.real / noise_var.astype(np.float32)
+    else:
+        llr = qam_mod.llr(rx_data_freq, noise_var)
+    limit = np.finfo(dtype).max
+    llr = np.clip(llr, -limit, limit, out=llr).astype(dtype, copy=False)
+    return llr.reshape((-1, 1)), noise_var, phase
+
+
 def bpsk_demodulation(rx_samples_data, h_tilde, sym_num, data_index):
     demod = np.zeros((48 * sym_num, 1), dtype=complex)
     for symi in range(sym_num):
@@ -195,13 +319,12 @@ def qpsk_demodulation(rx_samples_data, h_tilde, sym_num, pilot_index, data_index
 
 
 def channel_estimation(preamble_lts, index, lts_frequency):
-    preamble_lts_1 = preamble_lts[0:63]
-    preamble_lts_2 = preamble_lts[64:127]
+    preamble_lts_1 = preamble_lts[0:64]
+    preamble_lts_2 = preamble_lts[64:128]
     preamble_lts_avg = (preamble_lts_1 + preamble_lts_2) / 2
     preamble_lts_avg_f = np.fft.fft(preamble_lts_avg, 64)
     h = np.zeros((64, 1), dtype=complex)
-    for i in range(len(index)):
-        h[index[i], 0] = preamble_lts_avg_f[index[i]] / lts_frequency[index[i]]
+    h[index, 0] = preamble_lts_avg_f[index] / lts_frequency[index]
     return h
 
 
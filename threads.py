@@ -1,20 +1,58 @@
 import math
+import os
 
+import numpy as np
 from PySide6 import QtCore
 
+from llc.llc_frame import FRAME_OVERHEAD, transfer_session
 from llc.llc_nodeA import NodeALLC
 from llc.llc_nodeB import NodeBLLC
 from ofdm.ofdm_rx import OfdmRx
 from ofdm.ofdm_tx import OfdmTx
-from img_operate import read_image, save_image
-
-PKT_SIZE = 100 * 48 - 64 - 32
+from ofdm.ofdm_utils import OfdmConfig
+from img_operate import preview_image, read_image_bytes, save_image
+
+QAM_SIZE = 2  # 2 (BPSK), 4 (QPSK), 16 or 64 (QAM), on both sides of the link
+# None, 'conv-1/2', 'conv-2/3' or 'conv-3/4', on both sides of the link; the Viterbi decoder keeps up with
+# back-to-back frames at 1 MS/s for BPSK and QPSK, not for 16-QAM or 64-QAM (OfdmRx warns when it starts)
+CODING = 'conv-1/2'
+NUM_SYMBOL = 100  # OFDM symbols of a data frame
+_PHY_CONFIG = OfdmConfig(64, 16, QAM_SIZE, 'custom', coding=CODING)
+# payload bits of a data frame, whole bytes: header + payload + CRC-32 fill the PHY packet, see llc.llc_frame
+PKT_SIZE = (_PHY_CONFIG.packet_bit_size(NUM_SYMBOL) - FRAME_OVERHEAD) // 8 * 8
+# failed data frames whose LLRs the receiver keeps for chase combining with their retransmission, 0 disables
+HARQ_SIZE = 8
 PHY_TYPE = "pluto"
-ARQ_MODE = "stop-and-wait-ARQ"
+ARQ_MODE = "selective-repeat-ARQ"  # "null-ARQ", "stop-and-wait-ARQ" or "selective-repeat-ARQ"
+WINDOW_SIZE = 8  # data frames in flight (selective-repeat-ARQ), on both sides of the link
+BLOCK_ACK = 4  # data frames acknowledged by one block ACK (selective-repeat-ARQ), 0: one ACK per frame
+# OFDM symbols of an ACK frame: header + block ACK bitmap + CRC-32
+ACK_NUM_SYMBOL = _PHY_CONFIG.symbols_for_bits(FRAME_OVERHEAD + WINDOW_SIZE)
 FREQ = 1105e6
+# image payload, see img_operate.read_image_bytes: "raw" (pixels), "pyramid" (pixels coarse to fine), "file"
+# (the file as it is), "JPEG", "PJPEG" (progressive), "WEBP" or "PNG" (encoded again); the receiver decodes any
+# of them, and previews "pyramid" and "PJPEG" from their first frames
+IMAGE_CODEC = "file"
+IMAGE_QUALITY = None  # quality of JPEG/WEBP (1-95), None: the Pillow default
+IMAGE_MAX_BYTES = None  # payload budget of JPEG/WEBP in bytes, None: no budget
+# directory of the receiver journals: the frames of an interrupted transfer are kept there, and the same image
+# sent again resumes with the frames missing; None keeps the frames in memory only
+JOURNAL_DIR = os.path.join(os.getcwd(), "journal")
+
+
+def stop_llc(llc):
+    """ stop an LLC node, then its PHY, whose threads end and queues are released """
+    llc.done()
+    if llc.is_alive():
+        llc.join()
+    llc.ofdm_tx.done()
+    llc.ofdm_rx.done()
 
 
 class ReceiveThread(QtCore.QThread):
+    # seq, first byte and end byte of the image packet filled by a received frame
+    frameReceived = QtCore.Signal(int, int, int)
+
     def __init__(self, filepath: str, plutoIP: str, frameCount: int):
         super().__init__()
         self.llc = None
@@ -28,13 +66,11 @@ class ReceiveThread(QtCore.QThread):
         # Parameters for OFDM PHY
         n = 64
         cp = 16
-        qam_size = 2
+        qam_size = QAM_SIZE
         pilot_pattern = 'custom'
         preamble_type = '802.11'
-        tx_num_symbol = 1
-        # tx_packet_bit_size = tx_num_symbol * 48
-        rx_num_symbol = 100
-        rx_packet_bit_size = rx_num_symbol * 48
+        tx_num_symbol = ACK_NUM_SYMBOL
+        rx_num_symbol = NUM_SYMBOL
 
         # Parameters for PlutoSDR device
         tx_ipaddr = f"ip:{self.plutoIP}"
@@ -52,17 +88,39 @@ class ReceiveThread(QtCore.QThread):
         rx_args = [rx_args, rx_freq, bandwidth, rx_gain, rx_buffer_size, gain_control_mode]
 
         phy_rx = OfdmRx(PHY_TYPE, rx_args,
-                        n, cp, qam_size, pilot_pattern, preamble_type, rx_num_symbol, verbose=True)
+                        n, cp, qam_size, pilot_pattern, preamble_type, rx_num_symbol, verbose=True, coding=CODING,
+                        soft_output='float32' if HARQ_SIZE else None)
 
         print("Test double-direction LLC-layer")
         phy_tx = OfdmTx(PHY_TYPE, tx_args,
-                        n, cp, qam_size, pilot_pattern, preamble_type, tx_num_symbol, verbose=True)
-        llc_rx = NodeBLLC(phy_tx, phy_rx, rx_packet_bit_size)
+                        n, cp, qam_size, pilot_pattern, preamble_type, tx_num_symbol, verbose=True, coding=CODING)
+        llc_rx = NodeBLLC(phy_tx, phy_rx, phy_rx.packet_bit_size, harq_size=HARQ_SIZE,
+                          window_size=WINDOW_SIZE, block_ack=BLOCK_ACK, on_frame=self.frameReceived.emit,
+                          journal_dir=JOURNAL_DIR)
         self.llc = llc_rx
 
+    def received(self, start, end):
+        """ bytes [start, end) of the image packet received so far, a view of the rx buffer """
+        return self.llc.rx.buffer[start: end]
+
+    def preview(self):
+        """ (ImageHeader, PIL image) of the frames received so far, None before the image header """
+        rx = self.llc.rx
+        if rx is None:
+            return None
+        return preview_image(rx.buffer, rx.prefix_size())
+
     def run(self) -> None:
-        rx_pkt: list[int] = self.llc.recv(PKT_SIZE, self.frameCount, PHY_TYPE, is_dbl_link=True, arq_mode=ARQ_MODE)
+        try:
+            rx_pkt: np.ndarray = self.llc.recv(PKT_SIZE, self.frameCount, PHY_TYPE, is_dbl_link=True,
+                                               arq_mode=ARQ_MODE)
+        finally:
+            stop_llc(self.llc)
+        if rx_pkt is None:
+            # stopped, the journal keeps the frames for the next run
+            return
         save_image(rx_pkt, self.filepath)
+        self.llc.rx.discard()
 
 
 class TransmitThread(QtCore.QThread):
@@ -73,21 +131,20 @@ class TransmitThread(QtCore.QThread):
         self.plutoIP = plutoIP
 
         # tx
-        self.tx_pkt = list(read_image(self.filepath))
-        self.num_frame = math.ceil(len(self.tx_pkt) / PKT_SIZE)
+        # the image as bytes, framed through zero-copy slices by the LLC layer
+        self.tx_pkt = read_image_bytes(self.filepath, IMAGE_CODEC, IMAGE_QUALITY, IMAGE_MAX_BYTES)
+        self.num_frame = math.ceil(8 * len(self.tx_pkt) / PKT_SIZE)
         self.initLLC()
 
     def initLLC(self):
         # Parameters for OFDM PHY
         n = 64
         cp = 16
-        qam_size = 2
+        qam_size = QAM_SIZE
         pilot_pattern = 'custom'
         preamble_type = '802.11'
-        tx_num_symbol = 100
-        tx_packet_bit_size = tx_num_symbol * 48
-        rx_num_symbol = 1
-        # rx_packet_bit_size = rx_num_symbol * 48
+        tx_num_symbol = NUM_SYMBOL
+        rx_num_symbol = ACK_NUM_SYMBOL
 
         # Parameters for PlutoSDR device
         tx_ipaddr = f"ip:{self.plutoIP}"
@@ -104,13 +161,18 @@ class TransmitThread(QtCore.QThread):
         gain_control_mode = "fast_attack"
         rx_args = [rx_args, rx_freq, bandwidth, rx_gain, rx_buffer_size, gain_control_mode]
         phy_tx = OfdmTx(PHY_TYPE, tx_args,
-                        n, cp, qam_size, pilot_pattern, preamble_type, tx_num_symbol, verbose=True)
+                        n, cp, qam_size, pilot_pattern, preamble_type, tx_num_symbol, verbose=True, coding=CODING)
 
         print("Test double-direction LLC-layer")
         phy_rx = OfdmRx(PHY_TYPE, rx_args,
-                        n, cp, qam_size, pilot_pattern, preamble_type, rx_num_symbol, verbose=True)
-        llc_tx = NodeALLC(phy_tx, phy_rx, tx_packet_bit_size)
+                        n, cp, qam_size, pilot_pattern, preamble_type, rx_num_symbol, verbose=True, coding=CODING)
+        # the session id follows from the image, a receiver holding part of it from an interrupted run resumes
+        llc_tx = NodeALLC(phy_tx, phy_rx, phy_tx.packet_bit_size, window_size=WINDOW_SIZE,
+                          session=transfer_session(self.tx_pkt))
         self.llc = llc_tx
 
     def run(self) -> None:
-        self.llc.send(self.tx_pkt, PKT_SIZE, self.num_frame, is_dbl_link=True, arq_mode=ARQ_MODE)
+        try:
+            self.llc.send(self.tx_pkt, PKT_SIZE, is_dbl_link=True, arq_mode=ARQ_MODE)
+        finally:
+            stop_llc(self.llc)